@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+import torch
+from app.models.backends import create_backend
+from app.models.diffusion import DiffusionModel
+from app.models.evolution import EvolutionModel
+
+STAGES = (
+    "generate_latent", "mutate", "text_encode", "unet", "vae_decode",
+    "save", "load_latent", "ui_update", "end_to_end",
+)
+# パイプラインを直接呼び出す段階（remote バックエンドではパイプラインが生成サービス側にあるので計測しない）
+PIPELINE_STAGES = ("text_encode", "unet", "vae_decode")
+PROMPT = "a photograph of an astronaut riding a horse"
+
+
+class StageBenchmark:
+    """
+    生成・変異・保存の1ラウンドを段階ごとに計測するベンチマーク
+
+    各段階を単独で計測するほか、1ラウンド全体（変異→生成→保存→読み込み）も計測する。
+    結果は機械可読なJSONとして出力し、保存済みのベースラインと比較できる
+    """
+
+    def __init__(self, diffusion_model, repeats=5, warmup=1):
+        """
+        StageBenchmarkの初期化
+
+        Args:
+            diffusion_model (DiffusionModel): 計測に使うモデル
+            repeats (int): 各段階の計測回数
+            warmup (int): 計測前に捨てる実行回数
+        """
+        self.diffusion_model = diffusion_model
+        self.repeats = repeats
+        self.warmup = warmup
+
+    def run(self, population_sizes, resolutions, stages=STAGES):
+        """
+        指定された集団の大きさと解像度の組み合わせをすべて計測する
+
+        Returns:
+            list: 計測結果のリスト
+        """
+        results = []
+        for population_size in population_sizes:
+            for resolution in resolutions:
+                # 解像度ごとに新しいセッションにする（潜在変数の形状と省メモリ設定が変わる）
+                self.diffusion_model.reset_session(resolution=resolution)
+                for stage in stages:
+                    func = self._prepare(stage, population_size, resolution)
+                    if func is None:
+                        continue
+                    timings = self._measure(func)
+                    results.append(self._summarize(stage, population_size, resolution, timings))
+        return results
+
+    def _measure(self, func):
+        """関数を繰り返し実行し、各回の所要時間（ミリ秒）を返す"""
+        backend = self.diffusion_model.backend
+        for _ in range(self.warmup):
+            func()
+        backend.synchronize()
+
+        timings = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            func()
+            backend.synchronize()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    @staticmethod
+    def _summarize(stage, population_size, resolution, timings):
+        """計測結果の統計をまとめる"""
+        ordered = sorted(timings)
+        return {
+            "stage": stage,
+            "population_size": population_size,
+            "resolution": resolution,
+            "repeats": len(timings),
+            "median_ms": statistics.median(ordered),
+            "mean_ms": statistics.fmean(ordered),
+            "min_ms": ordered[0],
+            "p90_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))],
+        }
+
+    def _prepare(self, stage, population_size, resolution):
+        """段階ごとの計測対象の関数を用意する（計測できない段階はNone）"""
+        model = self.diffusion_model
+        pipe = model.pipe
+        backend = model.backend
+        if backend.remote and stage in PIPELINE_STAGES:
+            return None
+        latent_size = resolution // 8
+        latents = torch.randn((population_size, 4, latent_size, latent_size), device=model.device, dtype=torch.float16)
+
+        if stage == "generate_latent":
+            return lambda: [model.generate_latent() for _ in range(population_size)]
+
+        if stage == "mutate":
+            parents = latents[:1]
+            return lambda: EvolutionModel(parents, population_size).mutate_population()
+
+        if stage == "text_encode":
+            def encode():
+                with torch.no_grad():
+                    pipe.encode_prompt(prompt=PROMPT, device=model.device, num_images_per_prompt=1,
+                                       do_classifier_free_guidance=False)
+            return encode
+
+        if stage == "unet":
+            prompt_embeds, pooled_prompt_embeds = model._encode_prompt(PROMPT)
+
+            def denoise():
+                with torch.no_grad():
+                    return pipe(
+                        prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_prompt_embeds,
+                        height=resolution, width=resolution, latents=latents.to(backend.dtype),
+                        num_images_per_prompt=population_size, num_inference_steps=model.num_inference_steps,
+                        guidance_scale=0.0, output_type="latent"
+                    ).images
+            return denoise
+
+        if stage == "vae_decode":
+            return lambda: backend.decode_latents(pipe, latents)
+
+        if stage == "save":
+            images = self._decode(latents)
+
+            def save():
+                for i, image in enumerate(images):
+                    model._save_image_and_latent(image, latents[i:i + 1], i)
+                model.writer.flush()
+                model.latent_store.flush()
+            model._setup_base_directory()
+            return save
+
+        if stage == "load_latent":
+            model.generate_images(PROMPT, latents)
+            step = model.active_step
+            store = model.latent_store
+            return lambda: [store.get(step, i).to(model.device) for i in range(population_size)]
+
+        if stage == "ui_update":
+            return self._prepare_ui_update(population_size, resolution)
+
+        if stage == "end_to_end":
+            model.generate_images(PROMPT, latents)
+
+            def round_trip():
+                step = model.active_step
+                parents = [model.load_latent(step, i) for i in range(min(2, population_size))]
+                population = EvolutionModel(parents, population_size).mutate_population()
+                model.generate_images(PROMPT, population)
+                model.writer.flush()
+            return round_trip
+
+        raise ValueError(f"Unknown stage: {stage}")
+
+    def _prepare_ui_update(self, population_size, resolution):
+        """生成された画像を QImage に変換して QPixmap にする処理を用意する（PyQt5がない場合はNone）"""
+        try:
+            from PyQt5.QtGui import QGuiApplication, QPixmap
+            from app.ui.image_conversion import to_qimage
+        except ImportError:
+            return None
+
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        self._qt_app = QGuiApplication.instance() or QGuiApplication([])
+
+        model = self.diffusion_model
+        latents = torch.randn((population_size, 4, resolution // 8, resolution // 8), device=model.device)
+        images = self._decode(latents)
+        return lambda: [QPixmap.fromImage(to_qimage(image)) for image in images]
+
+    def _decode(self, latents):
+        """
+        計測に使う画像を用意する
+
+        remote バックエンドではVAEが生成サービス側にあるので、サービスに生成を依頼する
+        """
+        model = self.diffusion_model
+        if model.backend.remote:
+            return model.render_images(PROMPT, latents.to(torch.float16))
+        return model.backend.decode_latents(model.pipe, latents)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    計測結果をベースラインと比較する
+
+    Args:
+        results (list): 今回の計測結果
+        baseline (list): ベースラインの計測結果
+        tolerance (float): 許容する中央値の増加率（0.1なら10%）
+
+    Returns:
+        list: 比較結果のリスト（regression がTrueのものは性能が悪化している）
+    """
+    baseline_map = {(r["stage"], r["population_size"], r["resolution"]): r for r in baseline}
+    comparisons = []
+    for result in results:
+        base = baseline_map.get((result["stage"], result["population_size"], result["resolution"]))
+        if base is None:
+            continue
+        ratio = result["median_ms"] / base["median_ms"] if base["median_ms"] > 0 else float("inf")
+        comparisons.append({
+            "stage": result["stage"],
+            "population_size": result["population_size"],
+            "resolution": result["resolution"],
+            "baseline_median_ms": base["median_ms"],
+            "median_ms": result["median_ms"],
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance,
+        })
+    return comparisons
+
+
+def main():
+    """ベンチマークを実行するコマンドラインツール"""
+    parser = argparse.ArgumentParser(description="Benchmark the generate/mutate/persist loop stage by stage")
+    parser.add_argument(
+        "--backend", default=None,
+        help="inference backend (cuda, cpu, stub, remote); remote skips the text_encode, unet and vae_decode stages"
+    )
+    parser.add_argument("--population-sizes", type=int, nargs="+", default=[4])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512])
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="compare against a previous results file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    data_root = tempfile.mkdtemp(prefix="evodiffusion_bench_")
+    try:
+        model = DiffusionModel(backend=create_backend(args.backend), data_root=data_root)
+        benchmark = StageBenchmark(model, repeats=args.repeats, warmup=args.warmup)
+        results = benchmark.run(args.population_sizes, args.resolutions, args.stages)
+        model.close()
+    finally:
+        shutil.rmtree(data_root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "backend": model.backend.name,
+            "device": str(model.device),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_with_baseline(results, json.load(f)["results"], args.tolerance)
+        if any(c["regression"] for c in report["comparison"]):
+            exit_code = 1
+
+    text = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
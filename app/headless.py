@@ -0,0 +1,348 @@
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from app.models.backends import BACKEND_ENV, RemoteBackend, create_backend
+from app.models.diffusion import DiffusionModel
+from app.models.evolution import EvolutionModel
+from app.models.latent_store import LatentStore
+from app.models.lineage import LINEAGE_FILE, LatentResolver, LineageStore, is_replayable
+from app.models.user_log import iter_user_log
+
+logger = logging.getLogger(__name__)
+
+
+class SessionReplayer:
+    """
+    記録されたユーザーログをGUIなしで再生し、セッションの画像と潜在変数を再生成するクラス
+
+    DiffusionModelとEvolutionModelを直接操作し、ログの各操作を順に適用する。
+    元のセッションに系譜のレコードがあれば、チェックポイントの個体はその潜在変数を使い、
+    それ以外の変異はレコードのシードで EvolutionModel.apply_record により再現するので、潜在変数は元のセッションと一致する。
+    チェックポイントもレコードもない操作だけ、シードを設定した乱数で変異し直す。
+    再生したセッションにも同じ形式のログが書き込まれるので、それ自体を再生することもできる
+    """
+
+    def __init__(self, diffusion_model, prompt=None, population_size=4, seed=0):
+        """
+        SessionReplayerの初期化
+
+        Args:
+            diffusion_model (DiffusionModel): 画像生成に使うモデル
+            prompt (str, optional): ログにプロンプトが記録されていない場合に使うプロンプト
+            population_size (int): 集団の大きさ
+            seed (int): 変異の乱数のシード値（同じシードなら再生結果も同じになる）
+        """
+        self.diffusion_model = diffusion_model
+        self.prompt = prompt
+        self.population_size = population_size
+        self.seed = seed
+
+    def replay(self, log_path):
+        """
+        ユーザーログを再生する
+
+        Args:
+            log_path (str): ユーザーログのパス、またはセッションのディレクトリ
+
+        Returns:
+            str: 再生したセッションのベースディレクトリ
+        """
+        torch.manual_seed(self.seed)
+        self.diffusion_model.reset_session()
+        source = self._open_source_lineage(log_path)
+
+        step_map = {}  # 元のステップ → 再生したステップ
+        reproduced = set()  # 潜在変数を元のセッションと一致させて再現した元のステップ
+        try:
+            for action in group_actions(iter_user_log(log_path)):
+                prompt = action[0].get("prompt", self.prompt)
+                if prompt is None:
+                    raise ValueError("The user log has no prompt; pass one explicitly.")
+
+                source_step = action[0]["step"]
+                if source_step not in step_map:
+                    # ログに残らない初期画像の生成（プロンプトの設定）を再現する
+                    step_map[source_step], restored = self._generate_initial_population(prompt, source, source_step)
+                    if restored:
+                        reproduced.add(source_step)
+
+                result_step = action[0].get("result_step")
+                replayed = None
+                if result_step is None:
+                    result_step = max(step_map) + 1
+                elif source is not None:
+                    replayed = self._replay_records(source, result_step, step_map, reproduced)
+                    if replayed is not None:
+                        reproduced.add(result_step)
+                    else:
+                        logger.warning(
+                            "Step %d of %s has no checkpoint or lineage record; its latents will differ from the source",
+                            result_step, log_path
+                        )
+                step_map[result_step] = self._apply_action(action, step_map[source_step], prompt, replayed)
+        finally:
+            if source is not None:
+                source.lineage_store.close()
+
+        return self.diffusion_model.base_dir
+
+    def _open_source_lineage(self, log_path):
+        """
+        元のセッションの系譜のレコードとチェックポイントを開く
+
+        Args:
+            log_path (str): ユーザーログのパス、またはセッションのディレクトリ
+
+        Returns:
+            LatentResolver or None: 元のセッションの潜在変数のリゾルバ。系譜のレコードか潜在変数ストアがない場合はNone
+        """
+        session_dir = log_path if os.path.isdir(log_path) else os.path.dirname(log_path)
+        for name in (LINEAGE_FILE, LatentStore.META_FILE):
+            if not os.path.exists(os.path.join(session_dir, name)):
+                return None
+        model = self.diffusion_model
+        return LatentResolver(
+            LatentStore(session_dir), LineageStore(session_dir),
+            EvolutionModel([], device=model.device, latent_shape=model.latent_shape)
+        )
+
+    def _generate_initial_population(self, prompt, source=None, source_step=None):
+        """
+        初期画像を生成する
+
+        元のセッションから初期画像の潜在変数を復元できる場合はそれを使い、できない場合は生成し直す
+
+        Returns:
+            tuple: (生成したステップ, 元のセッションから復元したかどうか)
+        """
+        model = self.diffusion_model
+        latents = None
+        if source is not None:
+            latents = [source.resolve(source_step, i) for i in range(self.population_size)]
+            if any(latent is None for latent in latents):
+                latents = None
+        restored = latents is not None
+        if restored:
+            latents = [latent.to(model.device, torch.float16) for latent in latents]
+        else:
+            latents = [model.generate_latent(i) for i in range(self.population_size)]
+        model.generate_images(prompt, latents)
+        return model.active_step, restored
+
+    def _replay_records(self, source, result_step, step_map, reproduced):
+        """
+        元のセッションのチェックポイントと系譜のレコードから、生成されたステップの集団を再現する
+
+        チェックポイントがある個体はその潜在変数を使う。レコードだけがある個体は、親がすべて再現済みであれば
+        親を再生したステップに読み替えてレコードを適用し、そうでなければ元のセッションで復元した潜在変数を使う
+
+        Args:
+            source (LatentResolver): 元のセッションの潜在変数のリゾルバ
+            result_step (int): 元のセッションで生成されたステップ
+            step_map (dict): 元のステップ → 再生したステップ
+            reproduced (set): 潜在変数を元のセッションと一致させて再現した元のステップ
+
+        Returns:
+            tuple or None: (集団, 系譜のレコードのリスト)。レコードは再生したステップを親とし、
+                レコードを適用しなかった個体はNone。復元できない個体がある場合はNone
+        """
+        model = self.diffusion_model
+        population, lineage = [], []
+        for index in itertools.count():
+            latent = source.checkpoint(result_step, index)
+            record = source.lineage_store.get(result_step, index)
+            if latent is None and record is None:
+                break
+            if latent is None and is_replayable(record) and all(step in reproduced for step, _ in record["parents"]):
+                parents = [(step_map[step], i) for step, i in record["parents"]]
+                latent = source.evolution_model.apply_record(record, [model.load_latent(*parent) for parent in parents])
+                lineage.append(dict(record, parents=[list(parent) for parent in parents]))
+            else:
+                if latent is None:
+                    latent = source.resolve(result_step, index)
+                    if latent is None:
+                        return None
+                lineage.append(None)
+            population.append(latent.to(model.device, torch.float16))
+        if not population:
+            return None
+        return population, lineage
+
+    def _apply_action(self, action, parent_step, prompt, replayed=None):
+        """
+        1回の操作を適用して新しいステップを生成し、そのステップを返す
+
+        Args:
+            action (list): 1回の操作のログのエントリ
+            parent_step (int): 再生したセッションでの親のステップ
+            prompt (str): テキストプロンプト
+            replayed (tuple, optional): _replay_records で再現した (集団, 系譜のレコードのリスト)
+        """
+        model = self.diffusion_model
+        mutation_type = action[0]["mutation_type"]
+
+        if mutation_type not in ("random", "local"):
+            raise ValueError(f"Unknown mutation type: {mutation_type}")
+
+        if replayed is not None:
+            population, lineage = replayed
+        elif mutation_type == "random":
+            selected_ids = action[0]["selected_image_id"]
+            latents = [model.load_latent(parent_step, i) for i in selected_ids]
+            evolution_model = EvolutionModel(
+                latents, self.population_size, parent_ids=[(parent_step, i) for i in selected_ids]
+            )
+            population = evolution_model.mutate_population()
+        elif mutation_type == "local":
+            crop_rects = {entry["selected_image_id"]: entry["crop_rect"] for entry in action}
+            latents = [model.load_latent(parent_step, i) for i in range(self.population_size)]
+            evolution_model = EvolutionModel(
+                latents, self.population_size, parent_ids=[(parent_step, i) for i in range(len(latents))]
+            )
+            population = [
+                evolution_model.local_mutation(latent, crop_rects[i], parent_id=(parent_step, i)) if i in crop_rects
+                else evolution_model.keep(latent, parent_id=(parent_step, i))
+                for i, latent in enumerate(latents)
+            ]
+        if replayed is None:
+            lineage = evolution_model.lineage
+
+        model.generate_images(prompt, population, lineage=lineage)
+        for entry in action:
+            model.save_user_log(
+                entry["selected_image_id"], mutation_type, crop_rect=entry.get("crop_rect"),
+                step=parent_step, prompt=prompt, result_step=model.active_step
+            )
+        return model.active_step
+
+
+def group_actions(entries):
+    """
+    ログのエントリを1回の生成に対応する操作ごとにまとめる
+
+    局所変異では切り抜いた画像ごとにエントリが記録されるので、
+    同じ親ステップ（と生成されたステップ）を持つ連続した局所変異のエントリを1つにまとめる
+
+    Args:
+        entries (iterable): ユーザーログのエントリ
+
+    Returns:
+        list: エントリのリストのリスト
+    """
+    actions = []
+    for entry in entries:
+        previous = actions[-1][-1] if actions else None
+        if (previous is not None and entry["mutation_type"] == "local"
+                and previous["mutation_type"] == "local"
+                and previous["step"] == entry["step"]
+                and previous.get("result_step") == entry.get("result_step")):
+            actions[-1].append(entry)
+        else:
+            actions.append([entry])
+    return actions
+
+
+_worker_model = None
+
+
+def _init_worker(backend, device, data_root):
+    """ワーカープロセスごとにモデルを1回だけ読み込む"""
+    global _worker_model
+    options = {"device": device} if device is not None else {}
+    _worker_model = DiffusionModel(backend=create_backend(backend, **options), data_root=data_root)
+
+
+def _replay_in_worker(log_path, prompt, population_size, seed):
+    """ワーカープロセスでセッションを再生する"""
+    replayer = SessionReplayer(_worker_model, prompt=prompt, population_size=population_size, seed=seed)
+    base_dir = replayer.replay(log_path)
+    _worker_model.reset_session()
+    return base_dir
+
+
+def run_sessions(log_paths, data_root, backend=None, devices=(None,), workers_per_device=1,
+                 prompt=None, population_size=4, seed=0):
+    """
+    複数のセッションをプロセスプールで並列に再生する
+
+    デバイスごとに workers_per_device 個のワーカープロセスを起動し、セッションを順に割り当てる
+
+    Args:
+        log_paths (list): ユーザーログのパス、またはセッションのディレクトリのリスト
+        data_root (str): 再生したセッションを保存する場所
+        backend (str, optional): 推論バックエンドの名前
+        devices (tuple): 使うデバイスのリスト（Noneはバックエンドの既定のデバイス）
+        workers_per_device (int): デバイスごとのワーカープロセスの数
+        prompt (str, optional): ログにプロンプトが記録されていない場合に使うプロンプト
+        population_size (int): 集団の大きさ
+        seed (int): 変異の乱数のシード値
+
+    Returns:
+        list: 各セッションの (ログのパス, 再生したセッションのディレクトリ, エラーメッセージ)
+
+    Raises:
+        ValueError: remote バックエンドでデバイスを指定した場合（デバイスは生成サービスが決める）
+    """
+    if (backend or os.environ.get(BACKEND_ENV)) == RemoteBackend.name and any(d is not None for d in devices):
+        raise ValueError("--devices cannot be used with the remote backend; the service chooses its device.")
+    context = multiprocessing.get_context("spawn")
+    executors = [
+        ProcessPoolExecutor(
+            max_workers=workers_per_device, mp_context=context,
+            initializer=_init_worker, initargs=(backend, device, data_root)
+        )
+        for device in devices
+    ]
+
+    try:
+        futures = [
+            (log_path, executors[i % len(executors)].submit(_replay_in_worker, log_path, prompt, population_size, seed))
+            for i, log_path in enumerate(log_paths)
+        ]
+        results = []
+        for log_path, future in futures:
+            try:
+                results.append((log_path, future.result(), None))
+            except Exception as e:
+                results.append((log_path, None, str(e)))
+        return results
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+def main():
+    """セッションの再生を行うコマンドラインツール"""
+    parser = argparse.ArgumentParser(description="Replay recorded EvoDiffusion sessions without the GUI")
+    parser.add_argument("sessions", nargs="+", help="session directories or user log files")
+    parser.add_argument("--output", default="app/data/replay", help="directory for replayed sessions")
+    parser.add_argument("--backend", default=None, help="inference backend (cuda, cpu, stub)")
+    parser.add_argument("--devices", nargs="+", default=None, help="devices to run workers on")
+    parser.add_argument("--workers-per-device", type=int, default=1)
+    parser.add_argument("--prompt", default=None, help="prompt for logs that do not record one")
+    parser.add_argument("--population-size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if (args.backend or os.environ.get(BACKEND_ENV)) == RemoteBackend.name and args.devices:
+        parser.error("--devices cannot be used with the remote backend; the service chooses its device.")
+
+    devices = tuple(args.devices) if args.devices else (None,)
+    results = run_sessions(
+        [os.path.normpath(path) for path in args.sessions], args.output, backend=args.backend,
+        devices=devices, workers_per_device=args.workers_per_device,
+        prompt=args.prompt, population_size=args.population_size, seed=args.seed
+    )
+    for log_path, base_dir, error in results:
+        if error is None:
+            print(f"Replayed: {log_path} -> {base_dir}")
+        else:
+            print(f"Failed: {log_path}: {error}")
+
+
+if __name__ == "__main__":
+    main()
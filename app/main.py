@@ -1,4 +1,11 @@
+import time
+
+STARTED_AT = time.perf_counter()  # 起動時間の計測の基準（重いimportより前に記録する）
+
+import argparse
+import logging
 import sys
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 from app.ui.main_window import MainWindow
 
@@ -6,10 +13,20 @@ def main():
     """
     アプリケーションのメインエントリーポイント
     MainWindowを作成し、アプリケーションを実行する
+
+    モデルはウィンドウの表示後にバックグラウンドで読み込まれる
     """
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description="EvoDiffusionPython")
+    parser.add_argument("--population-size", type=int, default=4, help="number of images shown per step")
+    # 残りの引数はQtに渡す
+    args, qt_args = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(started_at=STARTED_AT, population_size=args.population_size)
     window.show()
+    # イベントループが始まり、ウィンドウが描画された時点で起動時間を表示する
+    QTimer.singleShot(0, window.report_window_shown)
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
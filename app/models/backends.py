@@ -0,0 +1,395 @@
+import os
+import shutil
+import zlib
+import numpy as np
+import torch
+from PIL import Image
+from app.models.latent_preview import LatentPreviewer
+from app.models.memory import MemoryPlan, apply_memory_plan, module_bytes
+
+MODEL_ID = "stabilityai/sdxl-turbo"
+BACKEND_ENV = "EVODIFFUSION_BACKEND"
+PIPELINE_CACHE_ENV = "EVODIFFUSION_PIPELINE_CACHE"
+
+
+class InferenceBackend:
+    """
+    DiffusionModelが使う推論環境（パイプライン・デバイス・データ型）の基底クラス
+
+    サブクラスは load_pipeline でデバイスに配置済みのパイプラインを返す
+    """
+
+    name = None
+    remote = False  # Trueの場合、パイプラインの代わりに生成サービスのクライアントを使う
+
+    def __init__(self, device, dtype):
+        """
+        InferenceBackendの初期化
+
+        Args:
+            device (str or torch.device): 推論に使うデバイス
+            dtype (torch.dtype): パイプラインの重みと入力のデータ型
+        """
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.memory_plan = None
+
+    def load_pipeline(self):
+        """
+        パイプラインを読み込み、デバイスに配置する
+
+        Returns:
+            パイプライン（diffusersのパイプラインと同じ呼び出し方ができるもの）
+        """
+        raise NotImplementedError
+
+    def create_generator(self):
+        """潜在変数の生成に使う乱数生成器を作成"""
+        return torch.Generator(device=self.device)
+
+    def decode_latents(self, pipe, latents):
+        """
+        デノイズ済みの潜在変数をVAEでデコードして画像にする
+
+        Args:
+            pipe: load_pipeline で読み込んだパイプライン
+            latents (torch.Tensor): 形状 (N, 4, H/8, W/8) の潜在変数
+
+        Returns:
+            list: PIL画像のリスト
+        """
+        vae = pipe.vae
+        dtype = vae.dtype
+        # fp16で数値が溢れるVAEはパイプラインと同様にfp32でデコードする
+        if dtype == torch.float16 and vae.config.force_upcast:
+            vae.to(torch.float32)
+        try:
+            with torch.no_grad():
+                image = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+        finally:
+            vae.to(dtype)
+        return pipe.image_processor.postprocess(image, output_type="pil")
+
+    def create_previewer(self):
+        """デノイズ済みの潜在変数の簡易プレビューを作る LatentPreviewer を作成"""
+        return LatentPreviewer()
+
+    def default_memory_budget(self):
+        """メモリ予算が指定されていない場合の予算（GPUでは搭載メモリ、それ以外は制限なし）"""
+        if self.device.type == "cuda":
+            return torch.cuda.get_device_properties(self.device).total_memory
+        return None
+
+    def configure_memory(self, pipe, height, width, batch_size, budget=None):
+        """
+        解像度とバッチサイズに合わせて、メモリ予算に収まる省メモリ設定をパイプラインに適用する
+
+        Args:
+            pipe: load_pipeline で読み込んだパイプライン
+            height (int): 画像の高さ
+            width (int): 画像の幅
+            batch_size (int): 1回のパイプライン呼び出しで生成する最大画像数
+            budget (int, optional): メモリ予算（バイト）。省略時は default_memory_budget
+
+        Returns:
+            MemoryPlan: 適用した設定
+        """
+        modules = [module for module in pipe.components.values() if isinstance(module, torch.nn.Module)]
+        sizes = [module_bytes(module) for module in modules]
+        plan = MemoryPlan.for_budget(
+            budget if budget is not None else self.default_memory_budget(),
+            sum(sizes), max(sizes, default=0), height, width, batch_size,
+            dtype_bytes=torch.finfo(self.dtype).bits // 8,
+            vae_dtype_bytes=4 if pipe.vae.config.force_upcast else torch.finfo(self.dtype).bits // 8,
+            allow_offload=self.device.type == "cuda"
+        )
+        if plan != self.memory_plan:
+            apply_memory_plan(pipe, plan, self.device, self.memory_plan)
+        self.memory_plan = plan
+        return plan
+
+    def synchronize(self):
+        """デバイス上の処理の完了を待つ（時間計測用）"""
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+
+def load_pretrained(model_id, dtype, pipeline_cache=None):
+    """
+    パイプラインの重みを読み込む
+
+    pipeline_cache（省略時は環境変数 EVODIFFUSION_PIPELINE_CACHE）が指定されている場合、
+    初回は指定したデータ型に変換した重みをそこに保存し、2回目以降はそれをローカルから直接読み込む。
+    Hubへの問い合わせ、variantの解決、データ型の変換を省けるので、再起動が速くなる
+
+    Args:
+        model_id (str): 読み込むモデルのID
+        dtype (torch.dtype): 重みのデータ型
+        pipeline_cache (str, optional): 変換済みの重みを保存する場所
+
+    Returns:
+        パイプライン（CPU上）
+    """
+    from diffusers import AutoPipelineForText2Image
+
+    pipeline_cache = pipeline_cache or os.environ.get(PIPELINE_CACHE_ENV)
+    cache_dir = None
+    if pipeline_cache:
+        dtype_name = str(dtype).rsplit(".", 1)[-1]
+        cache_dir = os.path.join(pipeline_cache, f"{model_id.replace('/', '--')}-{dtype_name}")
+        if os.path.isdir(cache_dir):
+            return AutoPipelineForText2Image.from_pretrained(cache_dir, torch_dtype=dtype, local_files_only=True)
+
+    pipe = AutoPipelineForText2Image.from_pretrained(model_id, torch_dtype=dtype, variant="fp16")
+    if cache_dir is not None:
+        # 書き込み途中のディレクトリを読み込まないよう、一時ディレクトリに保存してから置き換える
+        tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+        pipe.save_pretrained(tmp_dir)
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # 他のプロセスが先に保存した
+    return pipe
+
+
+class CudaBackend(InferenceBackend):
+    """CUDA上でfp16のSDXL Turboを動かすバックエンド"""
+
+    name = "cuda"
+
+    def __init__(self, device="cuda", model_id=MODEL_ID, pipeline_cache=None):
+        super().__init__(device, torch.float16)
+        self.model_id = model_id
+        self.pipeline_cache = pipeline_cache
+
+    def load_pipeline(self):
+        """fp16の重みを読み込み、GPUに配置する"""
+        pipe = load_pretrained(self.model_id, torch.float16, self.pipeline_cache)
+        return pipe.to(self.device)
+
+
+class CpuBackend(InferenceBackend):
+    """
+    CPU向けに調整したバックエンド
+
+    bf16/fp32 の選択、スレッド数の指定、channels_last のメモリ配置、
+    および任意で torch.compile によるUNetのコンパイルを行う
+    """
+
+    name = "cpu"
+    DTYPES = {"bfloat16": torch.bfloat16, "float32": torch.float32}
+
+    def __init__(self, dtype="bfloat16", num_threads=None, channels_last=True, compile=False, model_id=MODEL_ID,
+                 pipeline_cache=None, device="cpu"):
+        """
+        CpuBackendの初期化
+
+        Args:
+            dtype (str): "bfloat16" または "float32"
+            num_threads (int, optional): 推論に使うスレッド数。省略時はPyTorchの既定値
+            channels_last (bool): UNetとVAEを channels_last のメモリ配置にするかどうか
+            compile (bool): UNetを torch.compile でコンパイルするかどうか
+            model_id (str): 読み込むモデルのID
+            pipeline_cache (str, optional): 変換済みの重みを保存する場所（load_pretrained を参照）
+            device (str): CPUのデバイス名（他のバックエンドと同じく device を指定できるようにするため）
+        """
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported CPU dtype: {dtype}")
+        if torch.device(device).type != "cpu":
+            raise ValueError(f"CpuBackend cannot run on device: {device}")
+        super().__init__(device, self.DTYPES[dtype])
+        self.num_threads = num_threads
+        self.channels_last = channels_last
+        self.compile = compile
+        self.model_id = model_id
+        self.pipeline_cache = pipeline_cache
+
+    def load_pipeline(self):
+        """重みを指定したデータ型で読み込み、CPU向けの設定を適用する"""
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        pipe = load_pretrained(self.model_id, self.dtype, self.pipeline_cache)
+        pipe = pipe.to(self.device)
+
+        if self.channels_last:
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.vae.to(memory_format=torch.channels_last)
+        if self.compile:
+            pipe.unet = torch.compile(pipe.unet)
+        return pipe
+
+
+class StubBackend(InferenceBackend):
+    """負荷試験やCI向けに StubPipeline を使うバックエンド"""
+
+    name = "stub"
+
+    def __init__(self, device="cpu"):
+        super().__init__(device, torch.float32)
+
+    def load_pipeline(self):
+        """StubPipelineを作成する"""
+        return StubPipeline(device=self.device, dtype=self.dtype)
+
+    def decode_latents(self, pipe, latents):
+        """StubPipelineのデコードで潜在変数を画像にする"""
+        return pipe.decode(latents, latents.shape[2] * 8, latents.shape[3] * 8)
+
+    def create_previewer(self):
+        """StubPipelineのデコードと同じく、先頭3チャネルをRGBとみなすプレビューを作成"""
+        return LatentPreviewer(factors=((1, 0, 0), (0, 1, 0), (0, 0, 1), (0, 0, 0)), bias=(0, 0, 0))
+
+    def configure_memory(self, pipe, height, width, batch_size, budget=None):
+        """StubPipelineは重みを持たないので、省メモリ設定は適用しない"""
+        self.memory_plan = MemoryPlan(budget=budget)
+        return self.memory_plan
+
+
+class StubPipelineOutput:
+    """StubPipelineの出力（diffusersの出力と同じく images 属性を持つ）"""
+
+    def __init__(self, images):
+        self.images = images
+
+
+class StubPipeline:
+    """
+    SDXLのパイプラインと同じ呼び出し方ができる軽量で決定的なパイプライン
+
+    モデルの重みは読み込まず、潜在変数とプロンプトから決まった計算で画像を作る。
+    同じ入力からは常に同じ画像が得られる
+    """
+
+    def __init__(self, device="cpu", dtype=torch.float32, seq_len=77, embed_dim=2048, pooled_dim=1280):
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.seq_len = seq_len
+        self.embed_dim = embed_dim
+        self.pooled_dim = pooled_dim
+
+    def to(self, device):
+        """デバイスを変更する"""
+        self.device = torch.device(device)
+        return self
+
+    def encode_prompt(self, prompt, device=None, num_images_per_prompt=1, do_classifier_free_guidance=True, **kwargs):
+        """
+        プロンプトから決定的な埋め込みを作る
+
+        Returns:
+            tuple: (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)
+        """
+        generator = torch.Generator().manual_seed(zlib.crc32(prompt.encode("utf-8")))
+        prompt_embeds = torch.randn((1, self.seq_len, self.embed_dim), generator=generator)
+        pooled_prompt_embeds = torch.randn((1, self.pooled_dim), generator=generator)
+
+        device = device or self.device
+        prompt_embeds = prompt_embeds.to(device, self.dtype).repeat(num_images_per_prompt, 1, 1)
+        pooled_prompt_embeds = pooled_prompt_embeds.to(device, self.dtype).repeat(num_images_per_prompt, 1)
+        return prompt_embeds, None, pooled_prompt_embeds, None
+
+    def __call__(self, prompt=None, prompt_embeds=None, pooled_prompt_embeds=None, height=512, width=512,
+                 latents=None, num_images_per_prompt=1, num_inference_steps=1, guidance_scale=0.0,
+                 callback_on_step_end=None, output_type="pil", **kwargs):
+        """
+        潜在変数から画像を生成する
+
+        Returns:
+            StubPipelineOutput: 生成された画像（output_type="latent" の場合は潜在変数）
+        """
+        if prompt_embeds is None:
+            prompt_embeds, _, pooled_prompt_embeds, _ = self.encode_prompt(prompt or "")
+        batch_size = prompt_embeds.shape[0] * num_images_per_prompt
+
+        if latents is None:
+            latents = torch.randn((batch_size, 4, height // 8, width // 8))
+        latents = latents.to(self.device, self.dtype)
+        shift = prompt_embeds.float().mean(dim=(1, 2)).to(self.dtype)
+        shift = shift.repeat_interleave(batch_size // shift.shape[0]).view(-1, 1, 1, 1)
+
+        for i in range(num_inference_steps):
+            latents = torch.tanh(latents + shift)
+            if callback_on_step_end is not None:
+                callback_kwargs = callback_on_step_end(self, i, num_inference_steps - i, {"latents": latents})
+                latents = callback_kwargs.get("latents", latents)
+
+        if output_type == "latent":
+            return StubPipelineOutput(latents)
+        return StubPipelineOutput(self.decode(latents, height, width))
+
+    @staticmethod
+    def decode(latents, height, width):
+        """潜在変数の先頭3チャネルを拡大してRGB画像にする"""
+        rgb = ((latents[:, :3].float().clamp(-1, 1) + 1) * 127.5).to(torch.uint8)
+        rgb = rgb.repeat_interleave(height // rgb.shape[2], dim=2).repeat_interleave(width // rgb.shape[3], dim=3)
+        arrays = rgb.permute(0, 2, 3, 1).cpu().numpy()
+        return [Image.fromarray(np.ascontiguousarray(array)) for array in arrays]
+
+
+class RemoteBackend(InferenceBackend):
+    """
+    生成サービス（app.service）に画像生成を依頼するクライアントモードのバックエンド
+
+    モデルはサービスのプロセスが読み込むので、このプロセスでは読み込まない。
+    潜在変数はCPU上で作成してサービスに送る
+    """
+
+    name = "remote"
+    remote = True
+
+    def __init__(self, address=None, authkey=None, latent_pool_slots=64):
+        """
+        RemoteBackendの初期化
+
+        Args:
+            address (str, optional): サービスのアドレス。省略時は環境変数 EVODIFFUSION_SERVICE
+            authkey (bytes, optional): 認証に使う鍵。省略時は環境変数 EVODIFFUSION_SERVICE_KEY
+            latent_pool_slots (int): 潜在変数の受け渡しに使う共有メモリのスロット数
+                （UNIXソケットで接続する場合のみ使う。0の場合は共有メモリを使わない）
+        """
+        super().__init__("cpu", torch.float16)
+        self.address = address
+        self.authkey = authkey
+        self.latent_pool_slots = latent_pool_slots
+
+    def load_pipeline(self):
+        """サービスに接続するクライアントを作成する"""
+        from app.models.service_client import ServiceClient
+
+        return ServiceClient(self.address, self.authkey, latent_pool_slots=self.latent_pool_slots)
+
+    def decode_latents(self, pipe, latents):
+        """VAEはサービス側にあるので、クライアントモードではデコードできない"""
+        raise NotImplementedError("The remote backend cannot decode latents locally.")
+
+    def configure_memory(self, pipe, height, width, batch_size, budget=None):
+        """省メモリ設定はパイプラインを持つ生成サービスが選ぶ"""
+        self.memory_plan = MemoryPlan(budget=budget)
+        return self.memory_plan
+
+
+BACKENDS = {
+    CudaBackend.name: CudaBackend,
+    CpuBackend.name: CpuBackend,
+    StubBackend.name: StubBackend,
+    RemoteBackend.name: RemoteBackend,
+}
+
+
+def create_backend(name=None, **options):
+    """
+    名前からバックエンドを作成する
+
+    Args:
+        name (str, optional): "cuda"、"cpu"、"stub"、"remote" のいずれか。
+            省略時は環境変数 EVODIFFUSION_BACKEND、それもなければ "cuda"
+        **options: バックエンドのコンストラクタに渡す引数
+
+    Returns:
+        InferenceBackend: 作成したバックエンド
+    """
+    name = name or os.environ.get(BACKEND_ENV, CudaBackend.name)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}")
+    return BACKENDS[name](**options)
@@ -0,0 +1,544 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from app.models.latent_store import LatentStore
+from app.models.user_log import iter_user_log
+
+CATALOG_FILE = "catalog.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    base_dir TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_step INTEGER,
+    latent_shape TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    prompt TEXT,
+    parent_step INTEGER,
+    num_individuals INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (session_id, step)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS individuals (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    image_path TEXT,
+    latent_row INTEGER,
+    PRIMARY KEY (session_id, step, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    step INTEGER,
+    result_step INTEGER,
+    mutation_type TEXT NOT NULL,
+    selected_image_id TEXT NOT NULL,
+    crop_rect TEXT,
+    prompt TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_created_at ON sessions(created_at);
+CREATE INDEX IF NOT EXISTS steps_prompt ON steps(prompt, session_id);
+CREATE INDEX IF NOT EXISTS actions_session_result ON actions(session_id, result_step);
+"""
+
+_SESSION_NAME = re.compile(r"^(\d{8}_\d{6})(?:_\d+)?$")
+_STEP_DIR = re.compile(r"^step_(\d+)$")
+_IMAGE_FILE = re.compile(r"^image_(\d+)\.\w+$")
+
+
+class SessionCatalog:
+    """
+    セッション・ステップ・個体・ファイルの場所・ユーザーの操作を記録するSQLiteの索引
+
+    DiffusionModel は保存のたびにこの索引を更新するので、プロンプトや日時、系譜による検索や
+    個体の潜在変数の場所の取得に、セッションのディレクトリを走査する必要はない。
+    WALモードで開くので、複数のプロセス（ヘッドレスの並列再生など）から同時に更新できる
+    """
+
+    def __init__(self, path, timeout=30.0):
+        """
+        SessionCatalogの初期化（索引がなければ作成する）
+
+        Args:
+            path (str): 索引のファイルのパス
+            timeout (float): 他のプロセスの書き込みを待つ最大時間（秒）
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+        self._session_ids = {}
+
+    @staticmethod
+    def _normalize(base_dir):
+        """セッションのディレクトリを索引のキー（絶対パス）にする"""
+        return os.path.abspath(base_dir)
+
+    def register_session(self, base_dir, latent_shape, created_at=None):
+        """
+        セッションを登録する（登録済みなら何もしない）
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+            latent_shape (tuple): バッチ次元を除いた潜在変数の形状
+            created_at (float, optional): 作成日時（UNIX時間）。省略時は現在時刻
+
+        Returns:
+            int: セッションのID
+        """
+        key = self._normalize(base_dir)
+        created_at = time.time() if created_at is None else created_at
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sessions (base_dir, created_at, updated_at, latent_shape) VALUES (?, ?, ?, ?)",
+                (key, created_at, created_at, json.dumps(list(latent_shape)))
+            )
+            session_id = self._conn.execute("SELECT id FROM sessions WHERE base_dir = ?", (key,)).fetchone()[0]
+            self._session_ids[key] = session_id
+        return session_id
+
+    def session_id(self, base_dir):
+        """
+        セッションのIDを取得
+
+        Returns:
+            int or None: セッションのID。登録されていない場合はNone
+        """
+        key = self._normalize(base_dir)
+        with self._lock:
+            session_id = self._session_ids.get(key)
+            if session_id is None:
+                row = self._conn.execute("SELECT id FROM sessions WHERE base_dir = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                session_id = self._session_ids[key] = row[0]
+        return session_id
+
+    def record_step(self, base_dir, step, prompt, parent_step, individuals, created_at=None):
+        """
+        ステップとその個体を記録する（同じステップの記録は置き換える）
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+            step (int): ステップ番号
+            prompt (str or None): 生成に使ったプロンプト
+            parent_step (int or None): 変異の親となったステップ
+            individuals (list): (インデックス, 画像のパス, 潜在変数ストアの行番号) のリスト
+            created_at (float, optional): 生成日時（UNIX時間）。省略時は現在時刻
+        """
+        session_id = self._require_session(base_dir)
+        created_at = time.time() if created_at is None else created_at
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (session_id, step, prompt, parent_step, num_individuals, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, step, prompt, parent_step, len(individuals), created_at)
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO individuals (session_id, step, idx, image_path, latent_row) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, step, index, path, row) for index, path, row in individuals]
+            )
+            self._conn.execute(
+                "UPDATE sessions SET updated_at = ?, last_step = max(coalesce(last_step, -1), ?) WHERE id = ?",
+                (created_at, step, session_id)
+            )
+
+    def record_action(self, base_dir, entry, created_at=None):
+        """
+        ユーザーの操作（ユーザーログの1エントリ）を記録する
+
+        エントリに生成されたステップ（result_step）があれば、そのステップの親を操作の対象のステップにする
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+            entry (dict): ユーザーログのエントリ
+            created_at (float, optional): 操作の日時（UNIX時間）。省略時は現在時刻
+        """
+        session_id = self._require_session(base_dir)
+        crop_rect = entry.get("crop_rect")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO actions (session_id, step, result_step, mutation_type, selected_image_id, "
+                "crop_rect, prompt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session_id, entry.get("step"), entry.get("result_step"), entry["mutation_type"],
+                    json.dumps(entry["selected_image_id"]),
+                    json.dumps(crop_rect) if crop_rect is not None else None,
+                    entry.get("prompt"), time.time() if created_at is None else created_at
+                )
+            )
+            if entry.get("result_step") is not None:
+                self._conn.execute(
+                    "UPDATE steps SET parent_step = ? WHERE session_id = ? AND step = ?",
+                    (entry.get("step"), session_id, entry["result_step"])
+                )
+
+    def _require_session(self, base_dir):
+        """登録済みのセッションのIDを取得（未登録ならValueError）"""
+        session_id = self.session_id(base_dir)
+        if session_id is None:
+            raise ValueError(f"Session is not in the catalog: {base_dir}")
+        return session_id
+
+    def find_sessions(self, prompt=None, prompt_like=None, since=None, until=None, limit=None):
+        """
+        条件に合うセッションを新しい順に検索する
+
+        Args:
+            prompt (str, optional): いずれかのステップで使われたプロンプト（完全一致）
+            prompt_like (str, optional): プロンプトのLIKEパターン（例: "%cat%"）
+            since (datetime or float, optional): この日時以降に作成されたセッション
+            until (datetime or float, optional): この日時より前に作成されたセッション
+            limit (int, optional): 返す件数の上限
+
+        Returns:
+            list: セッションのdict（base_dir、created_at、last_step など）のリスト
+        """
+        conditions, params = [], []
+        if prompt is not None:
+            conditions.append("id IN (SELECT session_id FROM steps WHERE prompt = ?)")
+            params.append(prompt)
+        if prompt_like is not None:
+            conditions.append("id IN (SELECT session_id FROM steps WHERE prompt LIKE ?)")
+            params.append(prompt_like)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(_timestamp(since))
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(_timestamp(until))
+
+        query = "SELECT * FROM sessions"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        with self._lock:
+            return [_session_dict(row) for row in self._conn.execute(query, params)]
+
+    def session_steps(self, base_dir):
+        """
+        セッションのステップを番号順に取得
+
+        Returns:
+            list: ステップのdict（step、prompt、parent_step、num_individuals、created_at）のリスト
+        """
+        session_id = self._require_session(base_dir)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT step, prompt, parent_step, num_individuals, created_at FROM steps "
+                "WHERE session_id = ? ORDER BY step", (session_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def lineage(self, base_dir, step):
+        """
+        ステップの系譜（最初のステップから指定したステップまでの親をたどった列）を取得
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+            step (int): ステップ番号
+
+        Returns:
+            list: 古い順のステップのdict。各ステップには、そのステップを生成した操作の
+                mutation_type と selected_image_id（初期画像では None）が含まれる
+        """
+        session_id = self._require_session(base_dir)
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                WITH RECURSIVE chain(step, parent_step, prompt, depth) AS (
+                    SELECT step, parent_step, prompt, 0 FROM steps WHERE session_id = :session AND step = :step
+                    UNION ALL
+                    SELECT s.step, s.parent_step, s.prompt, chain.depth + 1
+                    FROM steps s JOIN chain ON s.session_id = :session AND s.step = chain.parent_step
+                )
+                SELECT chain.step, chain.parent_step, chain.prompt,
+                       (SELECT mutation_type FROM actions a
+                        WHERE a.session_id = :session AND a.result_step = chain.step LIMIT 1) AS mutation_type,
+                       (SELECT json_group_array(json(selected_image_id)) FROM actions a
+                        WHERE a.session_id = :session AND a.result_step = chain.step) AS selected
+                FROM chain ORDER BY depth DESC
+                """,
+                {"session": session_id, "step": step}
+            ).fetchall()
+
+        lineage = []
+        for row in rows:
+            entry = dict(row)
+            selected = json.loads(entry.pop("selected"))
+            entry["selected_image_id"] = _flatten_selection(selected) if selected else None
+            lineage.append(entry)
+        return lineage
+
+    def actions(self, base_dir):
+        """
+        セッションのユーザーの操作を記録順に取得
+
+        Returns:
+            list: ユーザーログと同じ形式のエントリのリスト
+        """
+        session_id = self._require_session(base_dir)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT step, result_step, mutation_type, selected_image_id, crop_rect, prompt "
+                "FROM actions WHERE session_id = ? ORDER BY id", (session_id,)
+            ).fetchall()
+
+        entries = []
+        for row in rows:
+            entry = {
+                "step": row["step"],
+                "selected_image_id": json.loads(row["selected_image_id"]),
+                "mutation_type": row["mutation_type"],
+            }
+            if row["crop_rect"] is not None:
+                entry["crop_rect"] = json.loads(row["crop_rect"])
+            if row["prompt"] is not None:
+                entry["prompt"] = row["prompt"]
+            if row["result_step"] is not None:
+                entry["result_step"] = row["result_step"]
+            entries.append(entry)
+        return entries
+
+    def individual(self, base_dir, step, index):
+        """
+        個体のファイルの場所を取得（主キーによる1回の検索）
+
+        Returns:
+            dict or None: image_path、latent_path、latent_row、latent_shape。記録がない場合はNone
+        """
+        key = self._normalize(base_dir)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT i.image_path, i.latent_row, s.latent_shape FROM individuals i "
+                "JOIN sessions s ON s.id = i.session_id "
+                "WHERE s.base_dir = ? AND i.step = ? AND i.idx = ?",
+                (key, step, index)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "image_path": row["image_path"],
+            "latent_path": os.path.join(key, LatentStore.DATA_FILE),
+            "latent_row": row["latent_row"],
+            "latent_shape": tuple(json.loads(row["latent_shape"])),
+        }
+
+    def load_latent(self, base_dir, step, index):
+        """
+        個体の潜在変数を読み込む
+
+        潜在変数ストアの索引を読まずに、記録された行だけをメモリマップで開く。
+        系譜のレコードだけが保存された個体は DiffusionModel.load_latent で復元する
+
+        Returns:
+            numpy.ndarray or None: 形状 (1, C, H, W) のfp16の配列。チェックポイントとして
+                保存されていない場合はNone
+        """
+        location = self.individual(base_dir, step, index)
+        if location is None or location["latent_row"] is None:
+            return None
+        shape = location["latent_shape"]
+        row_bytes = int(np.prod(shape)) * 2
+        return np.array(np.memmap(
+            location["latent_path"], dtype=np.float16, mode="r",
+            offset=location["latent_row"] * row_bytes, shape=(1,) + shape
+        ))
+
+    def remove_session(self, base_dir):
+        """セッションの記録を削除する（ファイルは削除しない）"""
+        key = self._normalize(base_dir)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE base_dir = ?", (key,))
+            self._session_ids.pop(key, None)
+
+    def index_session(self, base_dir):
+        """
+        既存のセッションのディレクトリを走査して索引に登録する（登録済みの記録は置き換える）
+
+        プロンプトと親のステップはユーザーログから復元する。
+        ログに現れない初期画像のステップのプロンプトは、そのステップを親とする操作のものを使う
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+
+        Returns:
+            int: 登録したステップの数
+        """
+        self.remove_session(base_dir)
+        store = _open_latent_store(base_dir)
+        latent_shape = store.latent_shape if store is not None else (4, 64, 64)
+        session_id = self.register_session(base_dir, latent_shape, created_at=_session_created_at(base_dir))
+        rows = store._rows if store is not None else {}
+
+        entries = list(iter_user_log(base_dir))
+        prompts, parents = {}, {}
+        for entry in entries:
+            prompt = entry.get("prompt")
+            if entry.get("result_step") is not None:
+                parents[entry["result_step"]] = entry.get("step")
+                if prompt is not None:
+                    prompts[entry["result_step"]] = prompt
+            if prompt is not None and entry.get("step") is not None:
+                prompts.setdefault(entry["step"], prompt)
+
+        steps = {}
+        for name in os.listdir(base_dir):
+            match = _STEP_DIR.match(name)
+            if match:
+                step_dir = os.path.join(base_dir, name)
+                steps[int(match.group(1))] = {
+                    int(image.group(1)): os.path.join(step_dir, image.group(0))
+                    for image in map(_IMAGE_FILE.match, os.listdir(step_dir)) if image
+                }
+        for step, index in rows:
+            steps.setdefault(step, {}).setdefault(index, None)
+
+        for step in sorted(steps):
+            step_dir = os.path.join(base_dir, f"step_{step}")
+            created_at = os.path.getmtime(step_dir) if os.path.isdir(step_dir) else None
+            individuals = [
+                (index, steps[step][index], rows.get((step, index)))
+                for index in sorted(steps[step])
+            ]
+            self.record_step(base_dir, step, prompts.get(step), parents.get(step), individuals, created_at)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO actions (session_id, step, result_step, mutation_type, selected_image_id, "
+                "crop_rect, prompt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        session_id, entry.get("step"), entry.get("result_step"), entry["mutation_type"],
+                        json.dumps(entry["selected_image_id"]),
+                        json.dumps(entry["crop_rect"]) if entry.get("crop_rect") is not None else None,
+                        entry.get("prompt"), 0.0
+                    )
+                    for entry in entries
+                ]
+            )
+        return len(steps)
+
+    def close(self):
+        """索引を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+
+def _timestamp(value):
+    """datetimeまたはUNIX時間をUNIX時間にする"""
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+
+def _session_dict(row):
+    """sessions の行をdictにする"""
+    session = dict(row)
+    session["latent_shape"] = tuple(json.loads(session["latent_shape"]))
+    return session
+
+
+def _flatten_selection(selected):
+    """操作ごとの選択（整数またはリスト）を1つのリストにまとめる"""
+    flattened = []
+    for value in selected:
+        flattened.extend(value if isinstance(value, list) else [value])
+    return flattened
+
+
+def _open_latent_store(base_dir):
+    """セッションの潜在変数ストアを開く（ない場合はNone）"""
+    if not os.path.exists(os.path.join(base_dir, LatentStore.META_FILE)):
+        return None
+    return LatentStore(base_dir)
+
+
+def _session_created_at(base_dir):
+    """セッションのディレクトリ名（タイムスタンプ）から作成日時を求める"""
+    match = _SESSION_NAME.match(os.path.basename(os.path.normpath(base_dir)))
+    if match:
+        return datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+    return os.path.getmtime(base_dir)
+
+
+def iter_session_dirs(data_root):
+    """
+    データディレクトリ直下のセッションのディレクトリを返す
+
+    Yields:
+        str: セッションのディレクトリ
+    """
+    with os.scandir(data_root) as entries:
+        for entry in entries:
+            if entry.is_dir() and _SESSION_NAME.match(entry.name):
+                yield entry.path
+
+
+def main():
+    """セッションの索引を構築・検索するコマンドラインツール"""
+    parser = argparse.ArgumentParser(description="Build and query the EvoDiffusion session catalog")
+    parser.add_argument("--data-root", default="app/data", help="directory containing the sessions")
+    parser.add_argument("--catalog", default=None, help="catalog file (default: <data-root>/catalog.sqlite3)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild", help="index existing session directories")
+    rebuild.add_argument("sessions", nargs="*", help="session directories (default: all under --data-root)")
+
+    find = subparsers.add_parser("find", help="find sessions")
+    find.add_argument("--prompt", default=None, help="exact prompt")
+    find.add_argument("--prompt-like", default=None, help="SQL LIKE pattern for the prompt")
+    find.add_argument("--since", default=None, help="ISO date or datetime")
+    find.add_argument("--until", default=None, help="ISO date or datetime")
+    find.add_argument("--limit", type=int, default=50)
+
+    lineage = subparsers.add_parser("lineage", help="show the lineage of a step")
+    lineage.add_argument("session", help="session directory")
+    lineage.add_argument("step", type=int)
+    args = parser.parse_args()
+
+    catalog = SessionCatalog(args.catalog or os.path.join(args.data_root, CATALOG_FILE))
+    try:
+        if args.command == "rebuild":
+            for base_dir in args.sessions or iter_session_dirs(args.data_root):
+                print(f"Indexed {catalog.index_session(base_dir)} steps: {base_dir}")
+        elif args.command == "find":
+            sessions = catalog.find_sessions(
+                prompt=args.prompt, prompt_like=args.prompt_like,
+                since=datetime.fromisoformat(args.since) if args.since else None,
+                until=datetime.fromisoformat(args.until) if args.until else None,
+                limit=args.limit
+            )
+            for session in sessions:
+                created_at = datetime.fromtimestamp(session["created_at"]).isoformat(sep=" ", timespec="seconds")
+                print(f"{created_at}  steps={(session['last_step'] or 0) + 1:<4} {session['base_dir']}")
+        else:
+            for entry in catalog.lineage(args.session, args.step):
+                print(json.dumps(entry, ensure_ascii=False))
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,48 @@
+import logging
 import torch
 import os
+import threading
 import json
+import time
 from datetime import datetime
-from diffusers import AutoPipelineForText2Image
-from diffusers.utils.torch_utils import randn_tensor
+from PIL import Image
+from app.models.backends import InferenceBackend, create_backend
+from app.models.catalog import CATALOG_FILE, SessionCatalog
+from app.models.diversity import DiversityFilter
+from app.models.evolution import EvolutionModel
+from app.models.generation_cache import GenerationCache
+from app.models.instrumentation import get_tracer
+from app.models.prompt_cache import PromptEmbeddingCache
+from app.models.persistence import AsyncWriter, ImageEncoding
+from app.models.step_cache import StepCache
+from app.models.latent_store import LatentStore
+from app.models.lineage import LatentResolver, LineageStore, is_replayable
+from app.models.memory import resolve_memory_budget
+from app.models.user_log import UserLogWriter, LOG_FILE, iter_user_log
+
+METRICS_FILE = "metrics.jsonl"
+RESOLUTION_ENV = "EVODIFFUSION_RESOLUTION"
+
+logger = logging.getLogger(__name__)
+
+
+def parse_resolution(text):
+    """
+    解像度の指定を (高さ, 幅) にする
+
+    Args:
+        text (str): "1024"（正方形）または "幅x高さ"（例: "1024x768"）
+
+    Returns:
+        tuple: (高さ, 幅)
+    """
+    width, _, height = text.lower().partition("x")
+    return int(height or width), int(width)
+
+
+class GenerationCancelled(Exception):
+    """画像生成が途中でキャンセルされたことを示す例外"""
+
 
 class DiffusionModel:
     """
@@ -14,31 +53,139 @@ class DiffusionModel:
     また、ユーザーの操作ログも記録する
     """
 
-    def __init__(self):
-        self._setup_model()
+    def __init__(self, backend=None, data_root="app/data", max_batch_size=4,
+                 prompt_cache_entries=16, prompt_cache_bytes=None, image_encoding=None, writer_workers=2, max_pending_writes=16,
+                 step_cache_bytes=512 * 1024 ** 2, generation_cache_bytes=256 * 1024 ** 2, catalog=None,
+                 checkpoint_interval=8, resolution=None, memory_budget=None):
+        """
+        DiffusionModelの初期化
+
+        Args:
+            backend (str or InferenceBackend, optional): 推論バックエンド（"cuda"、"cpu"、"stub"）。
+                省略時は環境変数 EVODIFFUSION_BACKEND、それもなければ "cuda"
+            data_root (str): セッションのディレクトリを作成する場所
+            max_batch_size (int): 1回のパイプライン呼び出しで生成する最大画像数
+            prompt_cache_entries (int, optional): プロンプト埋め込みキャッシュの最大エントリ数
+            prompt_cache_bytes (int, optional): プロンプト埋め込みキャッシュの最大バイト数
+            image_encoding (ImageEncoding, optional): 画像の保存形式。省略時はPNG
+            writer_workers (int): 保存を行うライタースレッドの数
+            max_pending_writes (int): 保存待ちにできる書き込みジョブの最大数
+            step_cache_bytes (int): 最近のステップの潜在変数と画像を保持するメモリ予算（バイト）
+            generation_cache_bytes (int): 生成条件ごとの画像を保持するメモリ予算（バイト）
+            catalog (str or SessionCatalog or bool, optional): セッションの索引、またはそのファイルのパス。
+                省略時は ``<data_root>/catalog.sqlite3``、Falseの場合は索引を更新しない
+            checkpoint_interval (int): 潜在変数をそのまま保存するステップの間隔。それ以外のステップで
+                系譜のレコードが渡された個体は、レコードだけを保存して読み込み時に復元する
+            resolution (int or tuple, optional): 生成する画像の解像度（正方形の一辺、または (高さ, 幅)）。
+                省略時は環境変数 EVODIFFUSION_RESOLUTION（"1024" や "1024x768"）、それもなければ512。
+                セッションごとに reset_session で変更できる
+            memory_budget (int or str, optional): 省メモリ設定を選ぶためのメモリ予算（"12G" など）。
+                省略時は環境変数 EVODIFFUSION_MEMORY_BUDGET、それもなければデバイスの搭載メモリ
+        """
+        self.tracer = get_tracer()
+        self._setup_model(backend)
+        self.previewer = self.backend.create_previewer()
         self._setup_generator()
-        self._initialize_attributes()
-
-    def _setup_model(self):
-        """Stable Diffusion XL Turboモデルのセットアップ"""
-        self.pipe = AutoPipelineForText2Image.from_pretrained(
-            "stabilityai/sdxl-turbo",
-            torch_dtype=torch.float16,
-            variant="fp16"
-        )
-        self.pipe = self.pipe.to("cuda")
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self._setup_pipe_lock()
+        self._setup_prompt_cache(prompt_cache_entries, prompt_cache_bytes)
+        self._setup_writer(image_encoding, writer_workers, max_pending_writes)
+        self.step_cache = StepCache(max_bytes=step_cache_bytes)
+        self.generation_cache = GenerationCache(max_bytes=generation_cache_bytes)
+        self.diversity = DiversityFilter()
+        self._initialize_attributes(data_root, max_batch_size, checkpoint_interval, memory_budget)
+        self._set_resolution(resolution or parse_resolution(os.environ.get(RESOLUTION_ENV, "512")))
+        self._setup_catalog(catalog)
+
+    def _setup_model(self, backend):
+        """バックエンドを通じたStable Diffusion XL Turboモデルのセットアップ"""
+        if not isinstance(backend, InferenceBackend):
+            backend = create_backend(backend)
+        self.backend = backend
+        self.pipe = backend.load_pipeline()
+        self.device = backend.device
 
     def _setup_generator(self):
         """乱数生成器のセットアップ"""
-        self.generator = torch.Generator(device="cuda")
+        self.generator = self.backend.create_generator()
+
+    def _setup_pipe_lock(self):
+        """パイプラインを複数のスレッドから同時に呼び出さないためのロック"""
+        self._pipe_lock = threading.Lock()
+
+    def _setup_prompt_cache(self, max_entries, max_bytes):
+        """プロンプト埋め込みキャッシュのセットアップ"""
+        self.prompt_cache = PromptEmbeddingCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def _setup_writer(self, image_encoding, num_workers, max_pending):
+        """画像と潜在変数を非同期に保存するライターのセットアップ"""
+        self.image_encoding = image_encoding or ImageEncoding()
+        self.writer = AsyncWriter(num_workers=num_workers, max_pending=max_pending)
+
+    def _setup_catalog(self, catalog):
+        """セッションの索引のセットアップ"""
+        if catalog is False:
+            self.catalog = None
+        elif isinstance(catalog, SessionCatalog):
+            self.catalog = catalog
+        else:
+            self.catalog = SessionCatalog(catalog or os.path.join(self.data_root, CATALOG_FILE))
 
-    def _initialize_attributes(self):
+    def _initialize_attributes(self, data_root, max_batch_size, checkpoint_interval, memory_budget):
         """属性の初期化"""
-        self.latent_shape = (1, 4, 64, 64)
+        self.data_root = data_root
+        self.max_batch_size = max_batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.memory_budget = resolve_memory_budget(memory_budget)
+        self.num_inference_steps = 1
+        self._initialize_session()
+
+    def _set_resolution(self, resolution):
+        """
+        画像の解像度と潜在変数の形状を設定し、メモリ予算に収まる省メモリ設定を選ぶ
+
+        Args:
+            resolution (int or tuple): 正方形の一辺、または (高さ, 幅)。8の倍数
+
+        Raises:
+            ValueError: 8の倍数でない場合
+        """
+        height, width = (resolution, resolution) if isinstance(resolution, int) else tuple(resolution)
+        if height <= 0 or width <= 0 or height % 8 or width % 8:
+            raise ValueError(f"Resolution must be a positive multiple of 8: {width}x{height}")
+        self.height = height
+        self.width = width
+        self.latent_shape = (1, 4, height // 8, width // 8)
+        self.memory_plan = self.backend.configure_memory(
+            self.pipe, height, width, self.max_batch_size, self.memory_budget
+        )
+        logger.info("%dx%d %s", width, height, self.memory_plan.describe())
+
+    @property
+    def resolution(self):
+        """生成する画像の解像度 (高さ, 幅)"""
+        return self.height, self.width
+
+    def _initialize_session(self):
+        """セッションごとの属性の初期化"""
         self.base_dir = None
+        self.latent_store = None
+        self.lineage_store = None
+        self.latent_resolver = None
+        self.user_log_writer = None
         self.current_step = 0
+        self.step_history = []
+        self.history_position = -1
         self.user_logs = []
+        self.last_step_metrics = None
+        self.last_pool_stats = None
+        self._step_individuals = {}  # インデックス → (インデックス, 画像のパス, 潜在変数ストアの行番号)
+
+    @property
+    def active_step(self):
+        """表示中（次の変異の親となる）ステップ。まだ生成していない場合はNone"""
+        if self.history_position < 0:
+            return None
+        return self.step_history[self.history_position]
 
     def generate_latent(self, seed=None):
         """
@@ -52,60 +199,596 @@ class DiffusionModel:
         """
         if seed is not None:
             self.generator.manual_seed(seed)
-        return randn_tensor(self.latent_shape, device=self.device, generator=self.generator, dtype=torch.float16)
+        return torch.randn(self.latent_shape, device=self.device, generator=self.generator, dtype=torch.float16)
 
-    def generate_images(self, prompt, latents):
+    def generate_images(self, prompt, latents, on_image=None, on_progress=None, should_cancel=None,
+                        on_preview=None, lineage=None):
         """
         与えられたプロンプトと潜在変数から画像を生成する。
 
+        集団はまとめて (N, 4, H/8, W/8) のテンソルとして扱い、
+        最大 ``max_batch_size`` 個ずつのマイクロバッチでパイプラインを呼び出す。
+        保存と戻り値の順序は入力の潜在変数の順序と同じ。
+
         Args:
             prompt (str): 画像生成のためのテキストプロンプト
-            latents (list): 潜在変数のリスト
+            latents (list or torch.Tensor): 潜在変数のリスト、または (N, 4, H/8, W/8) のテンソル
+            on_image (callable, optional): 画像が1枚できるたびに (index, image) で呼ばれる
+            on_progress (callable, optional): デノイズの各ステップ後に (完了数, 総数) で呼ばれる
+            should_cancel (callable, optional): Trueを返すと生成を中断する
+            on_preview (callable, optional): デノイズが終わりVAEデコードを始める前に、
+                簡易プレビューの (index, uint8配列 (H/8, W/8, 3)) で呼ばれる
+            lineage (list, optional): 潜在変数ごとの系譜のレコード（EvolutionModel.lineage）
 
         Returns:
             tuple: 生成された画像のリスト、ベースディレクトリ、現在のステップ
+
+        Raises:
+            GenerationCancelled: should_cancel によって生成が中断された場合
         """
         self._setup_base_directory()
-        images = []
+        self._begin_step()
+        latents = self._as_latent_list(latents)
+        images = [None] * len(latents)
+
+        try:
+            for index, image, key in self._iter_images(prompt, latents, on_progress, should_cancel, on_preview):
+                images[index] = image
+                self._store_image(index, image, latents[index], on_image, key, self._lineage_record(lineage, index))
+        except GenerationCancelled:
+            self._cancel_step()
+            raise
+
+        return self._finish_step(images, prompt)
+
+    def generate_diverse_images(self, prompt, latents, num_images, on_image=None, on_progress=None,
+                                should_cancel=None, lineage=None):
+        """
+        多めに生成した候補から多様な画像だけを選んで新しいステップとして保存する
 
-        for i, latent in enumerate(latents):
-            image = self._generate_single_image(prompt, latent)
-            images.append(image)
-            self._save_image_and_latent(image, latent, i)
+        候補をすべてマイクロバッチで生成し、DiversityFilter で互いに似ておらず、
+        セッションで既に表示した画像とも似ていない num_images 枚を選んで保存する。
+        選ばなかった候補は保存しない。所要時間と類似度は last_pool_stats に記録する
 
+        Args:
+            prompt (str): 画像生成のためのテキストプロンプト
+            latents (list or torch.Tensor): 候補の潜在変数のリスト、または (N, 4, H/8, W/8) のテンソル
+            num_images (int): 保存する画像の数
+            on_image (callable, optional): 選んだ画像を保存するたびに (index, image) で呼ばれる
+            on_progress (callable, optional): 候補のデノイズの各ステップ後に (完了数, 総数) で呼ばれる
+            should_cancel (callable, optional): Trueを返すと生成を中断する
+            lineage (list, optional): 候補ごとの系譜のレコード（EvolutionModel.lineage）
+
+        Returns:
+            tuple: 選んだ画像のリスト、ベースディレクトリ、現在のステップ
+
+        Raises:
+            GenerationCancelled: should_cancel によって生成が中断された場合
+        """
+        latents = self._as_latent_list(latents)
+        start = time.perf_counter()
+        with self.tracer.span("render_pool"):
+            images = self.render_images(prompt, latents, should_cancel, on_progress)
+        render_ms = (time.perf_counter() - start) * 1000
+
+        self._check_cancelled(should_cancel)
+        chosen = self.diversity.select(images, num_images)
+        self.last_pool_stats = dict(self.diversity.last_stats, render_ms=render_ms)
+
+        chosen_lineage = None if lineage is None else [self._lineage_record(lineage, i) for i in chosen]
+        return self.commit_images(
+            [images[i] for i in chosen], [latents[i] for i in chosen], on_image, prompt, chosen_lineage
+        )
+
+    def render_images(self, prompt, latents, should_cancel=None, on_progress=None):
+        """
+        画像を生成するが、保存やステップの更新は行わない
+
+        先読み生成など、採用されるか分からない画像を作るために使う。
+        採用する場合は commit_images で保存する
+
+        Args:
+            prompt (str): 画像生成のためのテキストプロンプト
+            latents (list or torch.Tensor): 潜在変数のリスト、または (N, 4, H/8, W/8) のテンソル
+            should_cancel (callable, optional): Trueを返すと生成を中断する
+            on_progress (callable, optional): デノイズの各ステップ後に (完了数, 総数) で呼ばれる
+
+        Returns:
+            list: 生成された画像のリスト
+
+        Raises:
+            GenerationCancelled: should_cancel によって生成が中断された場合
+        """
+        latents = self._as_latent_list(latents)
+        images = [None] * len(latents)
+        for index, image, _ in self._iter_images(prompt, latents, on_progress, should_cancel, None):
+            images[index] = image
+        return images
+
+    def commit_images(self, images, latents, on_image=None, prompt=None, lineage=None):
+        """
+        生成済みの画像を新しいステップとして保存する
+
+        Args:
+            images (list): render_images で生成した画像のリスト
+            latents (list or torch.Tensor): 画像に対応する潜在変数
+            on_image (callable, optional): 画像を保存するたびに (index, image) で呼ばれる
+            prompt (str, optional): 生成に使ったプロンプト（セッションの索引に記録する）
+            lineage (list, optional): 潜在変数ごとの系譜のレコード（EvolutionModel.lineage）
+
+        Returns:
+            tuple: 画像のリスト、ベースディレクトリ、現在のステップ
+        """
+        self._setup_base_directory()
+        self._begin_step()
+        latents = self._as_latent_list(latents)
+        for index, image in enumerate(images):
+            self._store_image(index, image, latents[index], on_image, record=self._lineage_record(lineage, index))
+        return self._finish_step(list(images), prompt)
+
+    @staticmethod
+    def _lineage_record(lineage, index):
+        """個体の系譜のレコードを取得（ない場合はNone）"""
+        if lineage is None or index >= len(lineage):
+            return None
+        return lineage[index]
+
+    @staticmethod
+    def _as_latent_list(latents):
+        """潜在変数を (1, 4, H/8, W/8) のテンソルのリストにする"""
+        return list(latents.split(1)) if torch.is_tensor(latents) else list(latents)
+
+    def _iter_images(self, prompt, latents, on_progress, should_cancel, on_preview):
+        """
+        画像を生成し、(index, image, key) を返す
+
+        生成キャッシュにある個体は先に返し、残りの個体だけをマイクロバッチにまとめて生成する。
+        key は生成条件のハッシュ値
+        """
+        keys = [self._generation_key(prompt, latent) for latent in latents]
+        pending = []
+        for index, key in enumerate(keys):
+            image = self.generation_cache.get(key)
+            if image is None:
+                self.tracer.count("generation_cache_miss")
+                pending.append(index)
+            else:
+                self.tracer.count("generation_cache_hit")
+                yield index, image, key
+        if not pending:
+            return
+
+        if on_preview is not None:
+            preview_callback = on_preview
+
+            def on_preview(position, preview):
+                # バッチ内の位置を入力の潜在変数のインデックスに戻す
+                preview_callback(pending[position], preview)
+
+        total = len(pending) * self.num_inference_steps
+        for start, batch in self._iter_batches([latents[index] for index in pending]):
+            self._check_cancelled(should_cancel)
+            step_callback = self._make_step_callback(
+                start, batch.shape[0], total, on_progress, should_cancel, on_preview
+            )
+            batch_images = self._generate_batch(prompt, batch, step_callback)
+            for offset, image in enumerate(batch_images):
+                index = pending[start + offset]
+                self.generation_cache.put(keys[index], image)
+                yield index, image, keys[index]
+
+    def _generation_key(self, prompt, latent):
+        """潜在変数1つ分の生成条件のキーを作る"""
+        return GenerationCache.make_key(
+            prompt, latent, self.height, self.width,
+            self.num_inference_steps, 0.0, model=f"{self.backend.name}:{self.backend.dtype}"
+        )
+
+    def _store_image(self, index, image, latent, on_image, key=None, record=None):
+        """現在のステップの画像と潜在変数をキャッシュに登録して通知し、保存を登録する"""
+        self.step_cache.put(self.current_step, index, latent, image)
+        # 保存待ちが溜まって書き込みの登録がブロックしても、表示は遅らせない
+        if on_image is not None:
+            on_image(index, image)
+        self._save_image_and_latent(image, latent, index, key, record)
+
+    def _begin_step(self):
+        """現在のステップの保存を始める（前の試行で保存した個体の記録は破棄する）"""
+        self._step_individuals = {}
+
+    def _cancel_step(self):
+        """
+        中断されたステップの個体の記録とキャッシュを破棄する（次の生成は同じステップ番号を使う）
+
+        ストアに書き込んだ潜在変数とレコードは残るが、再生成で後から書き込んだ方が優先される
+        """
+        self._step_individuals = {}
+        self.step_cache.discard_step(self.current_step)
+        self.latent_resolver.clear()
+        # 中断されたステップの画像の書き込みが終わってから、そのパスをリンク元から外す
+        self.writer.flush()
+        self.generation_cache.discard_paths(os.path.join(self.base_dir, f"step_{self.current_step}"))
+
+    def _finish_step(self, images, prompt=None):
+        """現在のステップを索引と履歴に追加し、次のステップに進める"""
+        self._record_step_metrics(self.current_step)
+        # 索引に記録したステップの個体は、クラッシュ後も潜在変数かレコードから復元できなければならない
+        self._sync_session_files()
+        if self.catalog is not None:
+            # 親のステップは、このステップを生成した操作が save_user_log で記録されたときに設定される
+            individuals = [self._step_individuals[index] for index in sorted(self._step_individuals)]
+            self.catalog.record_step(self.base_dir, self.current_step, prompt, None, individuals)
+        self._step_individuals = {}
+        self.diversity.add(self.current_step, images)
+        self._push_history(self.current_step)
         self.current_step += 1
         return images, self.base_dir, self.current_step
 
+    def _sync_session_files(self):
+        """潜在変数ストアと系譜のレコードをディスクに書き出す"""
+        with self.tracer.span("sync"):
+            self.latent_store.flush()
+            self.lineage_store.sync()
+
+    def _record_step_metrics(self, step):
+        """計測が有効な場合、ステップの計測結果をセッションのディレクトリに追記する"""
+        if not self.tracer.enabled:
+            return
+        summary = self.tracer.step_summary(self.device)
+        summary["step"] = step
+        self.last_step_metrics = summary
+        with open(os.path.join(self.base_dir, METRICS_FILE), "a") as f:
+            f.write(json.dumps(summary) + "\n")
+
+    def _push_history(self, step):
+        """生成したステップを履歴に追加（やり直し用の履歴は破棄）"""
+        del self.step_history[self.history_position + 1:]
+        self.step_history.append(step)
+        self.history_position = len(self.step_history) - 1
+
+    def undo(self):
+        """
+        表示中のステップを1つ前に戻す
+
+        Returns:
+            int or None: 新たに表示中となったステップ。戻れない場合はNone
+        """
+        if self.history_position <= 0:
+            return None
+        self.history_position -= 1
+        return self.active_step
+
+    def redo(self):
+        """
+        undoで戻したステップを1つ進める
+
+        Returns:
+            int or None: 新たに表示中となったステップ。進めない場合はNone
+        """
+        if self.history_position >= len(self.step_history) - 1:
+            return None
+        self.history_position += 1
+        return self.active_step
+
+    @staticmethod
+    def _check_cancelled(should_cancel):
+        """キャンセルが要求されていれば例外を送出"""
+        if should_cancel is not None and should_cancel():
+            raise GenerationCancelled()
+
+    def _make_step_callback(self, start, batch_size, total, on_progress, should_cancel, on_preview=None):
+        """デノイズの各ステップ後に進捗通知・キャンセル確認・プレビューの通知を行うコールバックを作成"""
+        if on_progress is None and should_cancel is None and on_preview is None:
+            return None
+
+        def callback(pipe, step_index, timestep, callback_kwargs):
+            self._check_cancelled(should_cancel)
+            if on_progress is not None:
+                done = start * self.num_inference_steps + (step_index + 1) * batch_size
+                on_progress(done, total)
+            if on_preview is not None and step_index == self.num_inference_steps - 1:
+                with self.tracer.span("preview"):
+                    previews = self.previewer.preview(callback_kwargs["latents"])
+                for offset, preview in enumerate(previews):
+                    on_preview(start + offset, preview)
+            return callback_kwargs
+
+        return callback
+
+    def _iter_batches(self, latents):
+        """潜在変数を (N, 4, H/8, W/8) に積み、マイクロバッチごとに返す"""
+        stacked = torch.cat(latents, dim=0)
+        batch_size = max(1, int(self.max_batch_size))
+        for start in range(0, stacked.shape[0], batch_size):
+            yield start, stacked[start:start + batch_size]
+
+    def reset_session(self, resolution=None):
+        """
+        現在のセッションを閉じ、次の生成から新しいセッションを始める
+
+        モデルは読み込み直さないので、1つのモデルで複数のセッションを続けて処理できる
+
+        Args:
+            resolution (int or tuple, optional): 新しいセッションの解像度。省略時は現在の解像度
+        """
+        self.writer.flush()
+        self._close_session_files()
+        self.step_cache.clear()
+        self.generation_cache.clear()
+        self.diversity.clear()
+        self._initialize_session()
+        if resolution is not None:
+            self._set_resolution(resolution)
+
+    def _close_session_files(self):
+        """セッションの潜在変数ストアとログを書き出して閉じる"""
+        if self.latent_store is not None:
+            self.latent_store.flush()
+        if self.lineage_store is not None:
+            self.lineage_store.close()
+        if self.user_log_writer is not None:
+            self.user_log_writer.close()
+
     def _setup_base_directory(self):
         """ベースディレクトリのセットアップ（初回のみ）"""
         if self.base_dir is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.base_dir = os.path.join("app/data", timestamp)
-            os.makedirs(self.base_dir, exist_ok=True)
-
-    def _generate_single_image(self, prompt, latent):
-        """単一の画像を生成"""
-        return self.pipe(
-            prompt=prompt,
-            height=512,
-            width=512,
-            latents=latent,
-            num_inference_steps=1,
-            guidance_scale=0.0
-        ).images[0]
-
-    def _save_image_and_latent(self, image, latent, index):
-        """画像と潜在変数を保存"""
+            self.base_dir = self._create_session_directory()
+            self._open_session_files()
+            if self.catalog is not None:
+                self.catalog.register_session(self.base_dir, self.latent_shape[1:])
+
+    def _open_session_files(self):
+        """セッションの潜在変数ストアとログを開く（既存のものがあれば追記する）"""
+        self.latent_store = LatentStore(self.base_dir, self.latent_shape[1:])
+        if self.latent_store.latent_shape != self.latent_shape[1:]:
+            # 再開したセッションの解像度に合わせる
+            _, latent_height, latent_width = self.latent_store.latent_shape
+            self._set_resolution((latent_height * 8, latent_width * 8))
+        self.lineage_store = LineageStore(self.base_dir)
+        self.latent_resolver = LatentResolver(
+            self.latent_store, self.lineage_store,
+            EvolutionModel([], device=self.device, latent_shape=self.latent_shape)
+        )
+        self.user_log_writer = UserLogWriter(os.path.join(self.base_dir, LOG_FILE))
+
+    def resume_session(self, base_dir, step=None):
+        """
+        保存済みのセッションを再開する
+
+        現在のセッションを閉じ、ベースディレクトリ・現在のステップ・履歴・操作ログを復元する。
+        履歴は指定したステップの系譜（最初のステップからの親の列）になり、そのステップが表示中となる。
+        次の生成は保存済みの最後のステップの次の番号に、セッションの解像度で保存される。
+        索引に記録がないセッションは、先にディレクトリを走査して登録する
+
+        Args:
+            base_dir (str): セッションのディレクトリ
+            step (int, optional): 表示中にするステップ。省略時は最後のステップ
+
+        Returns:
+            int or None: 表示中になったステップ。ステップが1つもない場合はNone
+
+        Raises:
+            ValueError: 指定したステップがセッションにない場合
+        """
+        catalog = self.catalog or SessionCatalog(os.path.join(self.data_root, CATALOG_FILE))
+        if catalog.session_id(base_dir) is None:
+            catalog.index_session(base_dir)
+        steps = [entry["step"] for entry in catalog.session_steps(base_dir)]
+        if step is None and steps:
+            step = steps[-1]
+        if step is not None and step not in steps:
+            raise ValueError(f"Step {step} is not in session {base_dir}")
+
+        self.reset_session()
+        self.base_dir = base_dir
+        self._open_session_files()
+        self.current_step = steps[-1] + 1 if steps else 0
+        if step is not None:
+            self.step_history = [entry["step"] for entry in catalog.lineage(base_dir, step)]
+            self.history_position = len(self.step_history) - 1
+        self.user_logs = list(iter_user_log(base_dir))
+        if catalog is not self.catalog:
+            catalog.close()
+        return self.active_step
+
+    def _create_session_directory(self):
+        """タイムスタンプ名のセッションディレクトリを作成（同名があれば連番を付ける）"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        os.makedirs(self.data_root, exist_ok=True)
+        suffix = 0
+        while True:
+            name = timestamp if suffix == 0 else f"{timestamp}_{suffix}"
+            path = os.path.join(self.data_root, name)
+            try:
+                os.makedirs(path)
+                return path
+            except FileExistsError:
+                suffix += 1
+
+    def _encode_prompt(self, prompt):
+        """
+        プロンプトを埋め込みに変換する（キャッシュがあればそれを使う）
+
+        Args:
+            prompt (str): テキストプロンプト
+
+        Returns:
+            tuple: (prompt_embeds, pooled_prompt_embeds)
+        """
+        cached = self.prompt_cache.get(prompt)
+        if cached is not None:
+            self.tracer.count("prompt_cache_hit")
+            return cached
+
+        self.tracer.count("prompt_cache_miss")
+        with self.tracer.span("encode"), torch.no_grad():
+            prompt_embeds, _, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                prompt=prompt,
+                device=self.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        self.prompt_cache.put(prompt, prompt_embeds, pooled_prompt_embeds)
+        return prompt_embeds, pooled_prompt_embeds
+
+    def _generate_batch(self, prompt, latents, step_callback=None):
+        """マイクロバッチ分の画像を1回のパイプライン呼び出しで生成"""
+        with self._pipe_lock:
+            marks = {}
+            if self.tracer.enabled:
+                step_callback = self._make_traced_callback(step_callback, marks)
+            if self.backend.remote:
+                # クライアントモードでは、プロンプトのエンコードも含めて生成サービスに依頼する
+                start = time.perf_counter()
+                images = self.pipe.generate(
+                    prompt, latents, height=self.height, width=self.width,
+                    num_inference_steps=self.num_inference_steps,
+                    guidance_scale=0.0, step_callback=step_callback
+                )
+            else:
+                prompt_embeds, pooled_prompt_embeds = self._encode_prompt(prompt)
+                start = time.perf_counter()
+                images = self.pipe(
+                    prompt_embeds=prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    height=self.height,
+                    width=self.width,
+                    latents=latents.to(self.device, self.backend.dtype),
+                    num_images_per_prompt=latents.shape[0],
+                    num_inference_steps=self.num_inference_steps,
+                    guidance_scale=0.0,
+                    callback_on_step_end=step_callback
+                ).images
+            if self.tracer.enabled:
+                # 最後のデノイズステップの完了までをdenoise、それ以降をdecodeとして記録する
+                denoised = marks.get("denoised", start)
+                self.tracer.record("denoise", (denoised - start) * 1000)
+                self.tracer.record("decode", (time.perf_counter() - denoised) * 1000)
+            return images
+
+    def _make_traced_callback(self, step_callback, marks):
+        """デノイズの各ステップの完了時刻を記録するコールバックを作成"""
+        def callback(pipe, step_index, timestep, callback_kwargs):
+            if step_callback is not None:
+                callback_kwargs = step_callback(pipe, step_index, timestep, callback_kwargs)
+            self.backend.synchronize()
+            marks["denoised"] = time.perf_counter()
+            return callback_kwargs
+        return callback
+
+    def _save_image_and_latent(self, image, latent, index, key=None, record=None):
+        """
+        画像の保存をライターに登録し、潜在変数をストアに追記
+
+        同じ生成条件の画像がすでに保存されていれば、画像を書き込む代わりにそのファイルにリンクする。
+        チェックポイントでないステップで再現できる系譜のレコードがあれば、潜在変数の代わりにレコードを追記する
+        """
         step_dir = os.path.join(self.base_dir, f"step_{self.current_step}")
         os.makedirs(step_dir, exist_ok=True)
         
-        image_path = os.path.join(step_dir, f"image_{index}.png")
-        latent_path = os.path.join(step_dir, f"latent_{index}.pt")
+        image_path = os.path.join(step_dir, f"image_{index}.{self.image_encoding.extension}")
         
-        image.save(image_path)
-        torch.save(latent, latent_path)
+        source = self.generation_cache.get_path(key) if key is not None else None
+        with self.tracer.span("save"):
+            if source is not None and source != image_path:
+                self.writer.link_image(source, image, image_path, self.image_encoding)
+            else:
+                # 書き込みに失敗したファイルをリンク元にしないよう、パスは書き込みの完了後に記録する
+                on_done = None if key is None else lambda: self.generation_cache.set_path(key, image_path)
+                self.writer.save_image(image, image_path, self.image_encoding, on_done)
+            if self._is_checkpoint(record):
+                row = self.latent_store.append(self.current_step, index, latent)
+            else:
+                row = None
+                # チェックポイントとの新旧を判別できるように、追記した時点のストアの行数を記録する
+                record = dict(record, latent_rows=self.latent_store.count)
+                self.lineage_store.append(self.current_step, index, record)
+        self._step_individuals[index] = (index, image_path if self.image_encoding.enabled else None, row)
+
+    def _is_checkpoint(self, record):
+        """個体の潜在変数をそのまま保存するか（系譜のレコードから再現できない場合も保存する）"""
+        if self.checkpoint_interval <= 1 or self.current_step % self.checkpoint_interval == 0:
+            return True
+        if not is_replayable(record):
+            return True
+        return any(parent[0] >= self.current_step for parent in record["parents"])
+
+    def load_latent(self, step, index):
+        """
+        潜在変数を読み込む
+
+        メモリ上のキャッシュにあればそれを返し、なければ潜在変数ストアから読み込む。
+        ストアにない場合は系譜のレコードから復元し、それもない場合は旧形式の ``latent_{index}.pt`` を読み込む
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+
+        Returns:
+            torch.Tensor: 潜在変数
+        """
+        latent = self.step_cache.get_latent(step, index)
+        if latent is not None:
+            self.tracer.count("step_cache_hit")
+            return latent
+
+        self.tracer.count("step_cache_miss")
+        with self.tracer.span("load"):
+            latent = self.latent_resolver.resolve(step, index) if self.latent_resolver is not None else None
+            if latent is None:
+                latent = torch.load(os.path.join(self.base_dir, f"step_{step}", f"latent_{index}.pt"))
+            latent = latent.to(self.device, torch.float16)
+        self.step_cache.put(step, index, latent=latent)
+        return latent
+
+    def load_image(self, step, index):
+        """
+        画像を読み込む
+
+        メモリ上のキャッシュにあればそれを返し、なければディスクから読み込む
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+
+        Returns:
+            PIL.Image.Image or None: 画像。ディスクにも保存されていない場合はNone
+        """
+        image = self.step_cache.get_image(step, index)
+        if image is not None:
+            self.tracer.count("step_cache_hit")
+            return image
+
+        self.tracer.count("step_cache_miss")
+        self.writer.flush()
+        image_path = os.path.join(self.base_dir, f"step_{step}", f"image_{index}.{self.image_encoding.extension}")
+        if not os.path.exists(image_path):
+            return None
+        with self.tracer.span("load"), Image.open(image_path) as f:
+            image = f.convert("RGB")
+        self.step_cache.put(step, index, image=image)
+        return image
+
+    def pop_write_errors(self):
+        """
+        バックグラウンドの保存で発生したエラーを取り出す
+
+        Returns:
+            list: (パス, 例外) のリスト
+        """
+        return self.writer.pop_errors()
+
+    def close(self):
+        """保存待ちの書き込みを完了させ、ライターを終了する（クライアントモードではサービスから切断する）"""
+        self.writer.close()
+        self._close_session_files()
+        if self.catalog is not None:
+            self.catalog.close()
+        if self.backend.remote:
+            self.pipe.close()
 
-    def save_user_log(self, selected_image_id, mutation_type, crop_rect=None):
+    def save_user_log(self, selected_image_id, mutation_type, crop_rect=None, step=None,
+                      prompt=None, result_step=None):
         """
         ユーザーの操作ログを保存する
 
@@ -113,21 +796,27 @@ class DiffusionModel:
             selected_image_id (int or list): ユーザーが選択した画像のID（複数可）
             mutation_type (str): 変異のタイプ（'random' または 'local'）
             crop_rect (dict, optional): 局所変異の場合のクロップ領域
+            step (int, optional): 記録するステップ。省略時は表示中のステップ
+            prompt (str, optional): 生成に使ったプロンプト
+            result_step (int, optional): この操作で生成されたステップ
         """
+        if step is None:
+            step = self.active_step  # 変異の親となったステップのログを記録
+
         log_entry = {
-            "step": self.current_step - 1,  # 直前のステップのログを記録
+            "step": step,
             "selected_image_id": selected_image_id,
             "mutation_type": mutation_type
         }
 
         if mutation_type == 'local' and crop_rect is not None:
             log_entry["crop_rect"] = crop_rect
+        if prompt is not None:
+            log_entry["prompt"] = prompt
+        if result_step is not None:
+            log_entry["result_step"] = result_step
 
         self.user_logs.append(log_entry)
-        self._write_user_log_to_file()
-
-    def _write_user_log_to_file(self):
-        """ユーザーログをJSONファイルに書き込む"""
-        log_path = os.path.join(self.base_dir, "user_log.json")
-        with open(log_path, "w") as f:
-            json.dump(self.user_logs, f, indent=2)
+        self.user_log_writer.append(log_entry)
+        if self.catalog is not None:
+            self.catalog.record_action(self.base_dir, log_entry)
@@ -0,0 +1,244 @@
+import threading
+import time
+import numpy as np
+from PIL import Image
+from app.models.instrumentation import get_tracer
+
+
+class TinyImageEmbedder:
+    """
+    画像を縮小した画素値から埋め込みベクトルを作る軽量な埋め込みモデル
+
+    各画像を size 四方に平均で縮小し、画像ごとに平均を引いて正規化したRGBの画素値を埋め込みとする。
+    埋め込みの内積は縮小画像の相関係数になり、構図と色がほぼ同じ画像ほど1に近づく。
+    学習済みのモデルを使わないので、32枚の埋め込みでも数ミリ秒で済む
+    """
+
+    def __init__(self, size=16):
+        """
+        TinyImageEmbedderの初期化
+
+        Args:
+            size (int): 縮小画像の一辺の画素数（埋め込みの次元は size × size × 3）
+        """
+        self.size = size
+
+    @property
+    def dim(self):
+        """埋め込みの次元"""
+        return self.size * self.size * 3
+
+    def embed(self, images):
+        """
+        画像をまとめて埋め込む
+
+        Args:
+            images (list): PIL.Image のリスト
+
+        Returns:
+            numpy.ndarray: 形状 (N, dim) のfloat32の単位ベクトル
+        """
+        if not images:
+            return np.empty((0, self.dim), dtype=np.float32)
+        pixels = np.stack([
+            np.asarray(image.convert("RGB").resize((self.size, self.size), Image.BOX)) for image in images
+        ])
+        vectors = pixels.reshape(len(images), -1).astype(np.float32)
+        vectors -= vectors.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-6)
+
+
+class SimilarityIndex:
+    """
+    セッションで表示した画像の埋め込みを保持する類似度の索引
+
+    埋め込みは (max_entries, dim) の配列にリングバッファとして格納し、上限を超えると古いものから破棄する。
+    問い合わせは保持しているすべての埋め込みとの内積を1回の行列積で計算する
+    """
+
+    def __init__(self, max_entries=1024):
+        """
+        SimilarityIndexの初期化
+
+        Args:
+            max_entries (int): 保持する埋め込みの最大数
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._embeddings = None
+        self._keys = [None] * max_entries
+        self._next = 0
+        self._size = 0
+        self.evicted = 0
+
+    def add(self, keys, embeddings):
+        """
+        埋め込みを追加する（上限を超えた分は古いものから破棄する）
+
+        Args:
+            keys (list): 埋め込みごとのキー（(ステップ, インデックス) など）
+            embeddings (numpy.ndarray): 形状 (N, dim) の埋め込み
+        """
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_entries, embeddings.shape[1]), dtype=np.float32)
+            for key, embedding in zip(keys, embeddings):
+                if self._size == self.max_entries:
+                    self.evicted += 1
+                else:
+                    self._size += 1
+                self._embeddings[self._next] = embedding
+                self._keys[self._next] = key
+                self._next = (self._next + 1) % self.max_entries
+
+    def max_similarity(self, embeddings):
+        """
+        埋め込みごとに、索引の中で最も似ている画像との類似度を求める
+
+        Args:
+            embeddings (numpy.ndarray): 形状 (N, dim) の埋め込み
+
+        Returns:
+            numpy.ndarray: 形状 (N,) のコサイン類似度。索引が空の場合は -1
+        """
+        with self._lock:
+            if self._size == 0:
+                return np.full(len(embeddings), -1.0, dtype=np.float32)
+            return (embeddings @ self._embeddings[:self._size].T).max(axis=1)
+
+    def keys(self):
+        """保持している埋め込みのキーのリスト（古い順）"""
+        with self._lock:
+            start = self._next if self._size == self.max_entries else 0
+            return [self._keys[(start + offset) % self.max_entries] for offset in range(self._size)]
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        """索引を空にする"""
+        with self._lock:
+            self._embeddings = None
+            self._keys = [None] * self.max_entries
+            self._next = 0
+            self._size = 0
+            self.evicted = 0
+
+
+def select_diverse(embeddings, count, novelty=None):
+    """
+    互いに似ておらず、既に表示した画像とも似ていない候補を貪欲法で選ぶ
+
+    選んだ候補と既に表示した画像への最大の類似度が最も小さい候補を1つずつ加える（最遠点選択）
+
+    Args:
+        embeddings (numpy.ndarray): 形状 (N, dim) の候補の埋め込み
+        count (int): 選ぶ候補の数
+        novelty (numpy.ndarray, optional): 候補ごとの既に表示した画像への最大の類似度
+
+    Returns:
+        list: 選んだ候補の位置（選んだ順）
+    """
+    count = min(count, len(embeddings))
+    scores = np.full(len(embeddings), -1.0, dtype=np.float32) if novelty is None else novelty.astype(np.float32)
+    pairwise = embeddings @ embeddings.T
+    chosen = []
+    for _ in range(count):
+        masked = scores.copy()
+        masked[chosen] = np.inf
+        position = int(np.argmin(masked))
+        chosen.append(position)
+        scores = np.maximum(scores, pairwise[position])
+    return chosen
+
+
+class DiversityFilter:
+    """
+    多めに生成した候補から、多様で新しい画像だけを選ぶフィルタ
+
+    候補をまとめて埋め込み、セッションの類似度の索引と候補同士の類似度から表示する画像を選ぶ。
+    直前の選択の所要時間と類似度は last_stats に記録する
+    """
+
+    def __init__(self, embedder=None, max_entries=1024):
+        """
+        DiversityFilterの初期化
+
+        Args:
+            embedder (TinyImageEmbedder, optional): 埋め込みモデル。省略時は TinyImageEmbedder()
+            max_entries (int): 類似度の索引に保持する埋め込みの最大数
+        """
+        self.embedder = embedder or TinyImageEmbedder()
+        self.index = SimilarityIndex(max_entries=max_entries)
+        self.tracer = get_tracer()
+        self.last_stats = None
+
+    def select(self, images, count):
+        """
+        候補の画像から表示する画像を選ぶ
+
+        Args:
+            images (list): 候補の画像（PIL.Image）のリスト
+            count (int): 選ぶ画像の数
+
+        Returns:
+            list: 選んだ候補の位置
+        """
+        start = time.perf_counter()
+        with self.tracer.span("embed"):
+            embeddings = self.embedder.embed(images)
+        embedded = time.perf_counter()
+        with self.tracer.span("diversity_select"):
+            novelty = self.index.max_similarity(embeddings)
+            chosen = select_diverse(embeddings, count, novelty)
+        selected = time.perf_counter()
+
+        chosen_embeddings = embeddings[chosen]
+        pairwise = chosen_embeddings @ chosen_embeddings.T
+        np.fill_diagonal(pairwise, -1.0)
+        self.last_stats = {
+            "candidates": len(images),
+            "selected": len(chosen),
+            "embed_ms": (embedded - start) * 1000,
+            "select_ms": (selected - embedded) * 1000,
+            "max_pairwise_similarity": float(pairwise.max()) if len(chosen) > 1 else None,
+            "max_novelty_similarity": float(novelty[chosen].max()) if len(self.index) and chosen else None,
+            "index_size": len(self.index),
+            "evicted": self.index.evicted,
+        }
+        return chosen
+
+    def add(self, step, images):
+        """
+        表示したステップの画像を類似度の索引に加える
+
+        Args:
+            step (int): ステップ番号
+            images (list): 画像（PIL.Image）のリスト
+        """
+        shown = [(index, image) for index, image in enumerate(images) if image is not None]
+        if shown:
+            keys = [(step, index) for index, _ in shown]
+            self.index.add(keys, self.embedder.embed([image for _, image in shown]))
+
+    def clear(self):
+        """索引と統計を空にする"""
+        self.index.clear()
+        self.last_stats = None
+
+
+def format_pool_stats(stats):
+    """候補の選択の統計を1行にまとめる"""
+    parts = [
+        f"{stats['selected']}/{stats['candidates']} candidates",
+        f"render {stats.get('render_ms', 0.0):.0f} ms",
+        f"embed {stats['embed_ms']:.1f} ms",
+        f"select {stats['select_ms']:.1f} ms",
+    ]
+    if stats["max_pairwise_similarity"] is not None:
+        parts.append(f"max similarity {stats['max_pairwise_similarity']:.2f}")
+    if stats["max_novelty_similarity"] is not None:
+        parts.append(f"vs. shown {stats['max_novelty_similarity']:.2f}")
+    parts.append(f"index {stats['index_size']} (evicted {stats['evicted']})")
+    return ", ".join(parts)
@@ -1,36 +1,125 @@
+import logging
+import math
 import torch
-from diffusers.utils.torch_utils import randn_tensor
+from app.models.instrumentation import get_tracer
+
+logger = logging.getLogger(__name__)
+
+_SEED_RANGE = 2 ** 62
+
 
 class EvolutionModel:
     """
     画像生成のための進化モデルを実装するクラス
 
     このクラスは、選択された潜在変数に基づいて新しい潜在変数を生成し、
-    画像の進化プロセスをシミュレートする
+    画像の進化プロセスをシミュレートする。
+    交叉（一様・ブロック・球面線形補間）と重み付きの多親組み換えは、親のテンソル全体から
+    集団のすべての子を1回のベクトル化された計算で作る。
+    ノイズや交叉のマスクは個体ごとのシードで作る乱数列から生成し、各個体の作り方（親・操作・シード・
+    ノイズの大きさ・クロップ領域）を系譜のレコードとして ``lineage`` に記録する。
+    apply_record にレコードと親の潜在変数を渡すと、同じ個体を再現できる
     """
 
-    def __init__(self, latents):
+    # apply_record で再現できる操作
+    REPLAYABLE_OPERATORS = (
+        "copy", "random", "local", "uniform_crossover", "block_crossover", "slerp", "recombination"
+    )
+
+    def __init__(self, latents, population_size=4, device=None, dtype=torch.float16, seed=None, parent_ids=None,
+                 latent_shape=None):
         """
         EvolutionModelの初期化
 
         Args:
-            latents (list): 潜在変数のリスト
+            latents (list or torch.Tensor): 潜在変数のリスト、または (N, C, H, W) のテンソル
+            population_size (int): 生成する集団の大きさ
+            device (str or torch.device, optional): 計算に使うデバイス。省略時は潜在変数と同じデバイス
+            dtype (torch.dtype): 潜在変数のデータ型
+            seed (int, optional): 個体ごとのシードを決める乱数のシード値。省略時はtorchの乱数から決める
+            parent_ids (list, optional): latents の各潜在変数の (ステップ, インデックス)。
+                系譜のレコードの親として記録する（省略時は latents での位置）
+            latent_shape (tuple, optional): 1個体の潜在変数の形状 (1, C, H/8, W/8)。
+                省略時は latents から決める（latents が空の場合は 512×512 の画像の形状）
         """
         self.latents = latents
-        self._setup_device_and_dtype()
-        self._initialize_parameters()
+        self.parent_ids = parent_ids
+        self._setup_device_and_dtype(device, dtype)
+        self._initialize_parameters(population_size, latent_shape or self._infer_latent_shape(latents))
+        self._setup_seeds(seed)
 
-    def _setup_device_and_dtype(self):
+    def _setup_device_and_dtype(self, device, dtype):
         """デバイスとデータ型のセットアップ"""
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.dtype = torch.float16
+        if device is None:
+            device = self._infer_device(self.latents)
+        self.device = torch.device(device)
+        self.dtype = dtype
+
+    @staticmethod
+    def _infer_device(latents):
+        """潜在変数が置かれているデバイスを取得（不明な場合はGPUがあればGPU）"""
+        if torch.is_tensor(latents):
+            return latents.device
+        if len(latents) > 0:
+            return latents[0].device
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    def _setup_seeds(self, seed):
+        """個体ごとのシードを決める乱数生成器と系譜のレコードのセットアップ"""
+        self._seed_generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        self.lineage = []
+
+    def _next_seeds(self, count):
+        """個体ごとのシードを count 個決める"""
+        return torch.randint(0, _SEED_RANGE, (count,), generator=self._seed_generator).tolist()
+
+    def _seeded_noise(self, seeds, shape):
+        """
+        シードごとの乱数列からノイズを生成する
+
+        乱数はデバイスによらずCPUでfloat32として生成するので、同じシードからは常に同じノイズになる
+
+        Args:
+            seeds (list): 個体ごとのシード
+            shape (tuple): 1個体分のノイズの形状 (1, C, H, W)
+
+        Returns:
+            torch.Tensor: 形状 (len(seeds), C, H, W) のノイズ
+        """
+        noise = torch.cat([
+            torch.randn(shape, generator=torch.Generator().manual_seed(seed), dtype=torch.float32)
+            for seed in seeds
+        ])
+        return noise.to(self.device, self.dtype)
+
+    def _parent_id(self, position):
+        """latents での位置を系譜のレコードの親のIDにする"""
+        if self.parent_ids is None:
+            return position
+        return list(self.parent_ids[position])
 
-    def _initialize_parameters(self):
+    @staticmethod
+    def _infer_latent_shape(latents):
+        """潜在変数の形状 (1, C, H, W) を取得"""
+        if len(latents) == 0:
+            return (1, 4, 64, 64)
+        return (1,) + tuple(latents[0].shape[-3:])
+
+    def _initialize_parameters(self, population_size, latent_shape):
         """進化パラメータの初期化"""
-        self.latent_shape = (1, 4, 64, 64)
-        self.population_size = 4
+        self.latent_shape = tuple(latent_shape)
+        # クロップ領域は画像の座標で指定されるので、潜在変数の8倍の解像度で換算する
+        self.image_size = (self.latent_shape[2] * 8, self.latent_shape[3] * 8)
+        self.population_size = population_size
         self.mutation_rate = 1.0
 
+        # 集団全体の計算で毎回使う定数を事前に計算しておく
+        self.population_shape = (population_size,) + self.latent_shape[1:]
+        self.norm_factor = math.sqrt(math.prod(self.latent_shape))
+        self.noise_scales = (
+            torch.arange(population_size, device=self.device, dtype=torch.float32) / population_size
+        ).to(self.dtype).view(-1, 1, 1, 1)
+
     def random_mutation(self):
         """
         ランダムな変異を適用して新しい潜在変数を生成する
@@ -38,111 +127,365 @@ class EvolutionModel:
         Returns:
             list: 変異後の潜在変数のリスト
         """
-        num_selected = len(self.latents)
-        
-        if num_selected == 0:
-            raise ValueError("No latents available for mutation.")
-        elif num_selected == 1:
-            return self._mutate_single_latent()
-        else:
-            return self._mutate_multiple_latents()
-        
-    def _mutate_single_latent(self):
+        return list(self.mutate_population().split(1))
+
+    def mutate_population(self):
+        """
+        ランダムな変異を適用して新しい集団を生成する
+
+        1つの潜在変数が選択された場合はそれを、複数の場合はその平均を中心として、
+        個体ごとに異なる大きさのノイズを集団全体に一度に加える
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の変異後の集団
+        """
+        with get_tracer().span("mutate"):
+            parents = self._stack_latents(self.latents)
+            num_selected = parents.shape[0]
+
+            if num_selected == 0:
+                raise ValueError("No latents available for mutation.")
+            elif num_selected == 1:
+                population = self._mutate_single_latent(parents)
+            else:
+                population = self._mutate_multiple_latents(parents)
+
+            return self._normalize_latent(population)
+
+    def _mutate_single_latent(self, parents):
         """単一の潜在変数に対する変異"""
-        mutated_latents = []
-        z0 = self.latents[0]
-        
-        for i in range(self.population_size):
-            noise = self._generate_noise(i)
-            new_z = z0 + noise
-            normalized_z = self._normalize_latent(new_z)
-            mutated_latents.append(normalized_z)
-        
+        population = parents[0:1] + self._generate_noise([0])
         self._update_mutation_rate()
-        return mutated_latents
+        return population
     
-    def _mutate_multiple_latents(self):
+    def _mutate_multiple_latents(self, parents):
         """複数の潜在変数に対する変異"""
-        mutated_latents = []
-        avg_z = torch.mean(torch.stack(self.latents), dim=0)
-        
-        for i in range(self.population_size):
-            noise = self._generate_noise(i)
-            new_z = avg_z + noise
-            normalized_z = self._normalize_latent(new_z)
-            mutated_latents.append(normalized_z)
-        
-        return mutated_latents
+        avg_z = torch.mean(parents, dim=0, keepdim=True)
+        return avg_z + self._generate_noise(list(range(parents.shape[0])))
     
-    def _generate_noise(self, index):
-        """ノイズの生成"""
-        return randn_tensor(self.latent_shape, dtype=self.dtype, device=self.device) * (index / self.population_size) * self.mutation_rate
+    def _generate_noise(self, parent_positions):
+        """
+        集団全体のノイズの生成（i番目の個体の大きさは i / population_size 倍）
+
+        個体ごとのシードとノイズの大きさを系譜のレコードに記録する
 
-    def _normalize_latent(self, latent):
-        """潜在変数の正規化"""
-        norm_factor = torch.sqrt(torch.tensor(float(torch.prod(torch.tensor(self.latent_shape)))))
-        return latent / torch.norm(latent) * norm_factor
+        Args:
+            parent_positions (list): 親の latents での位置
+        """
+        seeds = self._next_seeds(self.population_size)
+        scales = self.noise_scales * self.mutation_rate
+        parents = [self._parent_id(position) for position in parent_positions]
+        self.lineage.extend(
+            {"operator": "random", "parents": parents, "seed": seed, "scale": float(scale)}
+            for seed, scale in zip(seeds, scales.flatten().tolist())
+        )
+        return self._seeded_noise(seeds, self.latent_shape) * scales
+
+    def _stack_latents(self, latents):
+        """潜在変数を (N, C, H, W) のテンソルにまとめる"""
+        if torch.is_tensor(latents):
+            return latents.to(self.device, self.dtype)
+        if len(latents) == 0:
+            return torch.empty((0,) + self.latent_shape[1:], device=self.device, dtype=self.dtype)
+        return torch.cat([latent.to(self.device, self.dtype) for latent in latents], dim=0)
+
+    def _normalize_latent(self, latents):
+        """潜在変数の正規化（(N, C, H, W) の各個体を個別に正規化）"""
+        norms = torch.linalg.vector_norm(latents.flatten(1), dim=1, dtype=torch.float32)
+        scale = (self.norm_factor / norms).to(latents.dtype).view(-1, 1, 1, 1)
+        return latents * scale
 
     def _update_mutation_rate(self):
         """変異率の更新"""
         self.mutation_rate *= 0.7
 
-    def local_mutation(self, latent, crop_rect):
+    def uniform_crossover(self, mix_rate=0.5):
+        """
+        一様交叉で新しい集団を生成する
+
+        子ごとに2つの親を選び、潜在変数の画素ごとに（全チャネル共通で）どちらの親の値を使うかを決める
+
+        Args:
+            mix_rate (float): 1つ目の親の値を使う画素の割合
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の集団
+        """
+        return self._crossover("uniform_crossover", {"mix_rate": mix_rate})
+
+    def block_crossover(self, block_size=8, mix_rate=0.5):
+        """
+        ブロック単位の空間的な交叉で新しい集団を生成する
+
+        子ごとに2つの親を選び、潜在変数を block_size 四方のブロックに分けて、
+        ブロックごとにどちらの親の値を使うかを決める（画像の領域単位で親の特徴を受け継ぐ）
+
+        Args:
+            block_size (int): ブロックの一辺（潜在変数の画素数。画像では8倍）
+            mix_rate (float): 1つ目の親の値を使うブロックの割合
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の集団
+        """
+        return self._crossover("block_crossover", {"block_size": block_size, "mix_rate": mix_rate})
+
+    def slerp_crossover(self):
+        """
+        球面線形補間（slerp）で新しい集団を生成する
+
+        子ごとに2つの親と補間の位置 t ∈ [0, 1) を選び、親の間の大円上の点を子とする。
+        線形補間と違い、ガウスノイズとしてのノルムが補間の途中で小さくならない
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の集団
+        """
+        return self._crossover("slerp", {})
+
+    def weighted_recombination(self, weights=None, spread=0.5):
+        """
+        重み付きの多親組み換えで新しい集団を生成する
+
+        すべての親の重み付き和を子とする。子ごとの重みは基準の重みに対数正規分布の揺らぎを掛けて
+        正規化したもので、集団全体を (P, K) と (K, C×H×W) の1回の行列積で計算する
+
+        Args:
+            weights (list, optional): 親ごとの基準の重み（評価の高い親を大きくする）。省略時は均等
+            spread (float): 子ごとの重みの揺らぎの大きさ（0の場合はすべての子が同じ重み）
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の集団
+        """
+        with get_tracer().span("crossover"):
+            parents = self._require_parents(1)
+            num_parents = parents.shape[0]
+            weights = [1.0] * num_parents if weights is None else [float(weight) for weight in weights]
+            if len(weights) != num_parents:
+                raise ValueError(f"Expected {num_parents} weights, got {len(weights)}.")
+
+            seeds = self._next_seeds(self.population_size)
+            params = {"weights": weights, "spread": spread}
+            self._record_offspring("recombination", [list(range(num_parents))] * len(seeds), seeds, params)
+            return self._normalize_latent(self._recombine(parents, seeds, params))
+
+    def _crossover(self, operator, params):
+        """2つの親から子を作る交叉を集団全体に一度に適用する"""
+        with get_tracer().span("crossover"):
+            parents = self._require_parents(2)
+            pairs = self._pick_pairs(parents.shape[0])
+            seeds = self._next_seeds(self.population_size)
+            self._record_offspring(operator, pairs.tolist(), seeds, params)
+            pairs = pairs.to(self.device)
+            offspring = self._combine_pairs(operator, parents[pairs[:, 0]], parents[pairs[:, 1]], seeds, params)
+            return self._normalize_latent(offspring)
+
+    def _require_parents(self, minimum):
+        """親の潜在変数を (K, C, H, W) にまとめる（minimum 個未満ならValueError）"""
+        parents = self._stack_latents(self.latents)
+        if parents.shape[0] < minimum:
+            raise ValueError(f"At least {minimum} latents are required, got {parents.shape[0]}.")
+        return parents
+
+    def _pick_pairs(self, num_parents):
+        """子ごとに異なる2つの親の位置を選ぶ（形状 (P, 2)）"""
+        first = torch.randint(0, num_parents, (self.population_size,), generator=self._seed_generator)
+        offset = torch.randint(1, num_parents, (self.population_size,), generator=self._seed_generator)
+        return torch.stack([first, (first + offset) % num_parents], dim=1)
+
+    def _record_offspring(self, operator, parent_positions, seeds, params):
+        """子ごとの系譜のレコードを記録する"""
+        self.lineage.extend(
+            dict({"operator": operator, "parents": [self._parent_id(position) for position in positions],
+                  "seed": seed}, **params)
+            for positions, seed in zip(parent_positions, seeds)
+        )
+
+    def _combine_pairs(self, operator, first, second, seeds, params):
+        """
+        2つの親の組から子を作る
+
+        Args:
+            operator (str): 交叉の種類
+            first (torch.Tensor): 形状 (P, C, H, W) の1つ目の親
+            second (torch.Tensor): 形状 (P, C, H, W) の2つ目の親
+            seeds (list): 子ごとのシード
+            params (dict): 交叉のパラメータ
+
+        Returns:
+            torch.Tensor: 形状 (P, C, H, W) の子（正規化前）
+        """
+        if operator == "uniform_crossover":
+            mask = self._seeded_masks(seeds, params["mix_rate"], 1)
+            return torch.where(mask, first, second)
+        if operator == "block_crossover":
+            mask = self._seeded_masks(seeds, params["mix_rate"], params["block_size"])
+            return torch.where(mask, first, second)
+        if operator == "slerp":
+            return self._slerp(first, second, self._seeded_uniform(seeds))
+        raise ValueError(f"Unknown crossover operator: {operator}")
+
+    def _recombine(self, parents, seeds, params):
+        """子ごとの重みで親の重み付き和を作る（正規化前）"""
+        base = torch.tensor(params["weights"], dtype=torch.float32)
+        weights = torch.stack([
+            base * torch.exp(params["spread"] * torch.randn(len(base), generator=torch.Generator().manual_seed(seed)))
+            for seed in seeds
+        ])
+        weights = (weights / weights.sum(dim=1, keepdim=True)).to(self.device)
+        offspring = weights @ parents.flatten(1).float()
+        return offspring.view((len(seeds),) + tuple(parents.shape[1:])).to(self.dtype)
+
+    def _seeded_masks(self, seeds, mix_rate, block_size):
+        """
+        子ごとのシードから交叉のマスクを作る
+
+        Returns:
+            torch.Tensor: 形状 (P, 1, H, W) のbool型のマスク（Trueは1つ目の親を使う画素）
+        """
+        _, _, height, width = self.latent_shape
+        grid = (1, 1, -(-height // block_size), -(-width // block_size))
+        values = torch.cat([torch.rand(grid, generator=torch.Generator().manual_seed(seed)) for seed in seeds])
+        if block_size > 1:
+            values = values.repeat_interleave(block_size, dim=2).repeat_interleave(block_size, dim=3)
+        return (values[:, :, :height, :width] < mix_rate).to(self.device)
+
+    def _seeded_uniform(self, seeds):
+        """子ごとのシードから [0, 1) の一様乱数を1つずつ作る（形状 (P,)）"""
+        values = [torch.rand(1, generator=torch.Generator().manual_seed(seed)) for seed in seeds]
+        return torch.cat(values).to(self.device)
+
+    @staticmethod
+    def _slerp(first, second, t):
+        """
+        (P, C, H, W) の2つの潜在変数の組を、組ごとの位置 t で球面線形補間する
+
+        2つの潜在変数がほぼ平行な場合は線形補間にする
+        """
+        a = first.flatten(1).float()
+        b = second.flatten(1).float()
+        norms = torch.linalg.vector_norm(a, dim=1) * torch.linalg.vector_norm(b, dim=1)
+        omega = torch.acos(((a * b).sum(dim=1) / norms.clamp_min(1e-12)).clamp(-1, 1)).unsqueeze(1)
+        sin_omega = torch.sin(omega)
+        t = t.view(-1, 1)
+        parallel = sin_omega < 1e-6
+        sin_omega = sin_omega.clamp_min(1e-6)
+        weight_a = torch.where(parallel, 1 - t, torch.sin((1 - t) * omega) / sin_omega)
+        weight_b = torch.where(parallel, t, torch.sin(t * omega) / sin_omega)
+        return (weight_a * a + weight_b * b).view_as(first).to(first.dtype)
+
+    def local_mutation(self, latent, crop_rect, parent_id=None):
         """
         指定された潜在変数の特定の領域にローカルな変異を適用する
 
         Args:
             latent (torch.Tensor): 変異を適用する潜在変数
-            crop_rect (QRect): クロップ領域
+            crop_rect (QRect or dict): 画像の座標でのクロップ領域。dictの場合はユーザーログと同じ
+                x_start, y_start, x_end, y_end のキーを持つ
+            parent_id (tuple, optional): 系譜のレコードに記録する親の (ステップ, インデックス)
 
         Returns:
             torch.Tensor: 変異後の潜在変数
         """
-        x_start, y_start = crop_rect.topLeft().x(), crop_rect.topLeft().y()
-        x_end, y_end = crop_rect.bottomRight().x(), crop_rect.bottomRight().y()
+        x_start, y_start, x_end, y_end = self._crop_bounds(crop_rect)
 
         # 潜在空間の座標に変換
-        latent_x_start = max(0, int(x_start * self.latent_shape[3] / 512))
-        latent_y_start = max(0, int(y_start * self.latent_shape[2] / 512))
-        latent_x_end = min(self.latent_shape[3], int(x_end * self.latent_shape[3] / 512))
-        latent_y_end = min(self.latent_shape[2], int(y_end * self.latent_shape[2] / 512))
+        image_height, image_width = self.image_size
+        latent_x_start = max(0, int(x_start * self.latent_shape[3] / image_width))
+        latent_y_start = max(0, int(y_start * self.latent_shape[2] / image_height))
+        latent_x_end = min(self.latent_shape[3], int(x_end * self.latent_shape[3] / image_width))
+        latent_y_end = min(self.latent_shape[2], int(y_end * self.latent_shape[2] / image_height))
 
-        print(f"Crop rect: {crop_rect}")
-        print(f"Latent coordinates: ({latent_x_start}, {latent_y_start}) to ({latent_x_end}, {latent_y_end})")
-        print(f"Latent shape: {latent.shape}")
+        logger.debug("Crop rect %s -> latent (%d, %d) to (%d, %d), latent shape %s", crop_rect,
+                     latent_x_start, latent_y_start, latent_x_end, latent_y_end, tuple(latent.shape))
 
-        return self._edit_latent(latent, (latent_x_start, latent_y_start, latent_x_end, latent_y_end))
+        target_area = (latent_x_start, latent_y_start, latent_x_end, latent_y_end)
+        seed = self._next_seeds(1)[0]
+        self.lineage.append({
+            "operator": "local", "parents": [list(parent_id) if parent_id is not None else 0],
+            "seed": seed, "crop": list(target_area)
+        })
+        with get_tracer().span("mutate"):
+            return self._edit_latent(latent, target_area, seed)
+
+    def keep(self, latent, parent_id=None):
+        """
+        潜在変数を変更せずに次の集団に残す（系譜のレコードだけを記録する）
 
-    def _edit_latent(self, initial_latent, target_area):
+        Args:
+            latent (torch.Tensor): 残す潜在変数
+            parent_id (tuple, optional): 系譜のレコードに記録する親の (ステップ, インデックス)
+
+        Returns:
+            torch.Tensor: 渡された潜在変数
+        """
+        self.lineage.append({"operator": "copy", "parents": [list(parent_id) if parent_id is not None else 0]})
+        return latent
+
+    def apply_record(self, record, parents):
+        """
+        系譜のレコードを親の潜在変数に適用し、記録された個体を再現する
+
+        Args:
+            record (dict): lineage に記録されたレコード
+            parents (list): レコードの親の順に並べた潜在変数のリスト
+
+        Returns:
+            torch.Tensor: 形状 (1, C, H, W) の潜在変数
+
+        Raises:
+            ValueError: 再現できない操作の場合
+        """
+        operator = record["operator"]
+        parents = self._stack_latents(parents)
+        if operator == "copy":
+            return parents[0:1]
+        if operator == "local":
+            return self._edit_latent(parents[0:1], tuple(record["crop"]), record["seed"])
+        if operator == "random":
+            center = parents[0:1] if parents.shape[0] == 1 else torch.mean(parents, dim=0, keepdim=True)
+            scale = torch.tensor(record["scale"], dtype=self.dtype, device=self.device)
+            return self._normalize_latent(center + self._seeded_noise([record["seed"]], self.latent_shape) * scale)
+        if operator in ("uniform_crossover", "block_crossover", "slerp"):
+            return self._normalize_latent(
+                self._combine_pairs(operator, parents[0:1], parents[1:2], [record["seed"]], record)
+            )
+        if operator == "recombination":
+            return self._normalize_latent(self._recombine(parents, [record["seed"]], record))
+        raise ValueError(f"Cannot replay lineage operator: {operator}")
+
+    @staticmethod
+    def _crop_bounds(crop_rect):
+        """クロップ領域を (x_start, y_start, x_end, y_end) に変換"""
+        if isinstance(crop_rect, dict):
+            return crop_rect["x_start"], crop_rect["y_start"], crop_rect["x_end"], crop_rect["y_end"]
+        return (crop_rect.topLeft().x(), crop_rect.topLeft().y(),
+                crop_rect.bottomRight().x(), crop_rect.bottomRight().y())
+
+    def _edit_latent(self, initial_latent, target_area, seed):
         """
         指定された領域を新しいランダムノイズで置き換える関数
 
         Args:
             initial_latent (torch.Tensor): 編集する潜在変数
             target_area (tuple): 編集対象の領域を指定する(x_start, y_start, x_end, y_end)
+            seed (int): ノイズの乱数のシード
 
         Returns:
             torch.Tensor: 編集された潜在変数
         """
         x_start, y_start, x_end, y_end = target_area
         
-        edited_latent = initial_latent.clone()
+        edited_latent = initial_latent.to(self.device, self.dtype).clone()
         
         # 新しいランダムノイズを生成（すべてのチャネルに対して）
         height = y_end - y_start
         width = x_end - x_start
-        new_noise = randn_tensor((1, self.latent_shape[1], height, width), 
-                                 dtype=self.dtype, device=self.device)
+        new_noise = self._seeded_noise([seed], (1, self.latent_shape[1], max(0, height), max(0, width)))
         
-        print(f"Target area: {target_area}")
-        print(f"New noise shape: {new_noise.shape}")
-        print(f"Edited latent shape: {edited_latent.shape}")
-
         # サイズチェックと調整
         if new_noise.shape[2:] != edited_latent[:, :, y_start:y_end, x_start:x_end].shape[2:]:
-            print("Size mismatch detected. Adjusting new_noise size.")
+            logger.debug("Size mismatch detected. Adjusting new noise %s to target area %s",
+                         tuple(new_noise.shape), target_area)
             new_noise = new_noise[:, :, :y_end-y_start, :x_end-x_start]
-            print(f"Adjusted new noise shape: {new_noise.shape}")
 
         # すべてのチャネルに対して新しいノイズを適用
         edited_latent[:, :, y_start:y_end, x_start:x_end] = new_noise
@@ -151,7 +494,4 @@ class EvolutionModel:
         normalized_latent = self._normalize_latent(edited_latent)
         
         return normalized_latent
-    def _normalize_latent(self, latent):
-        """潜在変数の正規化"""
-        norm_factor = torch.sqrt(torch.tensor(float(torch.prod(torch.tensor(self.latent_shape)))))
-        return latent / torch.norm(latent) * norm_factor
+
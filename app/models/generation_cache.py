@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import torch
+from PIL import Image
+
+
+class GenerationCache:
+    """
+    生成条件のハッシュをキーとして生成済みの画像を保持するコンテンツアドレス方式のキャッシュ
+
+    キーはプロンプト、潜在変数のバイト列、解像度、ステップ数、ガイダンススケール、
+    モデル（バックエンドとデータ型）から作るので、同じ条件の生成はパイプラインを呼ばずに済む。
+    画像はメモリ予算の範囲でLRUで保持し、メモリから破棄された後も保存先のファイルから読み込める。
+    保存先のパスは、同じ画像を別のステップに保存する際のリンク元としても使う
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        GenerationCacheの初期化
+
+        Args:
+            max_bytes (int): メモリ上に保持する画像の合計バイト数の上限
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._paths = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt, latent, height, width, num_inference_steps, guidance_scale, model=""):
+        """
+        生成条件からキーを作る
+
+        Args:
+            prompt (str): テキストプロンプト
+            latent (torch.Tensor): 形状 (1, 4, H/8, W/8) の潜在変数
+            height (int): 画像の高さ
+            width (int): 画像の幅
+            num_inference_steps (int): デノイズのステップ数
+            guidance_scale (float): ガイダンススケール
+            model (str): モデルを識別する文字列
+
+        Returns:
+            str: キー（16進数のハッシュ値）
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        params = [model, prompt, height, width, num_inference_steps, guidance_scale, list(latent.shape)]
+        digest.update(json.dumps(params).encode("utf-8"))
+        digest.update(latent.detach().to("cpu", torch.float16).contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        画像を取得する（メモリになければ保存先のファイルから読み込む）
+
+        Returns:
+            PIL.Image.Image or None: 画像。キャッシュにない場合はNone
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return image
+            path = self._paths.get(key)
+
+        if path is None or not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with Image.open(path) as f:
+            image = f.convert("RGB")
+        self.put(key, image)
+        with self._lock:
+            self.hits += 1
+        return image
+
+    def put(self, key, image):
+        """画像を登録する"""
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return
+            self._images[key] = image
+            self.total_bytes += self._image_bytes(image)
+            while len(self._images) > 1 and self.total_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.total_bytes -= self._image_bytes(evicted)
+
+    def get_path(self, key):
+        """
+        画像の保存先のパスを取得する
+
+        Returns:
+            str or None: 最初に保存されたファイルのパス。記録がない場合はNone
+        """
+        with self._lock:
+            return self._paths.get(key)
+
+    def set_path(self, key, path):
+        """画像の保存先のパスを記録する（書き込みが完了してから呼ぶ。すでに記録がある場合は変更しない）"""
+        with self._lock:
+            self._paths.setdefault(key, path)
+
+    def discard_paths(self, directory):
+        """
+        指定したディレクトリに保存した画像のパスの記録を破棄する
+
+        中断されたステップのファイルは同じステップ番号の再生成で別の画像に上書きされるので、リンク元に使わない
+
+        Args:
+            directory (str): ディレクトリのパス
+        """
+        directory = os.path.normpath(directory)
+        with self._lock:
+            for key in [key for key, path in self._paths.items() if os.path.dirname(os.path.normpath(path)) == directory]:
+                del self._paths[key]
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._images.clear()
+            self._paths.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を取得"""
+        return {
+            "entries": len(self._images),
+            "paths": len(self._paths),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _image_bytes(image):
+        """画像のバイト数"""
+        return image.width * image.height * len(image.getbands())
@@ -0,0 +1,181 @@
+import bisect
+import os
+import threading
+import time
+from collections import defaultdict
+
+TRACE_ENV = "EVODIFFUSION_TRACE"
+
+# ヒストグラムの区切り（ミリ秒）
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class _NullSpan:
+    """計測が無効なときに使う何もしないスパン"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """処理時間を計測してTracerに記録するスパン"""
+
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class Tracer:
+    """
+    ホットパスの処理時間とカウンタを集計する計測レイヤー
+
+    段階ごとの処理時間（スパン）、キャッシュのヒット数や書き込みバイト数などのカウンタ、
+    GPUメモリのピークを集計し、ステップごとの要約を作る。
+    無効なときは span が共有の何もしないオブジェクトを返すので、オーバーヘッドはほぼない
+    """
+
+    def __init__(self, enabled=False):
+        """
+        Tracerの初期化
+
+        Args:
+            enabled (bool): 計測を有効にするかどうか
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._durations = defaultdict(list)
+        self._counters = defaultdict(int)
+        self._profiler = None
+
+    def span(self, name):
+        """
+        処理時間を計測するコンテキストマネージャを返す
+
+        Args:
+            name (str): 段階の名前（mutate、encode、denoise など）
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, duration_ms):
+        """処理時間を記録する"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._durations[name].append(duration_ms)
+
+    def count(self, name, value=1):
+        """カウンタを加算する"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += value
+
+    def step_summary(self, device=None):
+        """
+        前回の要約以降に集計した値の要約を作り、集計をリセットする
+
+        Args:
+            device (torch.device, optional): GPUメモリのピークを取得するデバイス
+
+        Returns:
+            dict: 段階ごとの処理時間の統計とヒストグラム、およびカウンタ
+        """
+        with self._lock:
+            durations, self._durations = self._durations, defaultdict(list)
+            counters, self._counters = self._counters, defaultdict(int)
+
+        summary = {
+            "stages": {name: self._stage_stats(values) for name, values in durations.items()},
+            "counters": dict(counters),
+        }
+        if device is not None and str(device).startswith("cuda"):
+            import torch
+
+            summary["counters"]["gpu_memory_peak_bytes"] = torch.cuda.max_memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        return summary
+
+    @staticmethod
+    def _stage_stats(values):
+        """処理時間の統計とヒストグラム"""
+        ordered = sorted(values)
+        histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        for value in ordered:
+            histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, value)] += 1
+        return {
+            "count": len(ordered),
+            "total_ms": sum(ordered),
+            "p50_ms": ordered[len(ordered) // 2],
+            "p90_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))],
+            "max_ms": ordered[-1],
+            "histogram": histogram,
+        }
+
+    def start_profiler(self):
+        """torch.profiler による詳細な計測を開始する"""
+        if self._profiler is not None:
+            return
+        # GUIの起動時にtorchを読み込まないよう、使うときにimportする
+        import torch
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.__enter__()
+
+    def stop_profiler(self, trace_path):
+        """
+        torch.profiler による計測を終了し、Chromeトレース形式で書き出す
+
+        Args:
+            trace_path (str): 書き出し先のパス
+        """
+        if self._profiler is None:
+            return
+        profiler, self._profiler = self._profiler, None
+        profiler.__exit__(None, None, None)
+        profiler.export_chrome_trace(trace_path)
+
+
+def format_step_summary(summary):
+    """
+    ステップの要約を表示用の文字列にする
+
+    Args:
+        summary (dict): Tracer.step_summary の戻り値
+
+    Returns:
+        str: 1行の要約
+    """
+    stages = ", ".join(
+        f"{name} {stats['total_ms']:.1f}ms" for name, stats in sorted(summary["stages"].items())
+    )
+    counters = ", ".join(f"{name}={value}" for name, value in sorted(summary["counters"].items()))
+    return "; ".join(part for part in (stages, counters) if part)
+
+
+tracer = Tracer(enabled=os.environ.get(TRACE_ENV) == "1")
+
+
+def get_tracer():
+    """アプリケーション全体で共有するTracerを取得"""
+    return tracer
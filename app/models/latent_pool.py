@@ -0,0 +1,316 @@
+import fcntl
+import os
+import secrets
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import torch
+
+_HEADER_FIELDS = 8
+_ALIGNMENT = 64
+
+
+class LatentHandle:
+    """
+    共有メモリ上の連続したスロットを指すハンドル
+
+    プール名と先頭スロット・スロット数だけを持つので、プロセス間で送っても数十バイトで済む
+    """
+
+    __slots__ = ("pool_name", "start", "count")
+
+    def __init__(self, pool_name, start, count):
+        self.pool_name = pool_name
+        self.start = start
+        self.count = count
+
+    def __getstate__(self):
+        return self.pool_name, self.start, self.count
+
+    def __setstate__(self, state):
+        self.pool_name, self.start, self.count = state
+
+    def __repr__(self):
+        return f"LatentHandle({self.pool_name!r}, start={self.start}, count={self.count})"
+
+
+class SharedLatentPool:
+    """
+    プロセス間で潜在変数をコピーせずに受け渡すための共有メモリのプール
+
+    固定形状のfp16のスロットを1つの共有メモリに確保し、連続したスロットの割り当てを
+    LatentHandle として渡す。ハンドルは参照しているプロセスのPIDを記録する参照カウントを持ち、
+    すべての参照が解放されるとスロットは再利用される。
+    参照したまま終了したプロセスの参照は reclaim（割り当てに失敗したときにも実行）で回収する。
+    管理領域の更新はロックファイル（fcntl.flock）でプロセス間の排他制御を行うので、POSIX専用
+    """
+
+    def __init__(self, num_slots=256, latent_shape=(4, 64, 64), max_holders=8, name=None):
+        """
+        SharedLatentPoolの初期化（共有メモリを作成する）
+
+        Args:
+            num_slots (int): スロットの数
+            latent_shape (tuple): 1スロットの潜在変数の形状 (C, H, W)
+            max_holders (int): 1つの割り当てを同時に参照できるプロセスの数の上限
+            name (str, optional): 共有メモリの名前。省略時は自動で決める
+        """
+        name = name or f"evodiffusion_{os.getpid()}_{secrets.token_hex(4)}"
+        layout = self._layout(num_slots, latent_shape, max_holders)
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=layout["size"])
+        self._owner = True
+        self._map(layout, num_slots, latent_shape, max_holders)
+        self._header[:4] = (num_slots, max_holders, len(latent_shape), 0)
+        self._header[4:4 + len(latent_shape)] = latent_shape
+        self._starts[:] = -1
+        self._holders[:] = 0
+        self._open_lock_file(create=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        他のプロセスが作成したプールに接続する
+
+        Args:
+            name (str): 共有メモリの名前
+
+        Returns:
+            SharedLatentPool: 接続したプール
+        """
+        pool = cls.__new__(cls)
+        pool._shm = _attach_shared_memory(name)
+        pool._owner = False
+        header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=pool._shm.buf)
+        num_slots, max_holders, ndim = (int(value) for value in header[:3])
+        latent_shape = tuple(int(value) for value in header[4:4 + ndim])
+        del header
+        pool._map(cls._layout(num_slots, latent_shape, max_holders), num_slots, latent_shape, max_holders)
+        pool._open_lock_file(create=False)
+        return pool
+
+    @staticmethod
+    def _layout(num_slots, latent_shape, max_holders):
+        """共有メモリ内の各領域のオフセット"""
+        def align(offset):
+            return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+        starts = align(_HEADER_FIELDS * 8)
+        holders = align(starts + num_slots * 4)
+        data = align(holders + num_slots * max_holders * 4)
+        size = data + num_slots * int(np.prod(latent_shape)) * 2
+        return {"starts": starts, "holders": holders, "data": data, "size": size}
+
+    def _map(self, layout, num_slots, latent_shape, max_holders):
+        """共有メモリの各領域をnumpy配列として参照する"""
+        buf = self._shm.buf
+        self.num_slots = num_slots
+        self.latent_shape = tuple(latent_shape)
+        self.max_holders = max_holders
+        self._header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+        # 各スロットを含む割り当ての先頭スロット（空きは-1）
+        self._starts = np.ndarray((num_slots,), dtype=np.int32, buffer=buf, offset=layout["starts"])
+        # 割り当ての先頭スロットごとの参照しているプロセスのPID（空きは0）
+        self._holders = np.ndarray((num_slots, max_holders), dtype=np.int32, buffer=buf, offset=layout["holders"])
+        self._data = np.ndarray((num_slots,) + self.latent_shape, dtype=np.float16, buffer=buf, offset=layout["data"])
+        self._thread_lock = threading.Lock()
+
+    def _open_lock_file(self, create):
+        """プロセス間の排他制御に使うロックファイルを開く"""
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{self.name}.lock")
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        self._lock_fd = os.open(self._lock_path, flags, 0o600)
+
+    @property
+    def name(self):
+        """共有メモリの名前（他のプロセスは attach にこの名前を渡す）"""
+        return self._shm.name
+
+    @contextmanager
+    def _locked(self):
+        """スレッド間とプロセス間の排他制御"""
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def allocate(self, count):
+        """
+        連続したスロットを割り当てる（呼び出したプロセスが参照を1つ持つ）
+
+        Args:
+            count (int): スロットの数
+
+        Returns:
+            LatentHandle: 割り当てたスロットのハンドル
+
+        Raises:
+            MemoryError: 連続した空きスロットがない場合
+        """
+        with self._locked():
+            start = self._find_free_run(count)
+            if start is None:
+                self._reclaim_locked()
+                start = self._find_free_run(count)
+            if start is None:
+                raise MemoryError(f"No {count} contiguous free slots in latent pool {self.name}.")
+            self._starts[start:start + count] = start
+            self._holders[start] = 0
+            self._holders[start, 0] = os.getpid()
+        return LatentHandle(self.name, start, count)
+
+    def put(self, latents):
+        """
+        潜在変数をスロットに書き込み、そのハンドルを返す
+
+        Args:
+            latents (torch.Tensor): 形状 (N, C, H, W) の潜在変数
+
+        Returns:
+            LatentHandle: 書き込んだスロットのハンドル
+        """
+        handle = self.allocate(latents.shape[0])
+        self.write(handle, latents)
+        return handle
+
+    def write(self, handle, latents):
+        """潜在変数をハンドルのスロットに書き込む"""
+        self.view(handle).copy_(latents.detach().to("cpu", torch.float16).reshape((handle.count,) + self.latent_shape))
+
+    def view(self, handle):
+        """
+        ハンドルのスロットを参照するテンソルを返す（コピーしない）
+
+        テンソルは共有メモリを直接参照するので、ハンドルを解放した後は使わないこと
+
+        Returns:
+            torch.Tensor: 形状 (N, C, H, W) のfp16のテンソル
+        """
+        self._check_handle(handle)
+        return torch.from_numpy(self._data[handle.start:handle.start + handle.count])
+
+    def retain(self, handle):
+        """ハンドルの参照を1つ追加する（呼び出したプロセスが参照を持つ）"""
+        with self._locked():
+            self._check_handle(handle)
+            row = self._holders[handle.start]
+            free = np.flatnonzero(row == 0)
+            if free.size == 0:
+                raise RuntimeError(f"Too many references to {handle}.")
+            row[free[0]] = os.getpid()
+
+    def release(self, handle):
+        """
+        呼び出したプロセスが持つハンドルの参照を1つ解放する
+
+        参照がなくなったスロットは再利用される
+        """
+        with self._locked():
+            self._check_handle(handle)
+            row = self._holders[handle.start]
+            held = np.flatnonzero(row == os.getpid())
+            if held.size == 0:
+                raise ValueError(f"{handle} is not held by this process.")
+            row[held[0]] = 0
+            if not row.any():
+                self._free(handle.start)
+
+    def refcount(self, handle):
+        """ハンドルの参照の数"""
+        return int(np.count_nonzero(self._holders[handle.start]))
+
+    def free_slots(self):
+        """空いているスロットの数"""
+        return int(np.count_nonzero(self._starts == -1))
+
+    def reclaim(self):
+        """
+        終了したプロセスが持っていた参照を回収する
+
+        Returns:
+            int: 回収した参照の数
+        """
+        with self._locked():
+            return self._reclaim_locked()
+
+    def _reclaim_locked(self):
+        """終了したプロセスの参照を回収する（ロックを取得した状態で呼ぶ）"""
+        reclaimed = 0
+        alive = {}
+        for start in np.flatnonzero(self._holders.any(axis=1)):
+            row = self._holders[start]
+            for position in np.flatnonzero(row):
+                pid = int(row[position])
+                if pid not in alive:
+                    alive[pid] = _process_alive(pid)
+                if not alive[pid]:
+                    row[position] = 0
+                    reclaimed += 1
+            if not row.any():
+                self._free(int(start))
+        return reclaimed
+
+    def _find_free_run(self, count):
+        """count 個の連続した空きスロットの先頭を探す（見つからなければNone）"""
+        free = np.flatnonzero(self._starts == -1)
+        if free.size < count:
+            return None
+        # 空きスロットの番号は昇順なので、count 個先との差が count - 1 なら連続している
+        runs = np.flatnonzero(free[count - 1:] - free[:free.size - count + 1] == count - 1)
+        return int(free[runs[0]]) if runs.size else None
+
+    def _free(self, start):
+        """割り当てを解放する"""
+        self._starts[self._starts == start] = -1
+
+    def _check_handle(self, handle):
+        """ハンドルがこのプールの有効な割り当てを指しているか確認する"""
+        if handle.pool_name != self.name:
+            raise ValueError(f"{handle} does not belong to latent pool {self.name}.")
+        if self._starts[handle.start] != handle.start:
+            raise ValueError(f"{handle} has already been released.")
+
+    def close(self):
+        """共有メモリから切断する（作成したプロセスでは共有メモリとロックファイルを削除する）"""
+        if self._shm is None:
+            return
+        del self._header, self._starts, self._holders, self._data
+        os.close(self._lock_fd)
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # view で返したテンソルがまだ参照している
+        if self._owner:
+            self._shm.unlink()
+            if os.path.exists(self._lock_path):
+                os.remove(self._lock_path)
+        self._shm = None
+
+
+def _attach_shared_memory(name):
+    """
+    既存の共有メモリに接続する
+
+    接続しただけのプロセスが終了したときに共有メモリが削除されないよう、
+    resource_tracker の管理対象から外す
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _process_alive(pid):
+    """プロセスが存在するかどうか"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
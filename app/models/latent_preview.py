@@ -0,0 +1,47 @@
+import torch
+
+# SDXLの潜在変数の4チャネルからRGBへの線形近似（VAEデコードの結果に最小二乗で合わせた係数）
+SDXL_LATENT_RGB_FACTORS = (
+    (0.3651, 0.4232, 0.4341),
+    (-0.2533, -0.0042, 0.1068),
+    (0.1076, 0.1111, -0.0362),
+    (-0.3165, -0.2492, -0.2188),
+)
+SDXL_LATENT_RGB_BIAS = (0.1084, -0.0175, -0.0011)
+
+
+class LatentPreviewer:
+    """
+    潜在変数からVAEを使わずに低解像度のプレビュー画像を作るクラス
+
+    各画素の4チャネルを線形変換でRGBに近似するだけなので、VAEデコードよりはるかに速い。
+    プレビューの解像度は潜在変数と同じ（512×512の画像なら64×64）
+    """
+
+    def __init__(self, factors=SDXL_LATENT_RGB_FACTORS, bias=SDXL_LATENT_RGB_BIAS):
+        """
+        LatentPreviewerの初期化
+
+        Args:
+            factors (tuple): 形状 (4, 3) の潜在変数のチャネルからRGBへの係数
+            bias (tuple): RGBごとのバイアス
+        """
+        self.factors = torch.tensor(factors, dtype=torch.float32)
+        self.bias = torch.tensor(bias, dtype=torch.float32)
+
+    def preview(self, latents):
+        """
+        潜在変数をプレビュー画像にする
+
+        Args:
+            latents (torch.Tensor): 形状 (N, 4, H/8, W/8) の潜在変数
+
+        Returns:
+            numpy.ndarray: 形状 (N, H/8, W/8, 3) のuint8配列
+        """
+        factors = self.factors.to(latents.device)
+        bias = self.bias.to(latents.device)
+        with torch.no_grad():
+            rgb = torch.einsum("nchw,cr->nhwr", latents.float(), factors) + bias
+            rgb = ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8)
+        return rgb.cpu().numpy()
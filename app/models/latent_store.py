@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import numpy as np
+import torch
+
+
+class LatentStore:
+    """
+    セッションの潜在変数をメモリマップされた1つのfp16配列にまとめて保存するストア
+
+    潜在変数は追記専用の行として ``latents.f16`` に書き込まれ、
+    各行の (ステップ, 個体のインデックス) は ``latents_index.i32`` に記録される。
+    読み込みはメモリマップ上のゼロコピーなテンソルとして返すので、
+    個体ごとのpickleファイルを開く必要はない
+    """
+
+    DATA_FILE = "latents.f16"
+    INDEX_FILE = "latents_index.i32"
+    META_FILE = "latents_meta.json"
+
+    def __init__(self, directory, latent_shape=(4, 64, 64), initial_capacity=64):
+        """
+        LatentStoreの初期化（既存のストアがあれば開く）
+
+        Args:
+            directory (str): ストアを置くディレクトリ
+            latent_shape (tuple): バッチ次元を除いた潜在変数の形状 (C, H, W)
+            initial_capacity (int): 新規作成時に確保する行数
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, self.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.latent_shape = tuple(meta["latent_shape"])
+            self.capacity = meta["capacity"]
+            self._open_maps()
+            self._load_index()
+        else:
+            self.latent_shape = tuple(latent_shape)
+            self.capacity = 0
+            self._grow(initial_capacity)
+            self.count = 0
+            self._rows = {}
+
+    @property
+    def row_size(self):
+        """1行あたりの要素数"""
+        return int(np.prod(self.latent_shape))
+
+    def append(self, step, index, latent):
+        """
+        潜在変数を追記する
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+            latent (torch.Tensor): 潜在変数（形状は (1, C, H, W) または (C, H, W)）
+
+        Returns:
+            int: 書き込んだ行番号
+        """
+        values = latent.detach().reshape(self.latent_shape).to("cpu", torch.float16).numpy()
+        with self._lock:
+            if self.count == self.capacity:
+                self._grow(self.capacity * 2)
+            row = self.count
+            self._data[row] = values
+            self._index[row] = (step, index)
+            self._rows[(step, index)] = row
+            self.count += 1
+        return row
+
+    def get(self, step, index):
+        """
+        潜在変数を読み込む（メモリマップ上のゼロコピーなビュー）
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+
+        Returns:
+            torch.Tensor or None: 形状 (1, C, H, W) の潜在変数。記録がない場合はNone
+        """
+        with self._lock:
+            row = self._rows.get((step, index))
+            if row is None:
+                return None
+            return torch.from_numpy(self._data[row:row + 1])
+
+    def row(self, step, index):
+        """
+        潜在変数の行番号を取得
+
+        Returns:
+            int or None: 最後に書き込んだ行の番号。記録がない場合はNone
+        """
+        with self._lock:
+            return self._rows.get((step, index))
+
+    def get_steps(self, start_step, end_step):
+        """
+        指定範囲のステップの潜在変数をまとめて読み込む
+
+        行が連続している場合はゼロコピーなビューを返す
+
+        Args:
+            start_step (int): 最初のステップ（含む）
+            end_step (int): 最後のステップ（含む）
+
+        Returns:
+            tuple: ((ステップ, インデックス) のリスト, 形状 (N, C, H, W) のテンソル)
+        """
+        with self._lock:
+            keys = sorted(key for key in self._rows if start_step <= key[0] <= end_step)
+            rows = np.array([self._rows[key] for key in keys], dtype=np.int64)
+            if len(rows) > 0 and np.all(np.diff(rows) == 1):
+                values = self._data[rows[0]:rows[-1] + 1]
+            else:
+                values = self._data[rows]
+            return keys, torch.from_numpy(values)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def flush(self):
+        """メモリマップの内容をディスクに書き出す"""
+        with self._lock:
+            self._data.flush()
+            self._index.flush()
+
+    def _grow(self, capacity):
+        """確保する行数を増やしてメモリマップを開き直す"""
+        capacity = max(1, capacity)
+        if self.capacity > 0:
+            self._data.flush()
+            self._index.flush()
+
+        data_path = os.path.join(self.directory, self.DATA_FILE)
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        self._resize_file(data_path, capacity * self.row_size * 2)
+        self._resize_file(index_path, capacity * 2 * 4, fill=b"\xff")
+        self.capacity = capacity
+        self._write_meta()
+        self._open_maps()
+
+    def _open_maps(self):
+        """データと索引のメモリマップを開く"""
+        self._data = np.memmap(
+            os.path.join(self.directory, self.DATA_FILE), dtype=np.float16, mode="r+",
+            shape=(self.capacity,) + self.latent_shape
+        )
+        self._index = np.memmap(
+            os.path.join(self.directory, self.INDEX_FILE), dtype=np.int32, mode="r+",
+            shape=(self.capacity, 2)
+        )
+
+    def _load_index(self):
+        """索引から (ステップ, インデックス) → 行 の対応を復元する"""
+        written = np.nonzero(self._index[:, 0] < 0)[0]
+        self.count = int(written[0]) if len(written) > 0 else self.capacity
+        self._rows = {
+            (int(step), int(index)): row
+            for row, (step, index) in enumerate(self._index[:self.count])
+        }
+
+    def _write_meta(self):
+        """形状と確保行数をメタデータに書き込む"""
+        with open(os.path.join(self.directory, self.META_FILE), "w") as f:
+            json.dump({"latent_shape": list(self.latent_shape), "capacity": self.capacity, "dtype": "float16"}, f)
+
+    @staticmethod
+    def _resize_file(path, size, fill=b"\x00"):
+        """ファイルを指定サイズまで拡張する（追加部分はfillで埋める）"""
+        current = os.path.getsize(path) if os.path.exists(path) else 0
+        if current >= size:
+            return
+        with open(path, "ab") as f:
+            remaining = size - current
+            chunk = fill * min(remaining, 1024 * 1024)
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from app.models.evolution import EvolutionModel
+from app.models.user_log import recover_tail
+
+LINEAGE_FILE = "lineage.jsonl"
+
+
+def is_replayable(record):
+    """
+    系譜のレコードから個体を再現できるか（親がすべて (ステップ, インデックス) で記録されているか）
+
+    Args:
+        record (dict or None): EvolutionModel.lineage のレコード
+
+    Returns:
+        bool: 再現できる場合はTrue
+    """
+    if record is None or record.get("operator") not in EvolutionModel.REPLAYABLE_OPERATORS:
+        return False
+    parents = record.get("parents") or []
+    return len(parents) > 0 and all(isinstance(parent, (list, tuple)) and len(parent) == 2 for parent in parents)
+
+
+class LineageStore:
+    """
+    セッションの個体の系譜のレコードを1行1レコードで追記するストア
+
+    チェックポイントとして潜在変数を保存しなかった個体は、親の (ステップ, インデックス)、
+    操作、シード、ノイズの大きさ、クロップ領域だけを ``lineage.jsonl`` に記録する。
+    同じ個体のレコードが複数ある場合は最後のものが有効になる。
+    1レコードは100バイト程度なので、潜在変数（32KB）を保存するより数百倍小さい
+    """
+
+    def __init__(self, directory):
+        """
+        LineageStoreの初期化（既存のレコードがあれば読み込む）
+
+        Args:
+            directory (str): セッションのディレクトリ
+        """
+        self.path = os.path.join(directory, LINEAGE_FILE)
+        self._lock = threading.Lock()
+        self._records = {}
+        recover_tail(self.path)
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[(record["step"], record["index"])] = record
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, step, index, record):
+        """
+        個体の系譜のレコードを追記する
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+            record (dict): EvolutionModel.lineage のレコード
+        """
+        record = dict(record, step=step, index=index)
+        with self._lock:
+            self._records[(step, index)] = record
+            self._file.write(json.dumps(record) + "\n")
+
+    def get(self, step, index):
+        """
+        個体の系譜のレコードを取得
+
+        Returns:
+            dict or None: レコード。記録がない場合はNone
+        """
+        with self._lock:
+            return self._records.get((step, index))
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def flush(self):
+        """追記したレコードを書き出す"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def sync(self):
+        """追記したレコードを書き出してfsyncする（クラッシュしても失われないようにする）"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        """レコードを書き出してファイルを閉じる"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class LatentResolver:
+    """
+    チェックポイントと系譜のレコードから個体の潜在変数を復元するリゾルバ
+
+    潜在変数ストアにない個体は、系譜のレコードを親へたどって最も近いチェックポイントを見つけ、
+    そこからレコードを順に適用して復元する。復元した潜在変数はLRUでキャッシュするので、
+    同じ祖先を持つ個体の復元では途中の計算を繰り返さない
+    """
+
+    def __init__(self, latent_store, lineage_store, evolution_model, max_entries=64):
+        """
+        LatentResolverの初期化
+
+        Args:
+            latent_store (LatentStore): チェックポイントの潜在変数のストア
+            lineage_store (LineageStore): 系譜のレコードのストア
+            evolution_model (EvolutionModel): レコードの適用に使うモデル（デバイスとデータ型を決める）
+            max_entries (int): キャッシュする潜在変数の最大数
+        """
+        self.latent_store = latent_store
+        self.lineage_store = lineage_store
+        self.evolution_model = evolution_model
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.replayed = 0
+
+    def resolve(self, step, index):
+        """
+        個体の潜在変数を復元する
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+
+        Returns:
+            torch.Tensor or None: 形状 (1, C, H, W) の潜在変数。チェックポイントにも
+                系譜のレコードにもたどり着けない場合はNone
+        """
+        with self._lock:
+            resolved = {}
+            # 親を先に復元するため、深さ優先でたどってから帰りがけにレコードを適用する
+            stack = [((step, index), False)]
+            while stack:
+                key, expanded = stack.pop()
+                if key in resolved:
+                    continue
+                latent = self._lookup(key)
+                if latent is not None:
+                    resolved[key] = latent
+                    continue
+                record = self.lineage_store.get(*key)
+                if record is None:
+                    return None
+                parents = [tuple(parent) for parent in record["parents"]]
+                if expanded:
+                    latent = self.evolution_model.apply_record(record, [resolved[parent] for parent in parents])
+                    self.replayed += 1
+                    resolved[key] = latent
+                    self._remember(key, latent)
+                    continue
+                stack.append((key, True))
+                stack.extend((parent, False) for parent in parents if parent not in resolved)
+            return resolved[(step, index)]
+
+    def checkpoint(self, step, index):
+        """
+        個体のチェックポイントの潜在変数を取得
+
+        中断されたステップと同じ番号で再生成すると、同じ個体にチェックポイントとレコードの両方が残りうる。
+        レコードの ``latent_rows``（追記したときの潜在変数ストアの行数）より前の行は古いので使わず、
+        後から書き込んだ方を採用する
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+
+        Returns:
+            torch.Tensor or None: 形状 (1, C, H, W) の潜在変数。チェックポイントがないか、
+                後から追記したレコードがある場合はNone
+        """
+        row = self.latent_store.row(step, index)
+        if row is None:
+            return None
+        record = self.lineage_store.get(step, index)
+        if record is not None and row < record.get("latent_rows", 0):
+            return None
+        return self.latent_store.get(step, index)
+
+    def _lookup(self, key):
+        """キャッシュかチェックポイントから潜在変数を探す"""
+        latent = self._cache.get(key)
+        if latent is not None:
+            self._cache.move_to_end(key)
+            return latent
+        return self.checkpoint(*key)
+
+    def _remember(self, key, latent):
+        """復元した潜在変数をキャッシュに登録する"""
+        self._cache[key] = latent
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,216 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MEMORY_BUDGET_ENV = "EVODIFFUSION_MEMORY_BUDGET"
+_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+# SDXLのUNetとVAEの構成（活性のメモリ量の見積もりに使う）
+UNET_ATTENTION_HEADS = 10  # 最も解像度の高いTransformerブロック（640チャネル、ヘッドあたり64）
+UNET_CHANNELS = 320
+VAE_DECODER_CHANNELS = 128
+VAE_TILE_SIZE = 512
+
+
+def parse_bytes(value):
+    """
+    メモリ量の指定をバイト数にする
+
+    Args:
+        value (int or str): バイト数、または "8G"、"512M" のような単位付きの文字列
+
+    Returns:
+        int or None: バイト数。値がない場合はNone
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = value.strip().upper().rstrip("B").rstrip("I")
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(float(text))
+
+
+def resolve_memory_budget(value=None):
+    """
+    メモリ予算を取得
+
+    Args:
+        value (int or str, optional): メモリ予算。省略時は環境変数 EVODIFFUSION_MEMORY_BUDGET
+
+    Returns:
+        int or None: バイト数。指定がない場合はNone
+    """
+    return parse_bytes(value if value is not None else os.environ.get(MEMORY_BUDGET_ENV))
+
+
+def module_bytes(module):
+    """モジュールの重みとバッファのバイト数"""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def estimate_unet_bytes(height, width, batch_size, dtype_bytes=2, attention_slicing=False):
+    """
+    UNetの1回の呼び出しの活性のピークのバイト数を見積もる
+
+    最も解像度の高いTransformerブロックの注意の重み（トークン数の2乗）と、
+    スキップ接続として保持される特徴マップを合計する。注意のスライスではヘッドを1つずつ計算する
+    """
+    latent_pixels = (height // 8) * (width // 8)
+    tokens = latent_pixels // 4
+    heads = 1 if attention_slicing else UNET_ATTENTION_HEADS
+    attention = batch_size * heads * tokens * tokens * dtype_bytes
+    features = batch_size * UNET_CHANNELS * latent_pixels * dtype_bytes * 10
+    return attention + features
+
+
+def estimate_vae_bytes(height, width, batch_size, dtype_bytes=4, slicing=False, tiling=False):
+    """
+    VAEデコードの活性のピークのバイト数を見積もる
+
+    中間ブロックの注意の重み（潜在変数の画素数の2乗）と、出力解像度の特徴マップを合計する。
+    スライスでは1枚ずつ、タイルでは VAE_TILE_SIZE 四方ずつデコードする
+    """
+    if tiling:
+        height, width = min(height, VAE_TILE_SIZE), min(width, VAE_TILE_SIZE)
+    if slicing:
+        batch_size = 1
+    latent_pixels = (height // 8) * (width // 8)
+    attention = latent_pixels * latent_pixels * dtype_bytes
+    features = VAE_DECODER_CHANNELS * height * width * dtype_bytes * 3
+    return batch_size * (attention + features)
+
+
+class MemoryPlan:
+    """
+    メモリ予算に収まるように選んだ省メモリ設定
+
+    VAEのスライス、VAEのタイル、注意のスライス、モデルのCPUオフロードの順に、
+    速度への影響が小さいものから予算に収まるまで有効にする
+    """
+
+    OPTIONS = ("vae_slicing", "vae_tiling", "attention_slicing", "cpu_offload")
+
+    def __init__(self, vae_slicing=False, vae_tiling=False, attention_slicing=False, cpu_offload=False,
+                 estimated_bytes=None, budget=None):
+        """
+        MemoryPlanの初期化
+
+        Args:
+            vae_slicing (bool): VAEで1枚ずつデコードするかどうか
+            vae_tiling (bool): VAEでタイルに分けてデコードするかどうか
+            attention_slicing (bool): UNetの注意をヘッドごとに計算するかどうか
+            cpu_offload (bool): 使っていないモデルをCPUに退避するかどうか
+            estimated_bytes (int, optional): 見積もったピークのバイト数
+            budget (int, optional): メモリ予算（バイト）
+        """
+        self.vae_slicing = vae_slicing
+        self.vae_tiling = vae_tiling
+        self.attention_slicing = attention_slicing
+        self.cpu_offload = cpu_offload
+        self.estimated_bytes = estimated_bytes
+        self.budget = budget
+
+    @classmethod
+    def for_budget(cls, budget, weight_bytes, largest_module_bytes, height, width, batch_size,
+                   dtype_bytes=2, vae_dtype_bytes=4, allow_offload=True):
+        """
+        メモリ予算に収まる設定を選ぶ
+
+        Args:
+            budget (int or None): メモリ予算（バイト）。Noneの場合は何も有効にしない
+            weight_bytes (int): パイプライン全体の重みのバイト数
+            largest_module_bytes (int): 最も大きいモデル（UNet）の重みのバイト数
+            height (int): 画像の高さ
+            width (int): 画像の幅
+            batch_size (int): 1回のパイプライン呼び出しで生成する最大画像数
+            dtype_bytes (int): UNetの活性の1要素のバイト数
+            vae_dtype_bytes (int): VAEの活性の1要素のバイト数
+            allow_offload (bool): CPUオフロードを使えるかどうか
+
+        Returns:
+            MemoryPlan: 選んだ設定（すべて有効にしても収まらない場合は、すべて有効にした設定）
+        """
+        plan = cls(budget=budget)
+        options = [option for option in cls.OPTIONS if allow_offload or option != "cpu_offload"]
+        if batch_size <= 1:
+            options.remove("vae_slicing")  # 1枚ずつのデコードと変わらない
+
+        def estimate():
+            weights = largest_module_bytes if plan.cpu_offload else weight_bytes
+            unet = estimate_unet_bytes(height, width, batch_size, dtype_bytes, plan.attention_slicing)
+            vae = estimate_vae_bytes(height, width, batch_size, vae_dtype_bytes, plan.vae_slicing, plan.vae_tiling)
+            # UNetとVAEは順に動くので、活性のピークは大きい方になる
+            return weights + max(unet, vae)
+
+        plan.estimated_bytes = estimate()
+        if budget is None:
+            return plan
+        for option in options:
+            if plan.estimated_bytes <= budget:
+                break
+            setattr(plan, option, True)
+            plan.estimated_bytes = estimate()
+        if plan.estimated_bytes > budget:
+            logger.warning(
+                "Estimated peak memory %.1f GiB exceeds the budget of %.1f GiB at %dx%d",
+                plan.estimated_bytes / 1024 ** 3, budget / 1024 ** 3, width, height
+            )
+        return plan
+
+    def enabled_options(self):
+        """有効にした設定の名前のリスト"""
+        return [option for option in self.OPTIONS if getattr(self, option)]
+
+    def describe(self):
+        """設定の要約"""
+        options = ", ".join(self.enabled_options()) or "none"
+        estimate = f"{self.estimated_bytes / 1024 ** 3:.1f} GiB" if self.estimated_bytes is not None else "unknown"
+        budget = f"{self.budget / 1024 ** 3:.1f} GiB" if self.budget is not None else "unlimited"
+        return f"memory plan: {options} (estimated peak {estimate}, budget {budget})"
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryPlan) and self.enabled_options() == other.enabled_options()
+
+    def __repr__(self):
+        return f"MemoryPlan({', '.join(self.enabled_options())})"
+
+
+def apply_memory_plan(pipe, plan, device, previous=None):
+    """
+    diffusersのパイプラインに省メモリ設定を適用する
+
+    Args:
+        pipe: diffusersのパイプライン
+        plan (MemoryPlan): 適用する設定
+        device (torch.device): パイプラインを配置するデバイス
+        previous (MemoryPlan, optional): 現在適用されている設定（変更のない設定は呼び出さない）
+    """
+    previous = previous or MemoryPlan()
+
+    if plan.vae_slicing != previous.vae_slicing:
+        (pipe.enable_vae_slicing if plan.vae_slicing else pipe.disable_vae_slicing)()
+    if plan.vae_tiling != previous.vae_tiling:
+        if plan.vae_tiling:
+            pipe.enable_vae_tiling()
+            # SDXLのVAEの既定のタイル（1024）では1024×1024の画像が分割されないので小さくする
+            vae = pipe.vae
+            if hasattr(vae, "tile_sample_min_size"):
+                vae.tile_sample_min_size = VAE_TILE_SIZE
+                vae.tile_latent_min_size = VAE_TILE_SIZE // 8
+        else:
+            pipe.disable_vae_tiling()
+    if plan.attention_slicing != previous.attention_slicing:
+        if plan.attention_slicing:
+            pipe.enable_attention_slicing("max")
+        else:
+            pipe.disable_attention_slicing()
+    if plan.cpu_offload != previous.cpu_offload:
+        if plan.cpu_offload:
+            pipe.enable_model_cpu_offload(device=device)
+        else:
+            pipe.remove_all_hooks()
+            pipe.to(device)
@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+import torch
+from app.models.instrumentation import get_tracer
+
+
+class ImageEncoding:
+    """
+    生成画像をディスクに保存する際のエンコード設定
+
+    PNG（圧縮レベル指定可）、WebP、または保存しない（"none"）を選択できる
+    """
+
+    FORMATS = ("png", "webp", "none")
+
+    def __init__(self, format="png", png_compress_level=6, webp_quality=90, webp_lossless=False):
+        """
+        ImageEncodingの初期化
+
+        Args:
+            format (str): "png"、"webp"、"none" のいずれか
+            png_compress_level (int): PNGのzlib圧縮レベル（0〜9）
+            webp_quality (int): WebPの品質（0〜100）
+            webp_lossless (bool): WebPを可逆圧縮で保存するかどうか
+        """
+        if format not in self.FORMATS:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.format = format
+        self.png_compress_level = png_compress_level
+        self.webp_quality = webp_quality
+        self.webp_lossless = webp_lossless
+
+    @property
+    def enabled(self):
+        """画像をディスクに保存するかどうか"""
+        return self.format != "none"
+
+    @property
+    def extension(self):
+        """保存する画像ファイルの拡張子"""
+        return self.format
+
+    def save(self, image, path):
+        """
+        画像を設定に従って保存する
+
+        Args:
+            image (PIL.Image.Image): 保存する画像
+            path (str): 保存先のパス
+        """
+        if self.format == "png":
+            image.save(path, format="PNG", compress_level=self.png_compress_level)
+        elif self.format == "webp":
+            image.save(path, format="WEBP", quality=self.webp_quality, lossless=self.webp_lossless)
+
+
+class AsyncWriter:
+    """
+    ファイル書き込みをバックグラウンドで行うライトビハインド方式のライター
+
+    書き込みジョブは上限付きのキューに積まれ、ライタースレッドのプールが順次処理する。
+    キューが一杯のときは submit が空きを待つ（バックプレッシャー）。
+    ファイルは一時ファイルに書き込んでから置き換えるので、途中まで書かれたファイルは見えない
+    """
+
+    def __init__(self, num_workers=2, max_pending=16, on_error=None):
+        """
+        AsyncWriterの初期化
+
+        Args:
+            num_workers (int): ライタースレッドの数
+            max_pending (int): キューに積める書き込みジョブの最大数
+            on_error (callable, optional): 書き込みに失敗したとき (path, exception) で呼ばれる
+        """
+        self.on_error = on_error
+        self.errors = []
+        self._errors_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker_loop, name=f"AsyncWriter-{i}", daemon=True)
+            for i in range(max(1, num_workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, path, write_func, on_done=None):
+        """
+        書き込みジョブを登録する
+
+        Args:
+            path (str): 書き込み先のパス
+            write_func (callable): 一時ファイルのパスを受け取って書き込む関数
+            on_done (callable, optional): 書き込みが成功し、ファイルを置き換えた後に引数なしで呼ばれる
+        """
+        if self._closed:
+            raise RuntimeError("AsyncWriter is closed.")
+        self._queue.put((path, write_func, on_done))
+
+    def save_image(self, image, path, encoding, on_done=None):
+        """画像の書き込みジョブを登録する（on_done は書き込みが成功したときに呼ばれる）"""
+        if encoding.enabled:
+            self.submit(path, lambda tmp_path: encoding.save(image, tmp_path), on_done)
+
+    def link_image(self, source, image, path, encoding):
+        """
+        保存済みの同じ画像へのハードリンクの作成を登録する
+
+        リンク元がまだ書き込まれていない場合や、リンクできないファイルシステムでは画像を書き込む
+
+        Args:
+            source (str): 同じ内容の保存済みの画像のパス
+            image (PIL.Image.Image): リンクできない場合に書き込む画像
+            path (str): 保存先のパス
+            encoding (ImageEncoding): 画像の保存形式
+        """
+        if encoding.enabled:
+            self.submit(path, lambda tmp_path: self._link_or_save(source, tmp_path, image, encoding))
+
+    @staticmethod
+    def _link_or_save(source, tmp_path, image, encoding):
+        """ハードリンクを作成し、失敗した場合は画像を書き込む"""
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            encoding.save(image, tmp_path)
+
+    def save_tensor(self, tensor, path):
+        """テンソルの書き込みジョブを登録する"""
+        self.submit(path, lambda tmp_path: torch.save(tensor, tmp_path))
+
+    def flush(self):
+        """登録済みのすべての書き込みジョブが終わるまで待つ"""
+        self._queue.join()
+
+    def close(self):
+        """書き込みを完了させ、ライタースレッドを終了する"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def pop_errors(self):
+        """発生した書き込みエラーを取り出す"""
+        with self._errors_lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def _worker_loop(self):
+        """キューから書き込みジョブを取り出して処理する"""
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, write_func, on_done=None):
+        """一時ファイルに書き込み、完了後に置き換える"""
+        tmp_path = f"{path}.tmp"
+        tracer = get_tracer()
+        try:
+            with tracer.span("write"):
+                write_func(tmp_path)
+            if tracer.enabled:
+                stat = os.stat(tmp_path)
+                # ハードリンクは新たに書き込んでいないので数えない
+                tracer.count("bytes_written" if stat.st_nlink == 1 else "bytes_linked", stat.st_size)
+            os.replace(tmp_path, path)
+            if on_done is not None:
+                on_done()
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._errors_lock:
+                self.errors.append((path, e))
+            if self.on_error is not None:
+                self.on_error(path, e)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+class PromptEmbeddingCache:
+    """
+    プロンプトのテキスト埋め込みを保持するLRUキャッシュ
+
+    プロンプトごとにトークン単位の埋め込みとプーリング済み埋め込みを保持する。
+    エントリ数またはバイト数の上限を超えた場合、最も古く使われたものから破棄する
+    """
+
+    def __init__(self, max_entries=16, max_bytes=None):
+        """
+        PromptEmbeddingCacheの初期化
+
+        Args:
+            max_entries (int, optional): 保持する最大エントリ数
+            max_bytes (int, optional): 保持する埋め込みの合計バイト数の上限
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prompt):
+        """
+        プロンプトに対応する埋め込みを取得する
+
+        Args:
+            prompt (str): テキストプロンプト
+
+        Returns:
+            tuple or None: (prompt_embeds, pooled_prompt_embeds)。未登録の場合はNone
+        """
+        entry = self._entries.get(prompt)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(prompt)
+        self.hits += 1
+        return entry
+
+    def put(self, prompt, prompt_embeds, pooled_prompt_embeds):
+        """
+        プロンプトの埋め込みを登録する
+
+        Args:
+            prompt (str): テキストプロンプト
+            prompt_embeds (torch.Tensor): トークン単位の埋め込み
+            pooled_prompt_embeds (torch.Tensor): プーリング済みの埋め込み
+        """
+        if prompt in self._entries:
+            self._remove(prompt)
+        self._entries[prompt] = (prompt_embeds, pooled_prompt_embeds)
+        self.total_bytes += self._entry_bytes(self._entries[prompt])
+        self._evict()
+
+    def clear(self):
+        """キャッシュを空にする"""
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を取得"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, prompt):
+        return prompt in self._entries
+
+    def _evict(self):
+        """上限を超えている間、最も古いエントリを破棄"""
+        while self._entries and self._over_limit():
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _over_limit(self):
+        """上限を超えているかどうか"""
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        # 1件だけの場合はバイト上限を超えていても保持する
+        if self.max_bytes is not None and len(self._entries) > 1:
+            return self.total_bytes > self.max_bytes
+        return False
+
+    def _remove(self, prompt):
+        """エントリを削除"""
+        entry = self._entries.pop(prompt)
+        self.total_bytes -= self._entry_bytes(entry)
+
+    @staticmethod
+    def _entry_bytes(entry):
+        """エントリのバイト数"""
+        return sum(tensor.numel() * tensor.element_size() for tensor in entry)
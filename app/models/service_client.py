@@ -0,0 +1,134 @@
+import os
+import threading
+from multiprocessing.connection import Client
+import numpy as np
+import torch
+from PIL import Image
+from app.models.latent_pool import SharedLatentPool
+
+SERVICE_ENV = "EVODIFFUSION_SERVICE"
+SERVICE_KEY_ENV = "EVODIFFUSION_SERVICE_KEY"
+DEFAULT_ADDRESS = "/tmp/evodiffusion_service.sock"
+
+
+def parse_address(address=None):
+    """
+    生成サービスのアドレスを解釈する
+
+    Args:
+        address (str, optional): "host:port" またはUNIXソケットのパス。
+            省略時は環境変数 EVODIFFUSION_SERVICE、それもなければ既定のソケット
+
+    Returns:
+        tuple or str: TCPの場合は (host, port)、それ以外はソケットのパス
+    """
+    address = address or os.environ.get(SERVICE_ENV, DEFAULT_ADDRESS)
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return (host or "localhost", int(port))
+    return address
+
+
+def service_authkey():
+    """サービスとの接続の認証に使う鍵を取得"""
+    return os.environ.get(SERVICE_KEY_ENV, "evodiffusion").encode("utf-8")
+
+
+class ServiceClient:
+    """
+    生成サービス（app.service）に画像生成を依頼するクライアント
+
+    RemoteBackend の load_pipeline が返すパイプラインの代わりで、
+    DiffusionModel はクライアントモードのとき generate を呼び出す。
+    1つの接続で送った依頼は順に処理され、応答が届くまで generate はブロックする。
+    UNIXソケットで接続する（同じホストで動いている）場合は、潜在変数を共有メモリの
+    SharedLatentPool に書き込み、シリアライズする代わりにハンドルだけを送る
+    """
+
+    def __init__(self, address=None, authkey=None, latent_pool_slots=64, latent_shape=(4, 64, 64)):
+        """
+        ServiceClientの初期化（サービスに接続する）
+
+        Args:
+            address (str, optional): サービスのアドレス
+            authkey (bytes, optional): 認証に使う鍵
+            latent_pool_slots (int): 共有メモリのスロット数（0の場合は共有メモリを使わない）
+            latent_shape (tuple): 共有メモリの1スロットの潜在変数の形状
+        """
+        self.address = parse_address(address)
+        self._conn = Client(self.address, authkey=authkey or service_authkey())
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.latent_pool = None
+        if latent_pool_slots and isinstance(self.address, str):
+            self.latent_pool = SharedLatentPool(num_slots=latent_pool_slots, latent_shape=latent_shape)
+
+    def generate(self, prompt, latents, height, width, num_inference_steps, guidance_scale=0.0, step_callback=None):
+        """
+        サービスで画像を生成する
+
+        Args:
+            prompt (str): テキストプロンプト
+            latents (torch.Tensor): 形状 (N, 4, H/8, W/8) の潜在変数
+            height (int): 画像の高さ
+            width (int): 画像の幅
+            num_inference_steps (int): デノイズのステップ数
+            guidance_scale (float): ガイダンススケール
+            step_callback (callable, optional): 応答が届いたとき、パイプラインの
+                callback_on_step_end と同じ引数でデノイズ済みの潜在変数を渡して呼ばれる
+
+        Returns:
+            list: PIL画像のリスト
+
+        Raises:
+            RuntimeError: サービスでの生成に失敗した場合
+        """
+        message = {
+            "prompt": prompt,
+            "height": height,
+            "width": width,
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+        }
+        handle = self._put_latents(latents)
+        if handle is None:
+            message["latents"] = latents.detach().to("cpu", torch.float16).numpy()
+        else:
+            message["latents_handle"] = handle
+
+        try:
+            with self._lock:
+                self._next_id += 1
+                message["id"] = self._next_id
+                self._conn.send(message)
+                response = self._conn.recv()
+
+            if "error" in response:
+                raise RuntimeError(f"Generation service failed: {response['error']}")
+            if step_callback is not None:
+                # サービスはデノイズ済みの潜在変数を同じスロットに書き戻す
+                if handle is None:
+                    denoised = torch.from_numpy(response["latents"])
+                else:
+                    denoised = self.latent_pool.view(handle)
+                step_callback(self, num_inference_steps - 1, 0, {"latents": denoised})
+        finally:
+            if handle is not None:
+                self.latent_pool.release(handle)
+        return [Image.fromarray(np.ascontiguousarray(array)) for array in response["images"]]
+
+    def _put_latents(self, latents):
+        """潜在変数を共有メモリに書き込む（使えない場合はNone）"""
+        if self.latent_pool is None or tuple(latents.shape[1:]) != self.latent_pool.latent_shape:
+            return None
+        try:
+            return self.latent_pool.put(latents)
+        except MemoryError:
+            return None
+
+    def close(self):
+        """サービスとの接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+        if self.latent_pool is not None:
+            self.latent_pool.close()
@@ -0,0 +1,161 @@
+import logging
+import threading
+from collections import OrderedDict
+from app.models.diffusion import GenerationCancelled
+from app.models.evolution import EvolutionModel
+
+logger = logging.getLogger(__name__)
+
+# 先読みは選択ごとに集団全体を生成するので、これより大きい集団では先読みしない
+MAX_SPECULATIVE_POPULATION = 16
+
+
+class SpeculativeScheduler:
+    """
+    ユーザーが画像を選んでいる間に、次の集団を先読みして生成するスケジューラ
+
+    次の集団は「どの画像を選択したか」で決まるので、起こりやすい選択
+    （各画像を1枚だけ選択、すべてを選択）について優先度順に変異と画像生成を済ませておく。
+    ユーザーの選択と一致すれば、その結果をすぐに使える。
+    先読みするのは優先度の高い max_entries 個の選択までで、上限を超えた場合は優先度の低い結果から破棄する。
+    ユーザーが操作した時点で、進行中の先読みはキャンセルされる
+    """
+
+    def __init__(self, diffusion_model, max_entries=8, population_size=4,
+                 max_population=MAX_SPECULATIVE_POPULATION):
+        """
+        SpeculativeSchedulerの初期化
+
+        Args:
+            diffusion_model (DiffusionModel): 画像生成に使うモデル
+            max_entries (int): 先読みする選択と、保持する先読み結果の最大数
+            population_size (int): 生成する集団の大きさ
+            max_population (int): 先読みする集団の大きさの上限。これを超える場合は先読みしない
+        """
+        self.diffusion_model = diffusion_model
+        self.max_entries = max_entries
+        self.population_size = population_size
+        self.enabled = population_size <= max_population
+        self._entries = OrderedDict()  # キー → (優先度の順位, 先読み結果)
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def candidate_selections(num_images):
+        """
+        先読みする選択を優先度順に列挙する
+
+        Args:
+            num_images (int): 表示中の画像の数
+
+        Returns:
+            list: 選択された画像のIDのタプルのリスト
+        """
+        selections = [(i,) for i in range(num_images)]
+        if num_images > 1:
+            selections.append(tuple(range(num_images)))
+        return selections
+
+    def start(self, prompt, step, num_images, selections=None):
+        """
+        指定されたステップを親とする先読みを開始する（進行中の先読みはキャンセル）
+
+        集団が max_population より大きい場合は何もしない
+
+        Args:
+            prompt (str): 画像生成のためのテキストプロンプト
+            step (int): 親となる表示中のステップ
+            num_images (int): 表示中の画像の数
+            selections (list, optional): 優先度順の先読みする選択。省略時は candidate_selections の順
+        """
+        self.cancel()
+        if not self.enabled:
+            return
+        if selections is None:
+            selections = self.candidate_selections(num_images)
+        selections = list(selections)[:self.max_entries]
+
+        with self._lock:
+            for key in [key for key in self._entries if key[:2] != (prompt, step)]:
+                del self._entries[key]
+
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(prompt, step, selections, self._cancel_event),
+            name="SpeculativeScheduler", daemon=True
+        )
+        self._thread.start()
+
+    def cancel(self):
+        """
+        進行中の先読みをキャンセルする
+
+        パイプラインの呼び出し中であれば、デノイズの次のステップで中断される。
+        終了は待たないので、GUIスレッドから呼び出してもブロックしない
+        """
+        self._cancel_event.set()
+
+    def clear(self):
+        """先読みをキャンセルし、保持している結果を破棄する"""
+        self.cancel()
+        with self._lock:
+            self._entries.clear()
+
+    def take(self, prompt, step, selection):
+        """
+        ユーザーの選択に一致する先読み結果を取り出す
+
+        Args:
+            prompt (str): 画像生成のためのテキストプロンプト
+            step (int): 親となる表示中のステップ
+            selection (list): 選択された画像のID
+
+        Returns:
+            tuple or None: (変異後の集団, 画像のリスト, 系譜のレコードのリスト)。一致するものがない場合はNone
+        """
+        key = (prompt, step, tuple(sorted(selection)))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def _run(self, prompt, step, selections, cancel_event):
+        """先読みを優先度順に実行する"""
+        for rank, selection in enumerate(selections):
+            if cancel_event.is_set():
+                return
+            key = (prompt, step, selection)
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key] = (rank, self._entries[key][1])
+                    continue
+
+            try:
+                latents = [self.diffusion_model.load_latent(step, i) for i in selection]
+                evolution_model = EvolutionModel(
+                    latents, self.population_size, parent_ids=[(step, i) for i in selection]
+                )
+                population = evolution_model.mutate_population()
+                images = self.diffusion_model.render_images(prompt, population, should_cancel=cancel_event.is_set)
+            except GenerationCancelled:
+                return
+            except Exception as e:
+                logger.warning("Speculative generation failed: %s", e)
+                return
+
+            with self._lock:
+                if cancel_event.is_set():
+                    return
+                self._entries[key] = (rank, (population, images, evolution_model.lineage))
+                while len(self._entries) > self.max_entries:
+                    lowest = max(self._entries, key=lambda entry_key: self._entries[entry_key][0])
+                    del self._entries[lowest]
+                    if lowest == key:
+                        # 残りの選択はさらに優先度が低いので、先読みを続けても保持されない
+                        return
@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+
+
+class StepCache:
+    """
+    最近のステップの潜在変数と画像をメモリ上に保持するLRUキャッシュ
+
+    (ステップ, インデックス) をキーとして潜在変数とデコード済み画像を保持し、
+    合計サイズがメモリ予算を超えた場合は最も古く使われたものから破棄する
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        """
+        StepCacheの初期化
+
+        Args:
+            max_bytes (int): 保持するデータの合計バイト数の上限
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, step, index, latent=None, image=None):
+        """
+        潜在変数と画像を登録する（既存のエントリには不足分を補う）
+
+        Args:
+            step (int): ステップ番号
+            index (int): 個体のインデックス
+            latent (torch.Tensor, optional): 潜在変数
+            image (PIL.Image.Image, optional): 画像
+        """
+        key = (step, index)
+        with self._lock:
+            old_latent, old_image = self._entries.get(key, (None, None))
+            if key in self._entries:
+                self._remove(key)
+
+            entry = (latent if latent is not None else old_latent, image if image is not None else old_image)
+            self._entries[key] = entry
+            self.total_bytes += self._entry_bytes(entry)
+            self._evict()
+
+    def get_latent(self, step, index):
+        """
+        潜在変数を取得する
+
+        Returns:
+            torch.Tensor or None: 潜在変数。キャッシュにない場合はNone
+        """
+        return self._get(step, index, 0)
+
+    def get_image(self, step, index):
+        """
+        画像を取得する
+
+        Returns:
+            PIL.Image.Image or None: 画像。キャッシュにない場合はNone
+        """
+        return self._get(step, index, 1)
+
+    def discard_step(self, step):
+        """指定したステップのエントリを破棄する"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == step]:
+                self._remove(key)
+
+    def clear(self):
+        """キャッシュを空にする"""
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を取得"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, step, index, position):
+        """エントリの指定位置の値を取得"""
+        key = (step, index)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[position] is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[position]
+
+    def _evict(self):
+        """予算を超えている間、最も古いエントリを破棄"""
+        while len(self._entries) > 1 and self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """エントリを削除"""
+        entry = self._entries.pop(key)
+        self.total_bytes -= self._entry_bytes(entry)
+
+    @staticmethod
+    def _entry_bytes(entry):
+        """エントリのバイト数"""
+        latent, image = entry
+        size = 0
+        if latent is not None:
+            size += latent.numel() * latent.element_size()
+        if image is not None:
+            size += image.width * image.height * len(image.getbands())
+        return size
@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+LOG_FILE = "user_log.jsonl"
+LEGACY_LOG_FILE = "user_log.json"
+
+
+class UserLogWriter:
+    """
+    ユーザーの操作ログを1行1エントリで追記するライター
+
+    エントリはバッファに書き込まれ、一定件数ごとにfsyncされる。
+    書き出していないエントリはタイマーで fsync_interval 秒以内にfsyncされるので、追記が途絶えても残らない。
+    開く際に末尾の書きかけの行を切り詰めるので、クラッシュ後もそのまま追記を再開できる
+    """
+
+    def __init__(self, path, fsync_every=16, fsync_interval=1.0):
+        """
+        UserLogWriterの初期化
+
+        Args:
+            path (str): ログファイルのパス
+            fsync_every (int): fsyncするまでに書き込むエントリ数の上限
+            fsync_interval (float): fsyncの最大間隔（秒）
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        recover_tail(path)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._timer = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, entry):
+        """
+        エントリを追記する
+
+        Args:
+            entry (dict): ログのエントリ
+        """
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            elif self._timer is None:
+                # 次の追記がなくても fsync_interval 以内に書き出す
+                self._timer = threading.Timer(self.fsync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        """バッファの内容を書き出してfsyncする"""
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+
+    def _sync(self):
+        """バッファの内容を書き出してfsyncする（ロックを保持して呼び出す）"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """ログを書き出してファイルを閉じる"""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+
+def recover_tail(path):
+    """
+    ログファイル末尾の書きかけの行を切り詰める
+
+    Args:
+        path (str): ログファイルのパス
+
+    Returns:
+        int: 切り詰めたバイト数
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+
+        # 最後の改行を探す
+        position = size
+        while position > 0:
+            chunk_start = max(0, position - 4096)
+            f.seek(chunk_start)
+            chunk = f.read(position - chunk_start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                position = chunk_start + newline + 1
+                break
+            position = chunk_start
+        f.truncate(position)
+        return size - position
+
+
+def iter_user_log(path):
+    """
+    ユーザーログのエントリを先頭から順に返す
+
+    1行1エントリの形式と、旧形式（JSON配列の ``user_log.json``）の両方を読み込める。
+    末尾の書きかけの行は無視する
+
+    Args:
+        path (str): ログファイルのパス、またはセッションのディレクトリ
+
+    Yields:
+        dict: ログのエントリ
+    """
+    if os.path.isdir(path):
+        path = find_user_log(path)
+        if path is None:
+            return
+
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                return
+            if line.strip():
+                yield json.loads(line)
+
+
+def find_user_log(session_dir):
+    """
+    セッションのディレクトリにあるユーザーログのパスを取得
+
+    Returns:
+        str or None: ログファイルのパス。存在しない場合はNone
+    """
+    for name in (LOG_FILE, LEGACY_LOG_FILE):
+        path = os.path.join(session_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def convert_json_log(json_path, jsonl_path=None):
+    """
+    旧形式の ``user_log.json`` を1行1エントリの形式に変換する
+
+    Args:
+        json_path (str): 旧形式のログファイルのパス
+        jsonl_path (str, optional): 出力先のパス。省略時は同じディレクトリの ``user_log.jsonl``
+
+    Returns:
+        str: 出力先のパス
+    """
+    if jsonl_path is None:
+        jsonl_path = os.path.join(os.path.dirname(json_path), LOG_FILE)
+
+    tmp_path = f"{jsonl_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in iter_user_log(json_path):
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, jsonl_path)
+    return jsonl_path
+
+
+def main():
+    """旧形式のログを変換するコマンドラインツール"""
+    parser = argparse.ArgumentParser(description="Convert user_log.json files to user_log.jsonl")
+    parser.add_argument("paths", nargs="+", help="user_log.json files or session directories")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, LEGACY_LOG_FILE)
+        if not os.path.exists(path):
+            print(f"Skipped (not found): {path}")
+            continue
+        print(f"Converted: {path} -> {convert_json_log(path)}")
+
+
+if __name__ == "__main__":
+    main()
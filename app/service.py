@@ -0,0 +1,471 @@
+import argparse
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from multiprocessing.connection import Listener
+import numpy as np
+import torch
+from app.models.backends import create_backend
+from app.models.instrumentation import get_tracer
+from app.models.latent_pool import SharedLatentPool
+from app.models.memory import resolve_memory_budget
+from app.models.prompt_cache import PromptEmbeddingCache
+from app.models.service_client import parse_address, service_authkey
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest:
+    """クライアントから受け取った1回分の生成の依頼"""
+
+    def __init__(self, client, message, latent_pool=None):
+        """
+        GenerationRequestの初期化
+
+        Args:
+            client (_ClientConnection): 依頼を送ったクライアント
+            message (dict): クライアントから受け取ったメッセージ
+            latent_pool (SharedLatentPool, optional): 潜在変数がハンドルで送られた場合のプール
+        """
+        self.client = client
+        self.request_id = message["id"]
+        self.prompt = message["prompt"]
+        self.latent_pool = latent_pool
+        self.latents_handle = message.get("latents_handle")
+        if self.latents_handle is None:
+            self.latents = torch.from_numpy(message["latents"])
+        else:
+            # 共有メモリを直接参照する（応答を送るまで参照を持つ）
+            latent_pool.retain(self.latents_handle)
+            self.latents = latent_pool.view(self.latents_handle)
+        self.height = message["height"]
+        self.width = message["width"]
+        self.num_inference_steps = message["num_inference_steps"]
+        self.guidance_scale = message["guidance_scale"]
+
+    def release_latents(self):
+        """共有メモリの参照を解放する"""
+        if self.latents_handle is not None:
+            self.latents = None
+            self.latent_pool.release(self.latents_handle)
+            self.latents_handle = None
+
+    @property
+    def num_images(self):
+        """生成する画像の数"""
+        return self.latents.shape[0]
+
+    @property
+    def batch_key(self):
+        """同じバッチにまとめられる依頼かどうかを判定するキー"""
+        return self.height, self.width, self.num_inference_steps, self.guidance_scale
+
+
+class BatchScheduler:
+    """
+    複数のクライアントの依頼をまとめてバッチにするスケジューラ
+
+    依頼はクライアントごとのキューに積まれる。バッチは最初の依頼から最大 max_wait 秒待って
+    max_batch_size 枚まで集め、クライアントを順番に回って1件ずつ取り出すので、
+    多くの依頼を送るクライアントがあっても他のクライアントが待たされ続けることはない。
+    解像度・ステップ数・ガイダンススケールが同じ依頼だけを同じバッチにまとめる
+    """
+
+    def __init__(self, max_batch_size=8, max_wait=0.02):
+        """
+        BatchSchedulerの初期化
+
+        Args:
+            max_batch_size (int): 1つのバッチで生成する最大画像数
+            max_wait (float): バッチに依頼を集めるために待つ最大秒数
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def submit(self, request):
+        """依頼をクライアントのキューに積む"""
+        with self._condition:
+            self._queues.setdefault(request.client.client_id, deque()).append(request)
+            self._condition.notify()
+
+    def remove_client(self, client_id):
+        """
+        クライアントのキューを削除する（切断されたクライアントの依頼を破棄）
+
+        Returns:
+            list: 破棄した依頼
+        """
+        with self._condition:
+            return list(self._queues.pop(client_id, ()))
+
+    def close(self):
+        """スケジューラを閉じ、next_batch で待っているスレッドを起こす"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def next_batch(self):
+        """
+        次のバッチを取り出す（依頼が届くまでブロックする）
+
+        Returns:
+            list or None: 依頼のリスト。スケジューラが閉じられた場合はNone
+        """
+        with self._condition:
+            while not self._closed and self._pending_images() == 0:
+                self._condition.wait()
+            if self._closed:
+                return None
+
+            deadline = time.monotonic() + self.max_wait
+            while self._pending_images() < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    break
+                self._condition.wait(remaining)
+            return self._take_batch()
+
+    def _pending_images(self):
+        """キューに積まれている画像の数"""
+        return sum(request.num_images for queue in self._queues.values() for request in queue)
+
+    def _take_batch(self):
+        """クライアントを順番に回り、互換性のある依頼を1件ずつ取り出してバッチにする"""
+        batch = []
+        size = 0
+        batch_key = None
+        progressed = True
+        while progressed and size < self.max_batch_size:
+            progressed = False
+            for client_id in list(self._queues):
+                queue = self._queues[client_id]
+                if not queue:
+                    continue
+                request = queue[0]
+                if batch_key is None:
+                    # 最初の依頼は上限を超えていても取り出す
+                    batch_key = request.batch_key
+                elif request.batch_key != batch_key or size + request.num_images > self.max_batch_size:
+                    continue
+                queue.popleft()
+                batch.append(request)
+                size += request.num_images
+                # 取り出したクライアントを最後に回し、次のバッチでは他のクライアントを優先する
+                self._queues.move_to_end(client_id)
+                progressed = True
+                if size >= self.max_batch_size:
+                    break
+        return batch
+
+
+class _ClientConnection:
+    """サービスに接続しているクライアント"""
+
+    def __init__(self, client_id, conn, max_pending):
+        self.client_id = client_id
+        self.conn = conn
+        # 処理待ちの依頼の数を制限する（上限に達すると受信を止め、クライアントの送信を待たせる）
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self._send_lock = threading.Lock()
+        self.latent_pool_names = set()  # このクライアントの依頼で接続した潜在変数のプール
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def begin_request(self):
+        """スケジューラに積んだ依頼を数える"""
+        with self._idle:
+            self._in_flight += 1
+
+    def finish_request(self):
+        """応答を送ったか破棄した依頼を数える"""
+        with self._idle:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def wait_idle(self):
+        """処理中の依頼がすべて応答されるか破棄されるまで待つ"""
+        with self._idle:
+            while self._in_flight > 0:
+                self._idle.wait()
+
+    def send(self, message):
+        """メッセージを送る（切断されていれば無視する）"""
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+        except (OSError, EOFError):
+            logger.debug("Client %d disconnected before the response was sent", self.client_id)
+
+
+class GenerationService:
+    """
+    パイプラインを1つだけ読み込み、ローカルソケット経由で複数のクライアントの生成を受け付けるサービス
+
+    クライアントごとに受信スレッドを立て、依頼を BatchScheduler に積む。
+    メインスレッドはバッチを取り出し、プロンプトの異なる依頼も埋め込みを連結して
+    1回のパイプライン呼び出しで生成する
+    """
+
+    def __init__(self, backend=None, address=None, authkey=None, max_batch_size=8, max_wait=0.02,
+                 max_pending_per_client=4, prompt_cache_entries=64, memory_budget=None):
+        """
+        GenerationServiceの初期化
+
+        Args:
+            backend (str or InferenceBackend, optional): 推論バックエンド
+            address (str, optional): 待ち受けるアドレス（"host:port" またはUNIXソケットのパス）
+            authkey (bytes, optional): 認証に使う鍵
+            max_batch_size (int): 1回のパイプライン呼び出しで生成する最大画像数
+            max_wait (float): バッチに依頼を集めるために待つ最大秒数
+            max_pending_per_client (int): クライアントごとの処理待ちの依頼の上限
+            prompt_cache_entries (int): プロンプト埋め込みキャッシュの最大エントリ数
+            memory_budget (int or str, optional): 省メモリ設定を選ぶためのメモリ予算（"12G" など）。
+                省略時は環境変数 EVODIFFUSION_MEMORY_BUDGET、それもなければデバイスの搭載メモリ
+        """
+        self.backend = create_backend(backend) if backend is None or isinstance(backend, str) else backend
+        self.pipe = self.backend.load_pipeline()
+        self.address = parse_address(address)
+        self.authkey = authkey or service_authkey()
+        self.max_pending_per_client = max_pending_per_client
+        self.max_batch_size = max_batch_size
+        self.memory_budget = resolve_memory_budget(memory_budget)
+        self._memory_resolution = None
+        self.scheduler = BatchScheduler(max_batch_size=max_batch_size, max_wait=max_wait)
+        self.prompt_cache = PromptEmbeddingCache(max_entries=prompt_cache_entries)
+        self.tracer = get_tracer()
+        self._client_ids = itertools.count(1)
+        self._listener = None
+        self._latent_pools = {}
+        self._latent_pool_clients = {}  # プールの名前 → 接続しているクライアントのIDの集合
+        self._latent_pools_lock = threading.Lock()
+
+    def serve_forever(self):
+        """接続の受け付けを開始し、バッチの処理を続ける"""
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # 前回のプロセスが残したソケット
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept_loop, name="GenerationService-accept", daemon=True).start()
+        logger.info("Generation service listening on %s", self.address)
+
+        try:
+            while True:
+                batch = self.scheduler.next_batch()
+                if batch is None:
+                    return
+                if batch:
+                    self._process_batch(batch)
+        finally:
+            self.close()
+
+    def close(self):
+        """待ち受けを終了する"""
+        self.scheduler.close()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        with self._latent_pools_lock:
+            for pool in self._latent_pools.values():
+                pool.close()
+            self._latent_pools.clear()
+            self._latent_pool_clients.clear()
+
+    def _latent_pool(self, client, message):
+        """潜在変数がハンドルで送られた場合、そのプールに接続する（接続済みなら再利用）"""
+        handle = message.get("latents_handle")
+        if handle is None:
+            return None
+        with self._latent_pools_lock:
+            pool = self._latent_pools.get(handle.pool_name)
+            if pool is None:
+                pool = SharedLatentPool.attach(handle.pool_name)
+                self._latent_pools[handle.pool_name] = pool
+                self._latent_pool_clients[handle.pool_name] = set()
+            self._latent_pool_clients[handle.pool_name].add(client.client_id)
+            client.latent_pool_names.add(handle.pool_name)
+            return pool
+
+    def _detach_latent_pools(self, client):
+        """
+        切断したクライアントだけが使っていたプールから切断する
+
+        接続したままだとクライアントが共有メモリを削除しても解放されないので、
+        長時間動くサービスでは切断のたびに閉じる
+        """
+        with self._latent_pools_lock:
+            for name in client.latent_pool_names:
+                clients = self._latent_pool_clients.get(name)
+                if clients is None:
+                    continue
+                clients.discard(client.client_id)
+                if not clients:
+                    self._latent_pools.pop(name).close()
+                    del self._latent_pool_clients[name]
+            client.latent_pool_names.clear()
+
+    def _accept_loop(self):
+        """クライアントの接続を受け付ける"""
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AttributeError):
+                return
+            except Exception as e:
+                # 認証の失敗などはそのクライアントだけを拒否する
+                logger.warning("Rejected a client: %s", e)
+                continue
+            client = _ClientConnection(next(self._client_ids), conn, self.max_pending_per_client)
+            threading.Thread(
+                target=self._receive_loop, args=(client,),
+                name=f"GenerationService-client-{client.client_id}", daemon=True
+            ).start()
+
+    def _receive_loop(self, client):
+        """クライアントから依頼を受信し、スケジューラに積む"""
+        try:
+            while True:
+                client.pending.acquire()
+                message = client.conn.recv()
+                request = GenerationRequest(client, message, self._latent_pool(client, message))
+                client.begin_request()
+                self.scheduler.submit(request)
+        except Exception as e:
+            if not isinstance(e, (OSError, EOFError)):
+                logger.warning("Invalid message from client %d: %s", client.client_id, e)
+            dropped = self.scheduler.remove_client(client.client_id)
+            for request in dropped:
+                request.release_latents()
+                client.finish_request()
+            logger.info("Client %d disconnected (%d queued requests dropped)", client.client_id, len(dropped))
+            # 生成中の依頼が共有メモリへの参照を解放してからプールを閉じる
+            client.wait_idle()
+            self._detach_latent_pools(client)
+            client.conn.close()
+
+    def _process_batch(self, batch):
+        """バッチの依頼をまとめて生成し、それぞれのクライアントに結果を送る"""
+        try:
+            with self.tracer.span("service_batch"):
+                images, latents = self._generate(batch)
+        except Exception as e:
+            logger.exception("Batch generation failed")
+            for request in batch:
+                self._respond(request, {"id": request.request_id, "error": str(e)})
+            return
+
+        self.tracer.count("service_batches")
+        self.tracer.count("service_images", len(images))
+        start = 0
+        for request in batch:
+            end = start + request.num_images
+            message = {
+                "id": request.request_id,
+                "images": [np.asarray(image.convert("RGB")) for image in images[start:end]],
+            }
+            if request.latents_handle is None:
+                message["latents"] = latents[start:end].to("cpu", torch.float16).numpy()
+            else:
+                # 入力の潜在変数はもう使わないので、同じスロットにデノイズ済みの潜在変数を書き戻す
+                request.latent_pool.write(request.latents_handle, latents[start:end])
+            self._respond(request, message)
+            start = end
+
+    def _respond(self, request, message):
+        """応答を送り、共有メモリの参照とクライアントの処理待ちの枠を解放する"""
+        request.release_latents()
+        request.client.send(message)
+        request.client.pending.release()
+        request.client.finish_request()
+
+    def _generate(self, batch):
+        """
+        依頼の潜在変数とプロンプトの埋め込みを連結し、1回のパイプライン呼び出しで生成する
+
+        Returns:
+            tuple: (PIL画像のリスト, デノイズ済みの潜在変数)
+        """
+        prompt_embeds = []
+        pooled_prompt_embeds = []
+        for request in batch:
+            embeds, pooled = self._encode_prompt(request.prompt)
+            prompt_embeds.append(embeds.expand(request.num_images, -1, -1))
+            pooled_prompt_embeds.append(pooled.expand(request.num_images, -1))
+
+        first = batch[0]
+        self._configure_memory(first.height, first.width)
+        denoised = {}
+
+        def capture_latents(pipe, step_index, timestep, callback_kwargs):
+            denoised["latents"] = callback_kwargs["latents"]
+            return callback_kwargs
+
+        latents = torch.cat([request.latents for request in batch], dim=0)
+        with torch.no_grad():
+            images = self.pipe(
+                prompt_embeds=torch.cat(prompt_embeds, dim=0),
+                pooled_prompt_embeds=torch.cat(pooled_prompt_embeds, dim=0),
+                height=first.height,
+                width=first.width,
+                latents=latents.to(self.backend.device, self.backend.dtype),
+                num_images_per_prompt=1,
+                num_inference_steps=first.num_inference_steps,
+                guidance_scale=first.guidance_scale,
+                callback_on_step_end=capture_latents
+            ).images
+        return images, denoised.get("latents", latents)
+
+    def _configure_memory(self, height, width):
+        """解像度が変わったときに、メモリ予算に収まる省メモリ設定を選び直す"""
+        if self._memory_resolution == (height, width):
+            return
+        plan = self.backend.configure_memory(self.pipe, height, width, self.max_batch_size, self.memory_budget)
+        self._memory_resolution = (height, width)
+        logger.info("%dx%d %s", width, height, plan.describe())
+
+    def _encode_prompt(self, prompt):
+        """プロンプトを埋め込みに変換する（キャッシュがあればそれを使う）"""
+        cached = self.prompt_cache.get(prompt)
+        if cached is not None:
+            return cached
+        with torch.no_grad():
+            prompt_embeds, _, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+                prompt=prompt,
+                device=self.backend.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        self.prompt_cache.put(prompt, prompt_embeds, pooled_prompt_embeds)
+        return prompt_embeds, pooled_prompt_embeds
+
+
+def main():
+    """生成サービスを起動するコマンドラインツール"""
+    parser = argparse.ArgumentParser(description="Serve image generation to EvoDiffusion clients over a local socket")
+    parser.add_argument("--address", default=None, help="host:port or a unix socket path")
+    parser.add_argument("--backend", default=None, help="inference backend (cuda, cpu, stub)")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20, help="how long to wait to fill a batch")
+    parser.add_argument("--max-pending-per-client", type=int, default=4)
+    parser.add_argument("--memory-budget", default=None, help="memory budget such as 12G (default: device memory)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = GenerationService(
+        backend=args.backend, address=args.address, max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000, max_pending_per_client=args.max_pending_per_client,
+        memory_budget=args.memory_budget
+    )
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from PyQt5.QtWidgets import QWidget, QRubberBand
-from PyQt5.QtCore import QRect, QPoint, QSize, Qt
+from PyQt5.QtCore import QRect, QPoint, QSize, Qt, pyqtSignal
 from PyQt5.QtGui import QPainter, QColor, QPen
 
 class CropOverlay(QWidget):
@@ -9,6 +9,8 @@ class CropOverlay(QWidget):
     このクラスは、マウスイベントを処理して矩形選択を可能にし、選択された領域を視覚的に表示する
     """
 
+    selection_changed = pyqtSignal()  # 選択された矩形が確定またはリセットされた
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setAttribute(Qt.WA_TransparentForMouseEvents, False)
@@ -34,6 +36,7 @@ class CropOverlay(QWidget):
         self.rubber_band.hide()
         if self.rubber_band.geometry().isValid():
             self.selected_rect = self.rubber_band.geometry()
+            self.selection_changed.emit()
         self.update()
 
     def mousePressEvent(self, event):
@@ -60,6 +63,7 @@ class CropOverlay(QWidget):
             self.selected_rect = self.rubber_band.geometry()
             self.rubber_band.hide()
             self.update()  # 選択された矩形を描画するためにウィジェットを更新
+            self.selection_changed.emit()
 
     def paintEvent(self, event):
         """ウィジェットの描画処理"""
@@ -74,6 +78,19 @@ class CropOverlay(QWidget):
         self.rubber_band.hide()
         self.selected_rect = None
         self.origin = None
+        self.selection_changed.emit()
+
+    def set_selected_rect(self, rect):
+        """
+        選択された矩形を設定する（selection_changed は通知しない）
+
+        Args:
+            rect (QRect or None): オーバーレイの座標の矩形
+        """
+        self.rubber_band.hide()
+        self.selected_rect = rect
+        self.origin = None
+        self.update()
     
     def get_selected_rect(self):
         """選択された矩形を取得"""
@@ -1,8 +1,9 @@
 from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QPushButton, QHBoxLayout, QWidget
 from PyQt5.QtGui import QPixmap, QCursor
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 from app.ui.components.crop_button import CropButton
 from app.ui.components.crop_overlay import CropOverlay
+from app.ui.image_conversion import to_qimage
 
 class ImageDisplay(QWidget):
     """
@@ -12,8 +13,11 @@ class ImageDisplay(QWidget):
     また、画像の選択状態を追跡
     """
 
-    def __init__(self, parent=None, button_position="right"):
+    selection_changed = pyqtSignal(bool)  # 評価ボタンで選択状態が切り替えられた
+
+    def __init__(self, parent=None, button_position="right", image_size=(512, 512)):
         super().__init__(parent)
+        self.image_size = tuple(image_size)
         self.setStyleSheet("background-color: white;")
         
         self.is_selected = False  # 選択状態を追跡する属性
@@ -29,7 +33,7 @@ class ImageDisplay(QWidget):
         self.image_label = QLabel(self)
         self.image_label.setScaledContents(True)
         self.image_label.setStyleSheet("border: 1px solid black;")
-        self.image_label.setFixedSize(512, 512)
+        self.image_label.setFixedSize(*self.image_size)
 
     def _setup_crop_overlay(self):
         """クロッピングオーバーレイを設定"""
@@ -69,6 +73,18 @@ class ImageDisplay(QWidget):
         self.image_label.setPixmap(pixmap)
         self.update()
 
+    def set_qimage(self, qimage):
+        """QImageを設定（ワーカースレッドで変換済みの画像を表示する）"""
+        self.set_pixmap(QPixmap.fromImage(qimage))
+
+    def set_image(self, image):
+        """PIL画像を設定"""
+        self.set_qimage(to_qimage(image))
+
+    def clear_image(self):
+        """画像の表示を消す"""
+        self.image_label.clear()
+
     def start_cropping(self):
         """クロッピング操作を開始"""
         QApplication.setOverrideCursor(QCursor(Qt.CursorShape.CrossCursor))
@@ -81,8 +97,14 @@ class ImageDisplay(QWidget):
 
     def _on_evaluation_button_clicked(self, checked):
         """評価ボタンがクリックされたときの処理"""
-        self.is_selected = checked
-        self.select_button.setText("Selected" if checked else "Select")
+        self.set_selected(checked)
+        self.selection_changed.emit(checked)
+
+    def set_selected(self, selected):
+        """選択状態を設定する（selection_changed は通知しない）"""
+        self.is_selected = selected
+        self.select_button.setChecked(selected)
+        self.select_button.setText("Selected" if selected else "Select")
 
     def get_selected_rect(self):
         """選択された矩形を取得"""
@@ -0,0 +1,344 @@
+import math
+from PyQt5.QtWidgets import QScrollArea, QWidget
+from PyQt5.QtCore import QPoint, QRect, QSize, Qt, pyqtSignal
+from app.ui.components.image_display import ImageDisplay
+from app.ui.thumbnail_cache import ThumbnailCache
+
+
+class ImageGrid(QScrollArea):
+    """
+    集団の画像をスクロールできるグリッドで表示するウィジェット
+
+    ImageDisplay は画面に見えている行（と前後の overscan_rows 行）の分だけ作り、
+    スクロールすると画面外に出たセルを別の画像に使い回すので、数百枚の集団でもウィジェットの数は増えない。
+    画像はセルの大きさに縮小したものを ThumbnailCache から取得し、キャッシュにない画像は
+    見えているセルの分だけスレッドプールでデコードする。
+    選択状態とクロップ領域はセルではなくグリッドが画像ごとに保持し、クロップ領域は元の画像の座標で扱う
+    """
+
+    selection_changed = pyqtSignal()  # 画像の選択状態が切り替えられた
+
+    def __init__(self, parent=None, count=4, columns=2, cell_size=512, image_size=(512, 512),
+                 max_thumbnail_bytes=64 * 1024 ** 2, overscan_rows=1):
+        """
+        ImageGridの初期化
+
+        Args:
+            parent (QWidget, optional): 親ウィジェット
+            count (int): 表示する画像の数
+            columns (int): ウィンドウを広げなくても表示できる最小の列数
+            cell_size (int): セルの画像の表示領域の一辺（画像は縦横比を保ってこの中に収める）
+            image_size (tuple): 元の画像の (幅, 高さ)（画像を読み込む前のクロップ領域の換算に使う）
+            max_thumbnail_bytes (int): 縮小画像のキャッシュの上限（バイト）
+            overscan_rows (int): スクロールに備えて画面外に用意しておく行数
+        """
+        super().__init__(parent)
+        self.columns = columns
+        self.cell_size = cell_size
+        self.overscan_rows = overscan_rows
+        self.image_size = tuple(image_size)
+        self._display_size = self._fit_display_size(self.image_size)
+        self._setup_thumbnail_cache(max_thumbnail_bytes)
+        self._setup_canvas()
+        self._initialize_items(count)
+        self._cells = {}  # 画像のインデックス → 表示に使っているセル
+        self._free_cells = []
+        self._cell_stride = self._measure_cell()
+
+    def _setup_thumbnail_cache(self, max_bytes):
+        """縮小画像のキャッシュのセットアップ"""
+        self.thumbnail_cache = ThumbnailCache(self._display_size, max_bytes=max_bytes, parent=self)
+        self.thumbnail_cache.thumbnail_ready.connect(self._on_thumbnail_ready)
+
+    def _setup_canvas(self):
+        """セルを配置するキャンバスとスクロールバーの設定"""
+        self._canvas = QWidget()
+        self.setWidget(self._canvas)
+        self.setWidgetResizable(False)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+        self.verticalScrollBar().valueChanged.connect(self._update_visible_cells)
+
+    def _initialize_items(self, count):
+        """画像ごとの状態の初期化"""
+        self._next_key = 0
+        self._keys = [self._new_key() for _ in range(count)]
+        self._sources = [None] * count
+        self._original_sizes = {}
+        self._selected = set()
+        self._crop_rects = {}
+
+    def _new_key(self):
+        """縮小画像のキャッシュのキーを作る（画像が差し替えられるたびに新しいキーにする）"""
+        self._next_key += 1
+        return self._next_key
+
+    def _fit_display_size(self, image_size):
+        """元の画像の縦横比を保ってセルに収まる表示の (幅, 高さ)"""
+        width, height = image_size
+        scale = self.cell_size / max(width, height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def _create_cell(self):
+        """セルを作成し、シグナルを接続する"""
+        cell = ImageDisplay(self._canvas, image_size=self._display_size)
+        cell.grid_index = None
+        cell.selection_changed.connect(lambda checked, cell=cell: self._on_cell_selection_changed(cell, checked))
+        cell.crop_overlay.selection_changed.connect(lambda cell=cell: self._on_cell_crop_changed(cell))
+        cell.hide()
+        cell.resize(cell.sizeHint())
+        return cell
+
+    def _measure_cell(self):
+        """セルを1つ作って、セルの配置の間隔を測る"""
+        cell = self._create_cell()
+        self._free_cells.append(cell)
+        return cell.size()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def sizeHint(self):
+        """columns 列・2行が見える大きさ"""
+        return QSize(self._viewport_width_for(self.columns) + self.frameWidth() * 2,
+                     self._cell_stride.height() * 2 + self.frameWidth() * 2)
+
+    def minimumSizeHint(self):
+        """columns 列・1行が見える大きさ"""
+        return QSize(self._viewport_width_for(self.columns) + self.frameWidth() * 2,
+                     self._cell_stride.height() + self.frameWidth() * 2)
+
+    def _viewport_width_for(self, columns):
+        """指定した列数のセルとスクロールバーが収まる幅"""
+        return self._cell_stride.width() * columns + self.verticalScrollBar().sizeHint().width()
+
+    def _column_count(self):
+        """ビューポートの幅に収まる列数"""
+        return max(1, self.viewport().width() // self._cell_stride.width())
+
+    def set_count(self, count):
+        """
+        表示する画像の数を変更する（残る画像の表示と状態はそのまま）
+
+        Args:
+            count (int): 画像の数
+        """
+        current = len(self._keys)
+        if count < current:
+            for index in [index for index in self._cells if index >= count]:
+                self._release_cell(index)
+            del self._keys[count:], self._sources[count:]
+            self._selected = {index for index in self._selected if index < count}
+            self._crop_rects = {index: rect for index, rect in self._crop_rects.items() if index < count}
+            self._original_sizes = {index: size for index, size in self._original_sizes.items() if index < count}
+        else:
+            self._keys.extend(self._new_key() for _ in range(count - current))
+            self._sources.extend([None] * (count - current))
+        self._update_visible_cells()
+
+    def set_image_size(self, image_size):
+        """
+        元の画像の (幅, 高さ) を設定する（縦横比が変わる場合はセルを作り直す）
+
+        Args:
+            image_size (tuple): 元の画像の (幅, 高さ)
+        """
+        self.image_size = tuple(image_size)
+        display_size = self._fit_display_size(self.image_size)
+        if display_size == self._display_size:
+            return
+        self._display_size = display_size
+        for index in list(self._cells):
+            self._release_cell(index)
+        for cell in self._free_cells:
+            cell.deleteLater()
+        self._free_cells = []
+        self.thumbnail_cache.set_thumbnail_size(display_size)
+        self._cell_stride = self._measure_cell()
+        self.updateGeometry()
+        self._update_visible_cells()
+
+    def set_image(self, index, image):
+        """
+        画像を差し替える（縮小はスレッドプールで行い、完了するまで前の画像を表示しておく）
+
+        画像そのものは縮小が済むと破棄するので、キャッシュから追い出された後も表示するには
+        set_sources で読み込み関数を設定しておく（縮小前に画面外へ出た画像は、次に見えたときに縮小する）
+
+        Args:
+            index (int): 画像のインデックス
+            image (QImage or PIL.Image.Image): 画像
+        """
+        if index >= len(self._keys):
+            return
+        self._keys[index] = self._new_key()
+        self._sources[index] = image
+        self._original_sizes.pop(index, None)
+        self.thumbnail_cache.request(self._keys[index], image)
+
+    def set_sources(self, loaders, reload=False):
+        """
+        画像の読み込み関数を設定する
+
+        読み込みは見えているセルの縮小画像がキャッシュにない場合だけ、スレッドプールで行う
+
+        Args:
+            loaders (list): 画像ごとの、PIL.Image（またはNone）を返す呼び出し可能オブジェクト
+            reload (bool): Trueの場合は別の画像として読み込み直す（読み込みが済むまで前の画像を表示しておく）
+        """
+        self.set_count(len(loaders))
+        for index, loader in enumerate(loaders):
+            self._sources[index] = loader
+            if reload:
+                self._keys[index] = self._new_key()
+                self._original_sizes.pop(index, None)
+        for index in self._cells:
+            self.thumbnail_cache.request(self._keys[index], self._sources[index])
+
+    def selected_indices(self):
+        """選択された画像のインデックスのリスト"""
+        return sorted(self._selected)
+
+    def crop_rect(self, index):
+        """
+        画像のクロップ領域を取得
+
+        Returns:
+            dict or None: 元の画像の座標の x_start, y_start, x_end, y_end。選択がない場合はNone
+        """
+        return self._crop_rects.get(index)
+
+    def crop_rects(self):
+        """画像ごとのクロップ領域のリスト（選択がない画像はNone）"""
+        return [self.crop_rect(index) for index in range(len(self._keys))]
+
+    def reset_selections(self):
+        """選択状態とクロッピング状態をリセットする"""
+        self._selected.clear()
+        self._crop_rects.clear()
+        for cell in self._cells.values():
+            index, cell.grid_index = cell.grid_index, None
+            cell.reset_selection()
+            cell.reset_cropping()
+            cell.grid_index = index
+
+    def _original_size(self, index):
+        """元の画像の (幅, 高さ)（まだ読み込んでいない場合は image_size）"""
+        return self._original_sizes.get(index, self.image_size)
+
+    def _to_image_rect(self, index, rect, label):
+        """表示上の矩形を元の画像の座標のクロップ領域にする"""
+        width, height = self._original_size(index)
+        scale_x = width / label.width()
+        scale_y = height / label.height()
+        return {
+            "x_start": round(rect.topLeft().x() * scale_x),
+            "y_start": round(rect.topLeft().y() * scale_y),
+            "x_end": round(rect.bottomRight().x() * scale_x),
+            "y_end": round(rect.bottomRight().y() * scale_y)
+        }
+
+    def _to_display_rect(self, index, crop_rect, label):
+        """元の画像の座標のクロップ領域を表示上の矩形にする"""
+        if crop_rect is None:
+            return None
+        width, height = self._original_size(index)
+        scale_x = label.width() / width
+        scale_y = label.height() / height
+        return QRect(
+            QPoint(round(crop_rect["x_start"] * scale_x), round(crop_rect["y_start"] * scale_y)),
+            QPoint(round(crop_rect["x_end"] * scale_x), round(crop_rect["y_end"] * scale_y))
+        )
+
+    def _on_cell_selection_changed(self, cell, checked):
+        """セルの評価ボタンで選択状態が切り替えられたときの処理"""
+        if cell.grid_index is None:
+            return
+        if checked:
+            self._selected.add(cell.grid_index)
+        else:
+            self._selected.discard(cell.grid_index)
+        self.selection_changed.emit()
+
+    def _on_cell_crop_changed(self, cell):
+        """セルのクロップ領域が確定またはリセットされたときの処理"""
+        if cell.grid_index is None:
+            return
+        rect = cell.crop_overlay.get_selected_rect()
+        if rect:
+            self._crop_rects[cell.grid_index] = self._to_image_rect(cell.grid_index, rect, cell.image_label)
+        else:
+            self._crop_rects.pop(cell.grid_index, None)
+
+    def _on_thumbnail_ready(self, key):
+        """縮小画像のデコードが完了したときの処理"""
+        if key not in self._keys:
+            return
+        index = self._keys.index(key)
+        # 元の大きさはクロップ領域の換算に使うので、縮小画像が追い出されても保持しておく
+        self._original_sizes[index] = self.thumbnail_cache.original_size(key)
+        if not callable(self._sources[index]):
+            self._sources[index] = None  # 縮小が済んだ画像は保持しない
+        cell = self._cells.get(index)
+        thumbnail = self.thumbnail_cache.get(key)
+        if cell is not None and thumbnail is not None:
+            cell.set_qimage(thumbnail)
+
+    def resizeEvent(self, event):
+        """リサイズイベントの処理（列数が変わるので配置し直す）"""
+        super().resizeEvent(event)
+        self._update_visible_cells()
+
+    def showEvent(self, event):
+        """表示イベントの処理"""
+        super().showEvent(event)
+        self._update_visible_cells()
+
+    def _update_visible_cells(self):
+        """見えている範囲の画像にセルを割り当て、範囲外のセルを回収する"""
+        count = len(self._keys)
+        columns = self._column_count()
+        stride_x, stride_y = self._cell_stride.width(), self._cell_stride.height()
+        rows = math.ceil(count / columns)
+        canvas_size = QSize(columns * stride_x, rows * stride_y)
+        if self._canvas.size() != canvas_size:
+            self._canvas.resize(canvas_size)
+
+        top = self.verticalScrollBar().value()
+        first_row = max(0, top // stride_y - self.overscan_rows)
+        last_row = min(rows - 1, (top + self.viewport().height()) // stride_y + self.overscan_rows)
+        visible = range(first_row * columns, min(count, (last_row + 1) * columns))
+
+        for index in [index for index in self._cells if index not in visible]:
+            self._release_cell(index)
+        for index in visible:
+            cell = self._cells.get(index) or self._bind_cell(index)
+            position = QPoint((index % columns) * stride_x, (index // columns) * stride_y)
+            if cell.pos() != position:
+                cell.move(position)
+        # 画面外に出た画像の待機中のデコードは取り消す
+        self.thumbnail_cache.cancel_pending(keep={self._keys[index] for index in visible})
+
+    def _bind_cell(self, index):
+        """画像にセルを割り当て、選択状態・クロップ領域・縮小画像を反映する"""
+        cell = self._free_cells.pop() if self._free_cells else self._create_cell()
+        cell.set_selected(index in self._selected)
+        cell.crop_overlay.set_selected_rect(self._to_display_rect(index, self._crop_rects.get(index), cell.image_label))
+        thumbnail = self.thumbnail_cache.get(self._keys[index])
+        if thumbnail is not None:
+            cell.set_qimage(thumbnail)
+        else:
+            cell.clear_image()
+            self.thumbnail_cache.request(self._keys[index], self._sources[index])
+        cell.grid_index = index
+        self._cells[index] = cell
+        cell.show()
+        return cell
+
+    def _release_cell(self, index):
+        """セルを画像から外して使い回せるようにする"""
+        cell = self._cells.pop(index)
+        cell.grid_index = None
+        cell.reset_cropping()
+        cell.hide()
+        self._free_cells.append(cell)
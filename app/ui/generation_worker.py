@@ -0,0 +1,82 @@
+import threading
+from PyQt5.QtCore import QThread, pyqtSignal
+from app.ui.image_conversion import to_qimage
+
+
+class GenerationWorker(QThread):
+    """
+    画像生成処理をGUIスレッドの外で実行するワーカー
+
+    潜在変数の読み込み・変異・画像生成・保存をまとめたタスクを別スレッドで実行し、
+    進捗と生成された画像をシグナルでGUIスレッドに通知する。
+    生成された画像はこのスレッドでQImageに変換してから渡すので、GUIスレッドの処理は
+    QPixmapへの転送だけで済む。
+    すべてのシグナルにはジョブIDが付くので、受け取り側は古いジョブの結果を破棄できる。
+    キャンセルされたジョブの終了はGUIスレッドでは待たず、次のジョブがこのスレッドで待つ
+    """
+
+    image_ready = pyqtSignal(int, int, object)  # ジョブID、画像のインデックス、QImage
+    preview_ready = pyqtSignal(int, int, object)  # ジョブID、画像のインデックス、プレビューのQImage
+    progress = pyqtSignal(int, int, int)  # ジョブID、完了数、総数
+    succeeded = pyqtSignal(int, object)  # ジョブID、タスクの戻り値
+    failed = pyqtSignal(int, str)  # ジョブID、エラーメッセージ
+    cancelled = pyqtSignal(int)  # ジョブID
+
+    def __init__(self, job_id, task, parent=None, wait_for=()):
+        """
+        GenerationWorkerの初期化
+
+        Args:
+            job_id (int): ジョブを識別するID
+            task (callable): ワーカー自身を引数に取り、別スレッドで実行される処理
+            parent (QObject, optional): 親オブジェクト
+            wait_for (iterable): タスクの前に終了を待つワーカー（キャンセル済みの前のジョブ）
+        """
+        super().__init__(parent)
+        self.job_id = job_id
+        self.task = task
+        self._is_cancelled = False
+        # QThread.wait は削除済みのワーカーに使えないので、終了はイベントで通知する
+        self.done = threading.Event()
+        self._wait_for = [worker.done for worker in wait_for]
+
+    def run(self):
+        """前のジョブの終了を待ってからタスクを実行し、結果をシグナルで通知する"""
+        # モデルの読み込み後にしか実行されないので、ここでimportしても重くない
+        from app.models.diffusion import GenerationCancelled
+
+        try:
+            for done in self._wait_for:
+                done.wait()
+            result = self.task(self)
+        except GenerationCancelled:
+            self.cancelled.emit(self.job_id)
+        except Exception as e:
+            self.failed.emit(self.job_id, str(e))
+        else:
+            if self._is_cancelled:
+                self.cancelled.emit(self.job_id)
+            else:
+                self.succeeded.emit(self.job_id, result)
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        """実行中のタスクのキャンセルを要求する"""
+        self._is_cancelled = True
+
+    def is_cancelled(self):
+        """キャンセルが要求されているかどうか"""
+        return self._is_cancelled
+
+    def report_image(self, index, image):
+        """生成された画像をQImageに変換して通知する"""
+        self.image_ready.emit(self.job_id, index, to_qimage(image))
+
+    def report_preview(self, index, preview):
+        """VAEデコード前の簡易プレビューをQImageに変換して通知する"""
+        self.preview_ready.emit(self.job_id, index, to_qimage(preview))
+
+    def report_progress(self, done, total):
+        """進捗を通知する"""
+        self.progress.emit(self.job_id, done, total)
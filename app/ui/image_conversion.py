@@ -0,0 +1,27 @@
+import numpy as np
+from PIL import Image
+from PyQt5.QtGui import QImage
+
+
+def to_qimage(image):
+    """
+    PIL画像またはRGBの配列をQImageに変換する
+
+    QImageは配列のバッファをそのまま参照するので、ピクセルデータのコピーは
+    PIL画像から連続したRGB配列を取り出す1回だけで済む。
+    QPixmapと異なりQImageはGUIスレッド以外でも作成できるので、ワーカースレッドで呼び出せる
+
+    Args:
+        image (PIL.Image.Image or numpy.ndarray): 画像、または形状 (H, W, 3) のuint8配列
+
+    Returns:
+        QImage: Format_RGB888 のQImage（参照する配列を ndarray 属性に保持する）
+    """
+    if isinstance(image, Image.Image) and image.mode != "RGB":
+        image = image.convert("RGB")
+    array = np.ascontiguousarray(np.asarray(image, dtype=np.uint8))
+    height, width = array.shape[:2]
+    qimage = QImage(array.data, width, height, array.strides[0], QImage.Format_RGB888)
+    # QImageはバッファを所有しないので、QImageと同じ寿命で配列を保持する
+    qimage.ndarray = array
+    return qimage
@@ -1,29 +1,104 @@
-import sys
+import logging
 import os
-import torch
+import sys
+import time
+from functools import partial
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QLineEdit, QProgressBar, QTextEdit, QGridLayout, QMessageBox
+    QPushButton, QLineEdit, QProgressBar, QTextEdit, QMessageBox, QCheckBox
 )
-from PyQt5.QtGui import QPixmap
 from PyQt5.QtCore import Qt
-from app.ui.components.image_display import ImageDisplay
-from app.models.diffusion import DiffusionModel
-from app.models.evolution import EvolutionModel
+from app.ui.components.image_grid import ImageGrid
+from app.ui.generation_worker import GenerationWorker
+from app.ui.model_loader import ModelLoader
+from app.models.instrumentation import format_step_summary, get_tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POPULATION_SIZE = 4
+# 多様性フィルタを有効にしたときに1回の操作で生成する候補の数（集団の2倍より少なくはしない）
+CANDIDATE_POOL_SIZE = 32
 
 class MainWindow(QMainWindow):
     """
     アプリケーションのメインウィンドウ
     
     ユーザーインターフェースの主要なコンポーネントを管理し、
-    画像生成と進化のロジックを制御する
+    画像生成と進化のロジックを制御する。
+    モデルはウィンドウの表示後にバックグラウンドで読み込み、読み込みが終わるまでの操作は予約しておく
     """
 
-    def __init__(self):
+    def __init__(self, started_at=None, population_size=DEFAULT_POPULATION_SIZE):
+        """
+        MainWindowの初期化
+
+        Args:
+            started_at (float, optional): 起動時刻（time.perf_counter の値）。起動時間の計測に使う
+            population_size (int): 1ステップで表示する画像の数
+        """
         super().__init__()
-        self.diffusion_model = DiffusionModel()
+        self._started_at = started_at if started_at is not None else time.perf_counter()
+        self.population_size = population_size
+        self.diffusion_model = None
+        self.speculative_scheduler = None
+        self._worker = None
+        self._retiring_workers = set()  # キャンセル済みで、まだ終了していないワーカー
+        self._after_retired_action = None
+        self._job_id = 0
+        self._on_job_success = None
+        self._queued_action = None
         self._setup_ui()
         self._connect_signals()
+        self._start_model_loading()
+
+    def _start_model_loading(self):
+        """モデルの読み込みをバックグラウンドで開始する"""
+        self._model_loader = ModelLoader(parent=self)
+        self._model_loader.status.connect(self.statusBar().showMessage)
+        self._model_loader.loaded.connect(self._on_model_loaded)
+        self._model_loader.failed.connect(self._on_model_failed)
+        self.progress_bar.setRange(0, 0)  # 読み込み中は進捗の分からないバーを表示
+        self._model_loader.start()
+
+    def report_window_shown(self):
+        """ウィンドウが表示されるまでの時間を表示する"""
+        elapsed = time.perf_counter() - self._started_at
+        self.text_output.append(f"Window shown {elapsed:.2f}s after launch. Loading model in the background...")
+        logger.info("Window shown %.2fs after launch", elapsed)
+
+    def _on_model_loaded(self, diffusion_model, timings):
+        """モデルの読み込みが完了したときの処理"""
+        from app.models.speculation import SpeculativeScheduler
+
+        self.diffusion_model = diffusion_model
+        self.speculative_scheduler = SpeculativeScheduler(diffusion_model, population_size=self.population_size)
+        if not self.speculative_scheduler.enabled:
+            self.speculative_checkbox.setChecked(False)
+            self.speculative_checkbox.setEnabled(False)
+            self.speculative_checkbox.setToolTip("Speculation is disabled for large populations.")
+        self.image_grid.set_image_size((diffusion_model.width, diffusion_model.height))
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.statusBar().showMessage("Ready", 5000)
+
+        elapsed = time.perf_counter() - self._started_at
+        self.text_output.append(
+            f"Model ready {elapsed:.1f}s after launch "
+            f"(imports {timings['imports']:.1f}s, model load {timings['model']:.1f}s)"
+        )
+        logger.info("Model ready %.1fs after launch: %s", elapsed, timings)
+
+        if self._queued_action is not None:
+            action, self._queued_action = self._queued_action, None
+            action()
+
+    def _on_model_failed(self, message):
+        """モデルの読み込みに失敗したときの処理"""
+        self._queued_action = None
+        self.progress_bar.setRange(0, 100)
+        self.statusBar().showMessage("Model failed to load")
+        self.text_output.append(f"Error while loading the model: {message}")
+        logger.error("Error while loading the model: %s", message)
 
     def _setup_ui(self):
         """UIコンポーネントの設定"""
@@ -36,7 +111,7 @@ class MainWindow(QMainWindow):
         layout = QVBoxLayout(central_widget)
         
         self._setup_prompt_input(layout)
-        self._setup_image_displays(layout)
+        self._setup_image_grid(layout)
         self._setup_control_buttons(layout)
         self._setup_progress_bar(layout)
         self._setup_text_output(layout)
@@ -50,25 +125,28 @@ class MainWindow(QMainWindow):
         self.prompt_button = QPushButton("Set prompt")
         layout.addWidget(self.prompt_button)
 
-    def _setup_image_displays(self, layout):
-        """画像表示領域の設定"""
-        image_layout = QGridLayout()
-        self.image_displays = []
-        for i in range(4):
-            button_position = "left" if i % 2 == 0 else "right"
-            image_display = ImageDisplay(button_position=button_position)
-            self.image_displays.append(image_display)
-            image_layout.addWidget(image_display, i // 2, i % 2)
-            image_display.installEventFilter(image_display.crop_overlay)
-        layout.addLayout(image_layout)
+    def _setup_image_grid(self, layout):
+        """画像表示領域の設定（見えている画像の分だけセルを作るスクロール可能なグリッド）"""
+        self.image_grid = ImageGrid(count=self.population_size)
+        layout.addWidget(self.image_grid, 1)
 
     def _setup_control_buttons(self, layout):
         """操作ボタンの設定"""
         button_layout = QHBoxLayout()
         self.generate_button = QPushButton("Generate")
         self.local_mutation_button = QPushButton("Apply Local Mutation")
+        self.undo_button = QPushButton("Undo")
+        self.redo_button = QPushButton("Redo")
+        self.speculative_checkbox = QCheckBox("Speculative")
+        self.diverse_checkbox = QCheckBox(f"Diverse ({self._candidate_pool_size()} candidates)")
+        self.profile_checkbox = QCheckBox("Profile")
         button_layout.addWidget(self.generate_button)
         button_layout.addWidget(self.local_mutation_button)
+        button_layout.addWidget(self.undo_button)
+        button_layout.addWidget(self.redo_button)
+        button_layout.addWidget(self.speculative_checkbox)
+        button_layout.addWidget(self.diverse_checkbox)
+        button_layout.addWidget(self.profile_checkbox)
         layout.addLayout(button_layout)
 
     def _setup_progress_bar(self, layout):
@@ -87,49 +165,288 @@ class MainWindow(QMainWindow):
         self.prompt_button.clicked.connect(self._on_prompt_button_clicked)
         self.generate_button.clicked.connect(self._on_generate_button_clicked)
         self.local_mutation_button.clicked.connect(self._on_local_mutation_clicked)
-
-    def _get_image_paths(self):
-        """生成された画像のパスを取得"""
-        base_dir = self.diffusion_model.base_dir
-        current_step = self.diffusion_model.current_step
-        return [os.path.join(base_dir, f"step_{current_step-1}", f"image_{i}.png") for i in range(4)]
-
-    def _update_images(self):
-        """画像表示の更新"""
-        for image_display, path in zip(self.image_displays, self._get_image_paths()):
-            image_display.set_pixmap(QPixmap(path))
+        self.undo_button.clicked.connect(self._on_undo_clicked)
+        self.redo_button.clicked.connect(self._on_redo_clicked)
+        self.speculative_checkbox.toggled.connect(self._on_speculative_toggled)
+        self.diverse_checkbox.toggled.connect(self._on_diverse_toggled)
+        self.profile_checkbox.toggled.connect(self._on_profile_toggled)
+
+    def _start_job(self, task, on_success):
+        """
+        生成ジョブをバックグラウンドで開始する
+
+        実行中のジョブがあればキャンセルし、その結果は破棄する。
+        キャンセルしたジョブの終了は新しいワーカーのスレッドで待つので、GUIスレッドはブロックしない。
+        ジョブの入力はすでに取り出してあるので、選択状態はここでリセットし、
+        新しい画像のプレビューが表示された時点から次の選択を始められるようにする
+
+        Args:
+            task (callable): ワーカーを引数に取り、別スレッドで実行される処理
+            on_success (callable): タスクの戻り値を受け取るGUIスレッド側の処理
+        """
+        self._cancel_current_job()
+        self._job_id += 1
+        self._on_job_success = on_success
+
+        worker = GenerationWorker(self._job_id, task, self, wait_for=self._retiring_workers)
+        worker.image_ready.connect(self._on_worker_image_ready)
+        worker.preview_ready.connect(self._on_worker_preview_ready)
+        worker.progress.connect(self._on_worker_progress)
+        worker.succeeded.connect(self._on_worker_succeeded)
+        worker.failed.connect(self._on_worker_failed)
+        worker.finished.connect(worker.deleteLater)
+        self._worker = worker
+
+        self.progress_bar.setValue(0)
+        self._reset_selections()
+        self.image_grid.set_count(self.population_size)
+        worker.start()
+
+    def _defer_until_model_loaded(self, action):
+        """
+        モデルの読み込み中であれば、操作を読み込みの完了後に実行するよう予約する
+
+        Args:
+            action (callable): 予約する操作
+
+        Returns:
+            bool: 予約した場合はTrue、モデルが読み込み済みの場合はFalse
+        """
+        if self.diffusion_model is not None:
+            return False
+        self._queued_action = action
+        self.text_output.append("Queued until the model is loaded.")
+        return True
+
+    def _defer_until_idle(self, action):
+        """
+        モデルの読み込み中またはジョブの実行中であれば、操作をその完了後に実行するよう予約する
+
+        プレビューを見て選択した画像の潜在変数は、ジョブが完了して保存されてから読み込めるので、
+        実行中のジョブはキャンセルせずに完了を待つ
+
+        Args:
+            action (callable): 予約する操作
+
+        Returns:
+            bool: 予約した場合はTrue、すぐに実行できる場合はFalse
+        """
+        if self._defer_until_model_loaded(action):
+            return True
+        if self._worker is None:
+            return False
+        self._queued_action = action
+        self.text_output.append("Queued until the current images are finished.")
+        return True
+
+    def _cancel_current_job(self):
+        """
+        実行中のジョブと先読み、予約された操作をキャンセルする
+
+        ジョブの終了は待たない。古いジョブの結果はジョブIDで破棄され、
+        ワーカーは終了したときに finished → deleteLater で削除される
+        """
+        self._queued_action = None
+        self._after_retired_action = None
+        if self.speculative_scheduler is not None:
+            self.speculative_scheduler.cancel()
+        if self._worker is not None:
+            worker, self._worker = self._worker, None
+            worker.cancel()
+            if worker.isRunning():
+                # 終了するまでは参照を保持し、後続のジョブが終了を待てるようにする
+                self._retiring_workers.add(worker)
+                worker.finished.connect(lambda: self._on_worker_retired(worker))
+
+    def _on_worker_retired(self, worker):
+        """キャンセルしたワーカーが終了したときの処理"""
+        self._retiring_workers.discard(worker)
+        if not self._retiring_workers and self._after_retired_action is not None:
+            action, self._after_retired_action = self._after_retired_action, None
+            action()
+
+    def _run_after_retired(self, action):
+        """
+        キャンセルしたジョブがすべて終了してから操作を実行する
+
+        キャンセルしたジョブがステップの保存を終えるまでは履歴が変わりうるので、
+        履歴を参照する操作はその後に実行する
+
+        Args:
+            action (callable): 実行する操作
+        """
+        if self._retiring_workers:
+            self._after_retired_action = action
+        else:
+            action()
+
+    def _wait_for_workers(self):
+        """キャンセルしたワーカーの終了を待つ（ウィンドウを閉じるときだけ使う）"""
+        for worker in list(self._retiring_workers):
+            worker.wait()
+        self._retiring_workers.clear()
+
+    def _generation_callbacks(self, worker):
+        """generate_imagesに渡す進捗通知・キャンセル確認用のコールバック"""
+        return {
+            "on_image": worker.report_image,
+            "on_preview": worker.report_preview,
+            "on_progress": worker.report_progress,
+            "should_cancel": worker.is_cancelled,
+        }
+
+    def _is_current_job(self, job_id):
+        """最新のジョブかどうか"""
+        return job_id == self._job_id
+
+    def _on_worker_image_ready(self, job_id, index, qimage):
+        """画像が1枚生成されたときの処理（ワーカーで変換済みのQImageをそのまま表示）"""
+        if self._is_current_job(job_id) and index < len(self.image_grid):
+            with get_tracer().span("ui_update"):
+                self.image_grid.set_image(index, qimage)
+
+    def _on_worker_preview_ready(self, job_id, index, qimage):
+        """VAEデコード前のプレビューが届いたときの処理（完成した画像が届くと置き換わる）"""
+        if self._is_current_job(job_id) and index < len(self.image_grid):
+            self.image_grid.set_image(index, qimage)
+
+    def _on_worker_progress(self, job_id, done, total):
+        """進捗が通知されたときの処理"""
+        if self._is_current_job(job_id):
+            self.progress_bar.setMaximum(total)
+            self.progress_bar.setValue(done)
+
+    def _on_worker_succeeded(self, job_id, result):
+        """ジョブが完了したときの処理"""
+        if self._is_current_job(job_id):
+            self._worker = None
+            self._on_job_success(result)
+            self._set_step_sources(self.diffusion_model.active_step)
+            self._report_write_errors()
+            self._report_step_metrics()
+            self._report_pool_stats()
+            if self._queued_action is not None:
+                action, self._queued_action = self._queued_action, None
+                action()
+            else:
+                self._start_speculation()
+
+    def _report_write_errors(self):
+        """バックグラウンドの保存で発生したエラーを表示"""
+        for path, error in self.diffusion_model.pop_write_errors():
+            self.text_output.append(f"Failed to save {path}: {error}")
+
+    def _report_step_metrics(self):
+        """計測が有効な場合、直前のステップの計測結果を表示"""
+        metrics = self.diffusion_model.last_step_metrics
+        if metrics is not None:
+            self.text_output.append(f"Step {metrics['step']} metrics: {format_step_summary(metrics)}")
+            self.diffusion_model.last_step_metrics = None
+
+    def _report_pool_stats(self):
+        """多様性フィルタで候補を選んだ場合、その所要時間と類似度を表示"""
+        stats = self.diffusion_model.last_pool_stats
+        if stats is not None:
+            from app.models.diversity import format_pool_stats
+            self.text_output.append(f"Diversity filter: {format_pool_stats(stats)}")
+            self.diffusion_model.last_pool_stats = None
+
+    def _is_diverse(self):
+        """多様性フィルタを使って候補を選ぶかどうか"""
+        return self.diverse_checkbox.isChecked()
+
+    def _generate_population(self, worker, prompt, latents, lineage=None):
+        """
+        集団の画像を生成する（多様性フィルタが有効なら候補から表示する画像を選ぶ）
+
+        Args:
+            worker (GenerationWorker): 進捗を通知するワーカー
+            prompt (str): テキストプロンプト
+            latents (list or torch.Tensor): 集団、または候補の潜在変数
+            lineage (list, optional): 潜在変数ごとの系譜のレコード
+        """
+        if not self._is_diverse():
+            return self.diffusion_model.generate_images(
+                prompt, latents, lineage=lineage, **self._generation_callbacks(worker)
+            )
+        return self.diffusion_model.generate_diverse_images(
+            prompt, latents, self.population_size, on_image=worker.report_image,
+            on_progress=worker.report_progress, should_cancel=worker.is_cancelled, lineage=lineage
+        )
+
+    def _candidate_pool_size(self):
+        """多様性フィルタを有効にしたときに生成する候補の数"""
+        return max(CANDIDATE_POOL_SIZE, 2 * self.population_size)
+
+    def _population_size(self):
+        """1回の操作で生成する潜在変数の数"""
+        return self._candidate_pool_size() if self._is_diverse() else self.population_size
+
+    def _on_worker_failed(self, job_id, message):
+        """ジョブが失敗したときの処理"""
+        if self._is_current_job(job_id):
+            self._worker = None
+            self._queued_action = None
+            self.text_output.append(f"Error during image generation: {message}")
+            logger.error("Error during image generation: %s", message)
 
     def _generate_initial_images(self, prompt):
         """初期画像の生成"""
-        latents = [self.diffusion_model.generate_latent(i) for i in range(4)]
-        self.diffusion_model.generate_images(prompt, latents)
-        self._update_images()
-        
-        base_dir = self.diffusion_model.base_dir
-        current_step = self.diffusion_model.current_step
+        population_size = self._population_size()
+
+        def task(worker):
+            latents = [self.diffusion_model.generate_latent(i) for i in range(population_size)]
+            return self._generate_population(worker, prompt, latents)
+
+        self._start_job(task, self._on_initial_images_generated)
+
+    def _on_initial_images_generated(self, result):
+        """初期画像の生成が完了したときの処理"""
+        _, base_dir, current_step = result
         self.text_output.append(f"Initial images generated in {base_dir}")
         self.text_output.append(f"Current step: {current_step}")
-        
-        return base_dir, current_step
 
     def _on_prompt_button_clicked(self):
         """プロンプトボタンがクリックされたときの処理"""
+        if self._defer_until_model_loaded(self._on_prompt_button_clicked):
+            return
         prompt = self.prompt_input.text()
         self._generate_initial_images(prompt)
 
     def _get_selected_image_ids(self):
         """選択された画像のIDを取得"""
-        return [i for i, display in enumerate(self.image_displays) if display.is_selected]
+        return self.image_grid.selected_indices()
 
     def _reset_selections(self):
-            """選択状態とクロッピング状態をリセットする"""
-            for display in self.image_displays:
-                display.reset_selection()
-                display.reset_cropping()
+        """選択状態とクロッピング状態をリセットする"""
+        self.image_grid.reset_selections()
+
+    def _set_step_sources(self, step, reload=False):
+        """
+        グリッドの画像の読み込み関数をステップの画像に設定する
+
+        縮小画像がキャッシュから追い出された画像は、見えたときにこの関数で読み込み直す
+
+        Args:
+            step (int): ステップ番号
+            reload (bool): Trueの場合は表示中の画像をこのステップの画像に差し替える
+        """
+        if step is None:
+            return
+        self.image_grid.set_image_size((self.diffusion_model.width, self.diffusion_model.height))
+        loaders = [partial(self.diffusion_model.load_image, step, i) for i in range(len(self.image_grid))]
+        self.image_grid.set_sources(loaders, reload=reload)
+
+    def _load_latents(self, image_ids):
+        """表示中のステップの潜在変数を読み込む"""
+        step = self.diffusion_model.active_step
+        return [self.diffusion_model.load_latent(step, i) for i in image_ids]
 
     def _on_generate_button_clicked(self):
         """生成ボタンがクリックされたときの処理"""
-        base_dir, current_step = self.diffusion_model.base_dir, self.diffusion_model.current_step
+        if self._defer_until_idle(self._on_generate_button_clicked):
+            return
+
         prompt = self.prompt_input.text()
         selected_image_ids = self._get_selected_image_ids()
 
@@ -137,77 +454,182 @@ class MainWindow(QMainWindow):
             self.text_output.append("Please select at least one image.")
             return
 
-        try:
+        step = self.diffusion_model.active_step
+        population_size = self._population_size()
+        speculated = None if self._is_diverse() else self.speculative_scheduler.take(prompt, step, selected_image_ids)
+        if speculated is not None:
+            def task(worker):
+                # 先読み済みの集団と画像をそのまま新しいステップとして保存
+                population, images, lineage = speculated
+                result = self.diffusion_model.commit_images(
+                    images, population, on_image=worker.report_image, prompt=prompt, lineage=lineage
+                )
+                self.diffusion_model.save_user_log(
+                    selected_image_ids, mutation_type='random', step=step,
+                    prompt=prompt, result_step=self.diffusion_model.active_step
+                )
+                return result
+
+            self._start_job(task, lambda result: self._on_images_generated("New images generated successfully (speculative)."))
+            return
+
+        def task(worker):
             # 選択された画像の潜在変数を読み込み
-            selected_latents = [
-                torch.load(os.path.join(base_dir, f"step_{current_step - 1}", f"latent_{i}.pt"))
-                for i in selected_image_ids
-            ]
+            selected_latents = self._load_latents(selected_image_ids)
 
             # 変異と画像生成
-            evolution_model = EvolutionModel(selected_latents)
+            from app.models.evolution import EvolutionModel
+            evolution_model = EvolutionModel(
+                selected_latents, population_size, parent_ids=[(step, i) for i in selected_image_ids]
+            )
             mutated_latents = evolution_model.random_mutation()
 
             if mutated_latents is None or len(mutated_latents) == 0:
                 raise ValueError("No mutated latents generated.")
 
+            result = self._generate_population(worker, prompt, mutated_latents, evolution_model.lineage)
+
             # ユーザーログを保存
-            self.diffusion_model.save_user_log(selected_image_ids, mutation_type='random')
+            self.diffusion_model.save_user_log(
+                selected_image_ids, mutation_type='random', step=step,
+                prompt=prompt, result_step=self.diffusion_model.active_step
+            )
+            return result
 
-            self.diffusion_model.generate_images(prompt, mutated_latents)
-            self._update_images()
+        self._start_job(task, lambda result: self._on_images_generated("New images generated successfully."))
 
-            self._reset_selections()
-            self.text_output.append("New images generated successfully.")
-        except Exception as e:
-            self.text_output.append(f"Error during image generation: {str(e)}")
-            print(f"Error details: {e}")  # デバッグ用にコンソールにも出力
+    def _on_images_generated(self, message):
+        """変異後の画像の生成が完了したときの処理"""
+        self.text_output.append(message)
 
     def _on_local_mutation_clicked(self):
         """ローカル変異ボタンがクリックされたときの処理"""
-        cropped_displays = [display for display in self.image_displays if display.crop_overlay.get_selected_rect()]
-        
-        if not cropped_displays:
-            QMessageBox.warning(self, "Warning", "Please crop an area in at least one image before applying local mutation.")
+        if self._defer_until_idle(self._on_local_mutation_clicked):
             return
 
-        base_dir, current_step = self.diffusion_model.base_dir, self.diffusion_model.current_step
-        all_latents = [
-            torch.load(os.path.join(base_dir, f"step_{current_step - 1}", f"latent_{i}.pt"))
-            for i in range(len(self.image_displays))
-        ]
-
-        evolution_model = EvolutionModel(all_latents)
-
-        mutated_latents = []
-        for i, display in enumerate(self.image_displays):
-            crop_rect = display.crop_overlay.get_selected_rect()
-            if crop_rect:
-                print(f"Applying local mutation to image {i}")
-                print(f"Crop rect: {crop_rect}")
-                mutated_latent = evolution_model.local_mutation(all_latents[i], crop_rect)
-                mutated_latents.append(mutated_latent)
-
-                # ユーザーログを保存
-                crop_rect_dict = {
-                    "x_start": crop_rect.topLeft().x(),
-                    "y_start": crop_rect.topLeft().y(),
-                    "x_end": crop_rect.bottomRight().x(),
-                    "y_end": crop_rect.bottomRight().y()
-                }
-                self.diffusion_model.save_user_log(i, mutation_type='local', crop_rect=crop_rect_dict)
-            else:
-                mutated_latents.append(all_latents[i])
+        # クロップ領域はグリッドが元の画像の座標に換算して保持している
+        crop_rects = self.image_grid.crop_rects()
+
+        if not any(crop_rects):
+            QMessageBox.warning(self, "Warning", "Please crop an area in at least one image before applying local mutation.")
+            return
 
         prompt = self.prompt_input.text()
-        self.diffusion_model.generate_images(prompt, mutated_latents)
-        self._update_images()
 
+        def task(worker):
+            step = self.diffusion_model.active_step
+            all_latents = self._load_latents(range(len(crop_rects)))
+
+            from app.models.evolution import EvolutionModel
+            evolution_model = EvolutionModel(all_latents)
+
+            mutated_latents = []
+            crop_logs = []
+            for i, crop_rect in enumerate(crop_rects):
+                if crop_rect:
+                    logger.debug("Applying local mutation to image %d: %s", i, crop_rect)
+                    mutated_latent = evolution_model.local_mutation(all_latents[i], crop_rect, parent_id=(step, i))
+                    mutated_latents.append(mutated_latent)
+                    crop_logs.append((i, crop_rect))
+                else:
+                    mutated_latents.append(evolution_model.keep(all_latents[i], parent_id=(step, i)))
+
+            result = self.diffusion_model.generate_images(
+                prompt, mutated_latents, lineage=evolution_model.lineage, **self._generation_callbacks(worker)
+            )
+
+            # ユーザーログを保存
+            for i, crop_rect_dict in crop_logs:
+                self.diffusion_model.save_user_log(
+                    i, mutation_type='local', crop_rect=crop_rect_dict, step=step,
+                    prompt=prompt, result_step=self.diffusion_model.active_step
+                )
+            return result
+
+        self._start_job(task, lambda result: self._on_images_generated("Local mutation applied to cropped areas."))
+
+    def _on_undo_clicked(self):
+        """元に戻すボタンがクリックされたときの処理"""
+        if self.diffusion_model is None:
+            return
+        self._cancel_current_job()
+        self._run_after_retired(lambda: self._show_step(self.diffusion_model.undo(), "Nothing to undo."))
+
+    def _on_redo_clicked(self):
+        """やり直しボタンがクリックされたときの処理"""
+        if self.diffusion_model is None:
+            return
+        self._cancel_current_job()
+        self._run_after_retired(lambda: self._show_step(self.diffusion_model.redo(), "Nothing to redo."))
+
+    def _show_step(self, step, empty_message):
+        """指定されたステップの画像を表示する（再生成や再読み込みはしない）"""
+        if step is None:
+            self.text_output.append(empty_message)
+            return
+
+        # 画像の読み込みと縮小は、見えている画像の分だけバックグラウンドで行う
+        self._set_step_sources(step, reload=True)
         self._reset_selections()
-        self.text_output.append("Local mutation applied to cropped areas.")
+        self.text_output.append(f"Showing step: {step}")
+        self._start_speculation()
+
+    def _on_speculative_toggled(self, checked):
+        """先読みの有効・無効が切り替えられたときの処理"""
+        if checked:
+            self._start_speculation()
+        elif self.speculative_scheduler is not None:
+            self.speculative_scheduler.clear()
+
+    def _on_diverse_toggled(self, checked):
+        """多様性フィルタの有効・無効が切り替えられたときの処理（先読みは4個体ずつなので使わない）"""
+        if checked:
+            if self.speculative_scheduler is not None:
+                self.speculative_scheduler.clear()
+        else:
+            self._start_speculation()
+
+    def _start_speculation(self):
+        """表示中のステップを親とする次の集団の先読みを開始する"""
+        if self.diffusion_model is None or self._is_diverse() or not self.speculative_scheduler.enabled:
+            return
+        step = self.diffusion_model.active_step
+        if self.speculative_checkbox.isChecked() and step is not None:
+            self.speculative_scheduler.start(self.prompt_input.text(), step, len(self.image_grid))
+
+    def _on_profile_toggled(self, checked):
+        """プロファイラの有効・無効が切り替えられたときの処理"""
+        tracer = get_tracer()
+        if checked:
+            tracer.start_profiler()
+            self.text_output.append("Profiler started.")
+        else:
+            model = self.diffusion_model
+            directory = (model.base_dir or model.data_root) if model is not None else "app/data"
+            trace_path = os.path.join(directory, "profile_trace.json")
+            tracer.stop_profiler(trace_path)
+            self.text_output.append(f"Profiler trace saved to {trace_path}")
+
+    def closeEvent(self, event):
+        """ウィンドウを閉じるときの処理"""
+        self._cancel_current_job()
+        # モデルを閉じる前に、キャンセルしたジョブの終了を待つ
+        self._wait_for_workers()
+        if self.profile_checkbox.isChecked():
+            self.profile_checkbox.setChecked(False)
+        # 読み込み中のモデルは中断できないので、読み込みの完了を待ってから閉じる
+        self._model_loader.wait()
+        # 画像を読み込み中のデコードが終わってからモデルを閉じる
+        self.image_grid.thumbnail_cache.clear()
+        self.image_grid.thumbnail_cache.wait()
+        if self.diffusion_model is not None:
+            self.diffusion_model.close()
+            self._report_write_errors()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    window.report_window_shown()
     sys.exit(app.exec_())
@@ -0,0 +1,48 @@
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class ModelLoader(QThread):
+    """
+    DiffusionModelをGUIスレッドの外で読み込むワーカー
+
+    torchやdiffusersなどの重いモジュールのimportもこのスレッドで行うので、
+    ウィンドウはモデルの読み込みを待たずに表示できる。
+    読み込みの状況と各段階の所要時間をシグナルでGUIスレッドに通知する
+    """
+
+    status = pyqtSignal(str)  # 読み込みの状況
+    loaded = pyqtSignal(object, object)  # DiffusionModel、段階ごとの所要時間（秒）のdict
+    failed = pyqtSignal(str)  # エラーメッセージ
+
+    def __init__(self, model_options=None, parent=None):
+        """
+        ModelLoaderの初期化
+
+        Args:
+            model_options (dict, optional): DiffusionModelのコンストラクタに渡す引数
+            parent (QObject, optional): 親オブジェクト
+        """
+        super().__init__(parent)
+        self.model_options = model_options or {}
+
+    def run(self):
+        """モジュールのimportとモデルの読み込みを行う"""
+        timings = {}
+        try:
+            start = time.perf_counter()
+            self.status.emit("Importing libraries...")
+            from app.models.diffusion import DiffusionModel
+            # 生成時に使うモジュールも先に読み込んでおく
+            import app.models.evolution  # noqa: F401
+            import app.models.speculation  # noqa: F401
+            timings["imports"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.status.emit("Loading model...")
+            model = DiffusionModel(**self.model_options)
+            timings["model"] = time.perf_counter() - start
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.loaded.emit(model, timings)
@@ -0,0 +1,169 @@
+import logging
+from collections import OrderedDict
+from PIL import Image
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QImage
+from app.ui.image_conversion import to_qimage
+
+logger = logging.getLogger(__name__)
+
+
+class _DecodeSignals(QObject):
+    """デコードの完了をGUIスレッドに通知するシグナル（QRunnableはシグナルを持てないため）"""
+
+    decoded = pyqtSignal(object, object, object)  # タスク、縮小画像のQImage、元の画像の (幅, 高さ)
+
+
+class _DecodeTask(QRunnable):
+    """画像を読み込んで縮小するタスク"""
+
+    def __init__(self, key, source, size, signals):
+        super().__init__()
+        # 取り消しのために参照を保持するので、スレッドプールには削除させない
+        self.setAutoDelete(False)
+        self.key = key
+        self.source = source
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        """画像を読み込んで縮小し、結果を通知する"""
+        thumbnail, original_size = None, None
+        try:
+            image = self.source() if callable(self.source) else self.source
+            if isinstance(image, QImage):
+                original_size = (image.width(), image.height())
+                thumbnail = image.scaled(self.size[0], self.size[1], Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            elif image is not None:
+                original_size = image.size
+                thumbnail = to_qimage(image.convert("RGB").resize(self.size, Image.BILINEAR, reducing_gap=2.0))
+        except Exception as e:
+            logger.warning("Failed to decode thumbnail %s: %s", self.key, e)
+        self.source = None
+        self.signals.decoded.emit(self, thumbnail, original_size)
+
+
+class ThumbnailCache(QObject):
+    """
+    表示用に縮小した画像をメモリ予算の範囲でLRUで保持するキャッシュ
+
+    画像の読み込みと縮小はスレッドプールで行い、完了すると thumbnail_ready で通知する。
+    縮小画像は表示の大きさで作るので、描画のたびに元の画像を拡大縮小する必要がない。
+    表示されなくなった画像の待機中のデコードは cancel_pending で取り消せる
+    """
+
+    thumbnail_ready = pyqtSignal(object)  # キー
+
+    def __init__(self, thumbnail_size=(512, 512), max_bytes=64 * 1024 ** 2, max_threads=2, parent=None):
+        """
+        ThumbnailCacheの初期化
+
+        Args:
+            thumbnail_size (tuple): 縮小画像の (幅, 高さ)
+            max_bytes (int): 保持する縮小画像の合計バイト数の上限
+            max_threads (int): デコードに使うスレッドの数
+            parent (QObject, optional): 親オブジェクト
+        """
+        super().__init__(parent)
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._original_sizes = {}
+        self._tasks = {}
+        self._retired = set()  # clear の前に始まり、結果を破棄するタスク
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(max_threads)
+        self._signals = _DecodeSignals()
+        self._signals.decoded.connect(self._on_decoded)
+
+    def get(self, key):
+        """
+        縮小画像を取得する
+
+        Returns:
+            QImage or None: 縮小画像。キャッシュにない場合はNone
+        """
+        image = self._images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._images.move_to_end(key)
+        return image
+
+    def original_size(self, key):
+        """縮小前の画像の (幅, 高さ)。デコードしていない場合はNone"""
+        return self._original_sizes.get(key)
+
+    def request(self, key, source):
+        """
+        縮小画像のデコードを要求する（キャッシュにあるか、デコード中の場合は何もしない）
+
+        Args:
+            key: 画像を識別するキー
+            source: PIL.Image、QImage、またはそれらを返す呼び出し可能オブジェクト（デコードのスレッドで呼ばれる）
+        """
+        if key in self._images or key in self._tasks or source is None:
+            return
+        task = _DecodeTask(key, source, self.thumbnail_size, self._signals)
+        self._tasks[key] = task
+        self._pool.start(task)
+
+    def cancel_pending(self, keep=()):
+        """
+        まだ始まっていないデコードを取り消す
+
+        Args:
+            keep (set): 取り消さないキー（表示中のセルの画像）
+        """
+        for key in [key for key in self._tasks if key not in keep]:
+            if self._pool.tryTake(self._tasks[key]):
+                del self._tasks[key]
+
+    def _on_decoded(self, task, thumbnail, original_size):
+        """デコードが完了したときの処理（GUIスレッド）"""
+        self._retired.discard(task)
+        if self._tasks.get(task.key) is not task:
+            return
+        del self._tasks[task.key]
+        if thumbnail is None:
+            return
+        self._put(task.key, thumbnail, original_size)
+        self.thumbnail_ready.emit(task.key)
+
+    def _put(self, key, thumbnail, original_size):
+        """縮小画像を登録し、上限を超えた分を古いものから破棄する"""
+        if key in self._images:
+            self.total_bytes -= self._images.pop(key).sizeInBytes()
+        self._images[key] = thumbnail
+        self._original_sizes[key] = original_size
+        self.total_bytes += thumbnail.sizeInBytes()
+        while self.total_bytes > self.max_bytes and len(self._images) > 1:
+            evicted_key, evicted = self._images.popitem(last=False)
+            self._original_sizes.pop(evicted_key, None)
+            self.total_bytes -= evicted.sizeInBytes()
+
+    def set_thumbnail_size(self, thumbnail_size):
+        """縮小画像の大きさを変更する（作成済みの縮小画像は破棄する）"""
+        if tuple(thumbnail_size) != self.thumbnail_size:
+            self.thumbnail_size = tuple(thumbnail_size)
+            self.clear()
+
+    def __len__(self):
+        return len(self._images)
+
+    def clear(self):
+        """キャッシュを空にする（デコード中の結果は破棄する）"""
+        self.cancel_pending()
+        self._retired.update(self._tasks.values())
+        self._tasks = {}
+        self._images.clear()
+        self._original_sizes.clear()
+        self.total_bytes = 0
+
+    def wait(self):
+        """デコード中のタスクの完了を待つ"""
+        self._pool.waitForDone()